@@ -10,21 +10,188 @@ Flask 後端，提供：
   - /admin/api/...    → 管理 API
 """
 
-from flask import Flask, request, jsonify, send_from_directory, abort
+from flask import Flask, request, jsonify, send_from_directory, abort, make_response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from datetime import datetime, timedelta
+import click
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql as postgresql_dialect, sqlite as sqlite_dialect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import joinedload, raiseload
+from datetime import date, datetime, timedelta
 import os
 import json
+import mimetypes
+import atexit
+import base64
+import gzip
+import hashlib
+import hmac
+import io
+import binascii
+import bisect
+import collections
+import concurrent.futures
+import csv
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__, static_folder='static')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///booking.db'
+
+# ─────────────────────────────────────────────
+# 資料庫連線設定
+# ─────────────────────────────────────────────
+# 預設使用 SQLite：SQLITE_PATH 為相對路徑時放在 instance/ 下，
+# 正式環境指向持久磁碟（Render 為 /var/data/booking.db）。
+# 設定 DATABASE_URL 即改用該資料庫（如 PostgreSQL），其餘程式碼不需變更。
+
+SQLITE_PRAGMAS = [
+    # WAL 讓讀取不被寫入阻擋，多個 gunicorn worker 同時寫入時改為排隊等待鎖
+    f"journal_mode={os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')}",
+    # WAL 下 NORMAL 仍不會損毀資料庫，只在斷電時可能遺失最後幾筆交易
+    f"synchronous={os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+    f"busy_timeout={int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}",
+    f"mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+    # 負值單位為 KiB，每條連線約 20 MB 頁面快取
+    f"cache_size={int(os.environ.get('SQLITE_CACHE_SIZE', -20000))}",
+    'temp_store=MEMORY',
+]
+
+
+def _database_uri():
+    """DATABASE_URL 優先，否則為 SQLITE_PATH 指定的 SQLite 檔案"""
+    url = os.environ.get('DATABASE_URL')
+    if url:
+        # Render/Heroku 提供的 postgres:// 在 SQLAlchemy 2 須寫成 postgresql://
+        if url.startswith('postgres://'):
+            url = 'postgresql://' + url[len('postgres://'):]
+        return url
+    path = os.environ.get('SQLITE_PATH', 'booking.db')
+    if os.path.isabs(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f'sqlite:///{path}'
+
+
+def _engine_options(uri):
+    """連線池設定；記憶體 SQLite 由 Flask-SQLAlchemy 固定使用單一連線，不套用"""
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        return {}
+    options = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    }
+    if not uri.startswith('sqlite'):
+        # 網路資料庫的連線可能被伺服器端或中間設備關閉
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    return options
+
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_pragmas(dbapi_conn, connection_record):
+    """每條新建立的 SQLite 連線套用 SQLITE_PRAGMAS"""
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
+
+
+app.config['SQLALCHEMY_DATABASE_URI'] = _database_uri()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'music-school-secret-2024')
 
 CORS(app)
 db = SQLAlchemy(app)
 
+
+def upsert_insert(model):
+    """依目前的資料庫回傳支援 on_conflict_do_update / on_conflict_do_nothing 的 INSERT"""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql_dialect.insert(model)
+    return sqlite_dialect.insert(model)
+
+# ─────────────────────────────────────────────
+# JSON 編碼與壓縮
+# ─────────────────────────────────────────────
+# 有安裝 orjson 時以其編碼/解碼，否則使用標準函式庫。
+# to_dict 直接回傳 datetime，於編碼時統一格式化：datetime 為 YYYY-MM-DD HH:MM、date 為 YYYY-MM-DD。
+
+JSON_GZIP_MIN_SIZE = int(os.environ.get('JSON_GZIP_MIN_SIZE', 1024))
+JSON_GZIP_LEVEL = int(os.environ.get('JSON_GZIP_LEVEL', 6))
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    ensure_ascii = False
+    sort_keys = False
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, datetime):
+            return o.isoformat(' ', 'minutes')
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def _orjson_options(self, indent=False):
+        # 以 default 格式化日期時間；允許整數等非字串鍵（與標準函式庫相同）
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        return options | orjson.OPT_INDENT_2 if indent else options
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._orjson_options()).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self._orjson_options(indent)),
+            mimetype=self.mimetype,
+        )
+
+
+app.json = FastJSONProvider(app)
+
+
+@app.after_request
+def _gzip_json(response):
+    """較大的 JSON 回應依 Accept-Encoding 以 gzip 壓縮"""
+    if (response.mimetype != 'application/json' or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or not request.accept_encodings['gzip']):
+        return response
+    data = response.get_data()
+    if len(data) < JSON_GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=JSON_GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
 # ─────────────────────────────────────────────
 # 資料庫模型
 # ─────────────────────────────────────────────
@@ -51,6 +218,11 @@ class Teacher(db.Model):
 
 class TimeSlot(db.Model):
     __tablename__ = 'time_slots'
+    __table_args__ = (
+        db.Index('ix_time_slots_teacher_avail_date_time', 'teacher_id', 'is_available', 'date', 'time'),
+        # 同一老師同一時間只有一個時段，並行展開時段時以 ON CONFLICT DO NOTHING 略過已存在者
+        db.Index('ux_time_slots_teacher_date_time', 'teacher_id', 'date', 'time', unique=True),
+    )
     id           = db.Column(db.Integer, primary_key=True)
     teacher_id   = db.Column(db.Integer, db.ForeignKey('teachers.id'), nullable=False)
     date         = db.Column(db.String(10), nullable=False)   # YYYY-MM-DD
@@ -67,6 +239,48 @@ class TimeSlot(db.Model):
         }
 
 
+class AvailabilityTemplate(db.Model):
+    """老師每週固定可預約時段（週幾 + 時間），由 materialize_slots 展開成 time_slots"""
+    __tablename__ = 'availability_templates'
+    __table_args__ = (
+        db.UniqueConstraint('teacher_id', 'weekday', 'time', name='uq_availability_templates_teacher_weekday_time'),
+    )
+    id         = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'), nullable=False)
+    weekday    = db.Column(db.Integer, nullable=False)   # 0=週一 … 6=週日
+    time       = db.Column(db.String(5), nullable=False)  # HH:MM
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'teacher_id': self.teacher_id,
+            'weekday': self.weekday,
+            'time': self.time,
+        }
+
+
+class AvailabilityException(db.Model):
+    """固定時段的例外（休假、停課）；time 為空代表整天不開放"""
+    __tablename__ = 'availability_exceptions'
+    __table_args__ = (
+        db.Index('ix_availability_exceptions_teacher_date', 'teacher_id', 'date'),
+    )
+    id         = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'), nullable=False)
+    date       = db.Column(db.String(10), nullable=False)  # YYYY-MM-DD
+    time       = db.Column(db.String(5))                   # HH:MM，空值為整天
+    note       = db.Column(db.Text)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'teacher_id': self.teacher_id,
+            'date': self.date,
+            'time': self.time or '',
+            'note': self.note or '',
+        }
+
+
 class Course(db.Model):
     __tablename__ = 'courses'
     id       = db.Column(db.Integer, primary_key=True)
@@ -116,14 +330,17 @@ class Student(db.Model):
             'parent_contact': self.parent_contact,
             'address': self.address,
             'note': self.note,
-            'enrollment_date': self.enrollment_date.strftime('%Y-%m-%d') if self.enrollment_date else '',
+            'enrollment_date': self.enrollment_date.date() if self.enrollment_date else '',
             'is_active': self.is_active,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
 class Payment(db.Model):
     __tablename__ = 'payments'
+    __table_args__ = (
+        db.Index('ix_payments_status_month', 'status', 'month'),
+    )
     id              = db.Column(db.Integer, primary_key=True)
     student_id      = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
     amount          = db.Column(db.Integer, nullable=False)
@@ -135,6 +352,8 @@ class Payment(db.Model):
     created_at      = db.Column(db.DateTime, default=datetime.now)
 
     student = db.relationship('Student', backref='payments')
+    # to_dict 會讀取的關聯（列表查詢依此預先載入，見 eager_for_serialize）
+    serialize_relations = ('student',)
 
     def to_dict(self):
         return {
@@ -142,12 +361,12 @@ class Payment(db.Model):
             'student_id': self.student_id,
             'student_name': self.student.name if self.student else '',
             'amount': self.amount,
-            'payment_date': self.payment_date.strftime('%Y-%m-%d') if self.payment_date else '',
+            'payment_date': self.payment_date.date() if self.payment_date else '',
             'payment_method': self.payment_method,
             'status': self.status,
             'month': self.month,
             'note': self.note,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
@@ -166,15 +385,39 @@ class Expense(db.Model):
             'id': self.id,
             'category': self.category,
             'amount': self.amount,
-            'expense_date': self.expense_date.strftime('%Y-%m-%d') if self.expense_date else '',
+            'expense_date': self.expense_date.date() if self.expense_date else '',
             'description': self.description,
             'note': self.note,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
+class IncomeMonthly(db.Model):
+    """收入月結彙總（依月份、付款方式、狀態），隨繳費新增/刪除在同一交易內更新"""
+    __tablename__ = 'finance_income_monthly'
+    month          = db.Column(db.String(7), primary_key=True)   # Payment.month（YYYY-MM，可為空字串）
+    payment_method = db.Column(db.String(20), primary_key=True)
+    status         = db.Column(db.String(20), primary_key=True)
+    amount         = db.Column(db.Integer, nullable=False, default=0)
+    count          = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ExpenseMonthly(db.Model):
+    """支出月結彙總（依月份、類別），隨支出新增/刪除在同一交易內更新"""
+    __tablename__ = 'finance_expense_monthly'
+    month    = db.Column(db.String(7), primary_key=True)   # expense_date 的 YYYY-MM
+    category = db.Column(db.String(50), primary_key=True)
+    amount   = db.Column(db.Integer, nullable=False, default=0)
+    count    = db.Column(db.Integer, nullable=False, default=0)
+
+
 class Attendance(db.Model):
     __tablename__ = 'attendance'
+    __table_args__ = (
+        db.Index('ix_attendance_student_date', 'student_id', 'date'),
+        db.Index('ix_attendance_date', 'date'),
+        db.Index('ix_attendance_student_status', 'student_id', 'status', 'date', 'course'),
+    )
     id              = db.Column(db.Integer, primary_key=True)
     student_id      = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
     date            = db.Column(db.String(10), nullable=False)  # YYYY-MM-DD
@@ -186,6 +429,7 @@ class Attendance(db.Model):
     created_at      = db.Column(db.DateTime, default=datetime.now)
 
     student = db.relationship('Student', backref='attendance_records')
+    serialize_relations = ('student',)
 
     def to_dict(self):
         return {
@@ -198,7 +442,7 @@ class Attendance(db.Model):
             'late_minutes': self.late_minutes,
             'course': self.course,
             'note': self.note,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
@@ -218,12 +462,16 @@ class Exam(db.Model):
             'date': self.date,
             'max_score': self.max_score,
             'pass_score': self.pass_score,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
 class Grade(db.Model):
     __tablename__ = 'grades'
+    __table_args__ = (
+        db.Index('ix_grades_exam_score', 'exam_id', 'score'),
+        db.Index('ix_grades_student_created', 'student_id', 'created_at'),
+    )
     id              = db.Column(db.Integer, primary_key=True)
     exam_id         = db.Column(db.Integer, db.ForeignKey('exams.id'), nullable=False)
     student_id      = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
@@ -235,6 +483,7 @@ class Grade(db.Model):
 
     exam = db.relationship('Exam', backref='grades')
     student = db.relationship('Student', backref='grades')
+    serialize_relations = ('exam', 'student')
 
     def to_dict(self):
         return {
@@ -248,7 +497,7 @@ class Grade(db.Model):
             'rank': self.rank,
             'trend': self.trend,
             'note': self.note,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
@@ -263,6 +512,7 @@ class Shift(db.Model):
     created_at      = db.Column(db.DateTime, default=datetime.now)
 
     teacher = db.relationship('Teacher', backref='shifts')
+    serialize_relations = ('teacher',)
 
     def to_dict(self):
         return {
@@ -273,7 +523,7 @@ class Shift(db.Model):
             'start_time': self.start_time,
             'end_time': self.end_time,
             'course': self.course,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
@@ -290,6 +540,7 @@ class Substitute(db.Model):
 
     original_teacher = db.relationship('Teacher', foreign_keys=[original_teacher_id], backref='original_substitutes')
     substitute_teacher = db.relationship('Teacher', foreign_keys=[substitute_teacher_id], backref='substitute_shifts')
+    serialize_relations = ('original_teacher', 'substitute_teacher')
 
     def to_dict(self):
         return {
@@ -302,7 +553,7 @@ class Substitute(db.Model):
             'time_slot': self.time_slot,
             'reason': self.reason,
             'status': self.status,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
@@ -319,6 +570,7 @@ class Leave(db.Model):
     created_at      = db.Column(db.DateTime, default=datetime.now)
 
     teacher = db.relationship('Teacher', backref='leaves')
+    serialize_relations = ('teacher',)
 
     def to_dict(self):
         return {
@@ -331,12 +583,16 @@ class Leave(db.Model):
             'days': self.days,
             'reason': self.reason,
             'status': self.status,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
         }
 
 
 class Booking(db.Model):
     __tablename__ = 'bookings'
+    __table_args__ = (
+        db.Index('ix_bookings_status_created', 'status', 'created_at'),
+        db.Index('ix_bookings_created', 'created_at'),
+    )
     id           = db.Column(db.Integer, primary_key=True)
     booking_code = db.Column(db.String(20), unique=True, nullable=False)
     teacher_id   = db.Column(db.Integer, db.ForeignKey('teachers.id'), nullable=False)
@@ -356,120 +612,488 @@ class Booking(db.Model):
 
     teacher = db.relationship('Teacher', backref='bookings')
     slot    = db.relationship('TimeSlot', backref='booking')
+    serialize_relations = ('teacher', 'slot')
 
-    def to_dict(self):
+    def to_dict(self, teacher=None, slot=None):
+        """teacher / slot 可由呼叫端提供已查得的資料（需有 name/instrument、date/time），省去關聯載入"""
+        teacher = teacher if teacher is not None else self.teacher
+        slot = slot if slot is not None else self.slot
         return {
             'id': self.id,
             'booking_code': self.booking_code,
-            'teacher': self.teacher.name if self.teacher else '',
-            'instrument': self.teacher.instrument if self.teacher else '',
-            'date': self.slot.date if self.slot else '',
-            'time': self.slot.time if self.slot else '',
+            'teacher': teacher.name if teacher else '',
+            'instrument': teacher.instrument if teacher else '',
+            'date': slot.date if slot else '',
+            'time': slot.time if slot else '',
             'student_name': self.student_name,
             'student_contact': self.student_contact,
             'student_age': self.student_age,
             'student_level': self.student_level,
             'student_note': self.student_note,
-            'courses': json.loads(self.courses_json or '[]'),
+            'courses': app.json.loads(self.courses_json or '[]'),
             'total_price': self.total_price,
             'status': self.status,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else '',
+            'created_at': self.created_at or '',
+        }
+
+
+class IdSequence(db.Model):
+    """編號序列（預約編號、學生編號），由 SequenceAllocator 分段配發"""
+    __tablename__ = 'sequences'
+    name       = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False)
+
+
+class AvailabilityVersion(db.Model):
+    """每位老師時段異動的版本號，各 worker 依此判斷記憶體中的可用時段是否過期"""
+    __tablename__ = 'availability_versions'
+    teacher_id = db.Column(db.Integer, primary_key=True)
+    version    = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SchemaMigration(db.Model):
+    """已套用的結構遷移（見 MIGRATIONS）"""
+    __tablename__ = 'schema_migrations'
+    id         = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class LineOutbox(db.Model):
+    """LINE 發送佇列：管理端與 webhook 只寫入此表，由背景 LineSender 實際呼叫 LINE API"""
+    __tablename__ = 'line_outbox'
+    __table_args__ = (
+        db.Index('ix_line_outbox_status_next', 'status', 'next_attempt_at'),
+    )
+    id              = db.Column(db.Integer, primary_key=True)
+    kind            = db.Column(db.String(20), nullable=False)   # broadcast / push / multicast / reply
+    payload         = db.Column(db.Text, nullable=False)         # LINE API 的 JSON 內容
+    access_token    = db.Column(db.Text)                         # 空值時使用環境變數的 token
+    status          = db.Column(db.String(20), nullable=False, default='pending')  # pending / sending / sent / failed
+    attempts        = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    last_status     = db.Column(db.Integer)                      # 最後一次 LINE API 的 HTTP 狀態碼
+    last_error      = db.Column(db.Text)
+    created_at      = db.Column(db.DateTime, default=datetime.now)
+    sent_at         = db.Column(db.DateTime)
+    # 每次重試都帶同一個 X-Line-Retry-Key，LINE 據此避免逾時重送造成重複發送
+    retry_key       = db.Column(db.String(36))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at.strftime('%Y-%m-%d %H:%M:%S') if self.next_attempt_at else '',
+            'last_status': self.last_status,
+            'last_error': self.last_error or '',
+            'created_at': self.created_at or '',
+            'sent_at': self.sent_at.strftime('%Y-%m-%d %H:%M:%S') if self.sent_at else '',
+        }
+
+
+class LineEvent(db.Model):
+    """已收到的 LINE webhook 事件，webhook 先存檔回應，再由 LineEventProcessor 批次處理"""
+    __tablename__ = 'line_events'
+    __table_args__ = (
+        db.Index('ix_line_events_status_id', 'status', 'id'),
+    )
+    id               = db.Column(db.Integer, primary_key=True)
+    webhook_event_id = db.Column(db.String(64), unique=True)   # LINE 的 webhookEventId，用於排除重送
+    event_type       = db.Column(db.String(30))
+    payload          = db.Column(db.Text, nullable=False)
+    status           = db.Column(db.String(20), nullable=False, default='pending')  # pending / processing / done / failed
+    error            = db.Column(db.Text)
+    received_at      = db.Column(db.DateTime, default=datetime.now)
+    claimed_at       = db.Column(db.DateTime)                    # 認領時間，processing 逾時即可重新認領
+    processed_at     = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'webhook_event_id': self.webhook_event_id,
+            'event_type': self.event_type,
+            'status': self.status,
+            'error': self.error or '',
+            'received_at': self.received_at.strftime('%Y-%m-%d %H:%M:%S') if self.received_at else '',
+            'processed_at': self.processed_at.strftime('%Y-%m-%d %H:%M:%S') if self.processed_at else '',
+        }
+
+
+class AutoReplyRule(db.Model):
+    """LINE 關鍵字自動回覆規則（由 AutoReplyEngine 編譯後比對）"""
+    __tablename__ = 'line_reply_rules'
+    id         = db.Column(db.Integer, primary_key=True)
+    keywords   = db.Column(db.Text, nullable=False)     # 以逗號或換行分隔；regex 規則為單一正規表示式
+    match_type = db.Column(db.String(20), nullable=False, default='contains')  # contains / exact / regex
+    reply      = db.Column(db.Text, nullable=False)     # 可用 {text}、{keyword} 與 regex 具名群組
+    priority   = db.Column(db.Integer, nullable=False, default=0)  # 數字大者優先
+    is_active  = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def keyword_list(self):
+        if self.match_type == 'regex':
+            return [self.keywords]
+        return [k.strip() for k in re.split(r'[,，\n]', self.keywords) if k.strip()]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'keywords': self.keyword_list(),
+            'match_type': self.match_type,
+            'reply': self.reply,
+            'priority': self.priority,
+            'is_active': self.is_active,
+            'updated_at': self.updated_at or '',
+        }
+
+
+class LineFollower(db.Model):
+    """LINE 好友（由 webhook 的 follow/unfollow 維護），可連結到學生本人或家長"""
+    __tablename__ = 'line_followers'
+    __table_args__ = (
+        db.Index('ix_line_followers_student', 'student_id'),
+    )
+    id            = db.Column(db.Integer, primary_key=True)
+    user_id       = db.Column(db.String(64), unique=True, nullable=False)   # LINE userId
+    student_id    = db.Column(db.Integer, db.ForeignKey('students.id'))
+    relation      = db.Column(db.String(20), default='parent')   # student / parent
+    display_name  = db.Column(db.String(100))
+    is_following  = db.Column(db.Boolean, default=True)
+    followed_at   = db.Column(db.DateTime, default=datetime.now)
+    unfollowed_at = db.Column(db.DateTime)
+
+    student = db.relationship('Student', backref='line_followers')
+    serialize_relations = ('student',)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'student_id': self.student_id,
+            'student_name': self.student.name if self.student else '',
+            'relation': self.relation,
+            'display_name': self.display_name or '',
+            'is_following': self.is_following,
+            'followed_at': self.followed_at or '',
+            'unfollowed_at': self.unfollowed_at or '',
+        }
+
+
+# ─────────────────────────────────────────────
+# 編號配發
+# ─────────────────────────────────────────────
+
+class SequenceAllocator:
+    """
+    以 sequences 資料表為準的號碼配發器（hi/lo）。
+    每個 worker 一次向資料庫預留 block_size 個號碼（單一原子 UPDATE），
+    之後在記憶體內依序配發，不需 COUNT(*) 也不會因併發或刪除而重複。
+    號碼在同一 worker 內遞增；worker 重啟時未用完的號碼會留下空號。
+    """
+
+    def __init__(self, name, block_size=None, start=1001):
+        self.name = name
+        self.block_size = block_size or int(os.environ.get('SEQUENCE_BLOCK_SIZE', 20))
+        self.start = start
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = 0
+        self._end = 0
+
+    def next(self):
+        with self._lock:
+            # gunicorn --preload fork 後不可沿用父行程預留的區段
+            if self._pid != os.getpid() or self._next >= self._end:
+                self._next, self._end = self._reserve_block()
+                self._pid = os.getpid()
+            value = self._next
+            self._next += 1
+            return value
+
+    def reserve(self, count):
+        """一次預留 count 個連續號碼（批次匯入用），不影響記憶體內的區段"""
+        start, end = self._reserve_block(count)
+        return range(start, end)
+
+    def _reserve_block(self, size=None):
+        """在獨立的短交易中預留下一個區段，不受目前請求的交易 rollback 影響"""
+        size = size or self.block_size
+        table = IdSequence.__table__
+        for _ in range(2):
+            with db.engine.begin() as conn:
+                new_next = conn.execute(
+                    table.update()
+                    .where(table.c.name == self.name)
+                    .values(next_value=table.c.next_value + size)
+                    .returning(table.c.next_value)
+                ).scalar()
+            if new_next is not None:
+                return new_next - size, new_next
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(table.insert().values(name=self.name, next_value=self.start))
+            except IntegrityError:
+                pass  # 其他 worker 已建立
+        raise RuntimeError(f'無法配發序號：{self.name}')
+
+
+booking_code_seq = SequenceAllocator('booking_code')
+student_id_seq = SequenceAllocator('student_id')
+
+
+# ─────────────────────────────────────────────
+# 可預約時段索引
+# ─────────────────────────────────────────────
+
+class AvailabilityIndex:
+    """
+    每個 worker 在記憶體中保存各老師今天起的可預約時段（日期 → 依時間排序的 (time, id)），
+    /api/slots 直接由此回答，不需查詢資料庫。
+    異動時段的請求在同一交易內呼叫 bump_availability() 遞增該老師的版本號，
+    提交後以 invalidate() 清掉本 worker 的快取；其他 worker 至多每 check_interval 秒
+    讀一次全部版本號（單一小查詢），版本不同的老師於下次查詢時重新載入。
+    最多落後 check_interval 秒；實際預約仍由 create_booking 的條件式 UPDATE 把關。
+    只快取在職老師（與版本號同一查詢取得），其他 teacher_id 交由呼叫端查資料庫，快取大小不超過在職老師數。
+    """
+
+    def __init__(self, check_interval=None):
+        self.check_interval = check_interval if check_interval is not None else \
+            float(os.environ.get('AVAILABILITY_CHECK_SECONDS', 1))
+        self._lock = threading.Lock()
+        self._teachers = {}     # teacher_id -> (version, loaded_from, dates, by_date)
+        self._active = frozenset()
+        self._checked_at = 0.0
+        self._pid = None
+
+    def slots(self, teacher_id, start, end):
+        """teacher_id 在 start ~ end（含，YYYY-MM-DD）的可預約時段；非在職老師或 start 早於載入日時回傳 None"""
+        self._sync_versions()
+        if teacher_id not in self._active:
+            return None
+        entry = self._teachers.get(teacher_id)
+        if entry is None:
+            entry = self._load(teacher_id)
+        _, loaded_from, dates, by_date = entry
+        if start < loaded_from:
+            return None
+        result = []
+        for date in dates[bisect.bisect_left(dates, start):bisect.bisect_right(dates, end)]:
+            result.extend(
+                {'id': slot_id, 'teacher_id': teacher_id, 'date': date, 'time': time_, 'is_available': True}
+                for time_, slot_id in by_date[date]
+            )
+        return result
+
+    def invalidate(self, teacher_id):
+        with self._lock:
+            self._teachers.pop(teacher_id, None)
+
+    def _sync_versions(self):
+        now = time.monotonic()
+        with self._lock:
+            # gunicorn --preload fork 後不沿用父行程的快取
+            if self._pid != os.getpid():
+                self._teachers.clear()
+                self._checked_at = 0.0
+                self._pid = os.getpid()
+            if now - self._checked_at < self.check_interval:
+                return
+        versions = {
+            teacher_id: version or 0
+            for teacher_id, version in db.session.query(Teacher.id, AvailabilityVersion.version)
+            .outerjoin(AvailabilityVersion, AvailabilityVersion.teacher_id == Teacher.id)
+            .filter(Teacher.is_active.is_(True))
         }
+        with self._lock:
+            self._active = frozenset(versions)
+            for teacher_id, entry in list(self._teachers.items()):
+                # 離職（或已刪除）的老師一併移出快取
+                if versions.get(teacher_id) != entry[0]:
+                    del self._teachers[teacher_id]
+            self._checked_at = now
+
+    def _load(self, teacher_id):
+        # 先讀版本再載入時段：載入期間若有異動，版本號必然不同，下次檢查會重新載入
+        version = db.session.query(AvailabilityVersion.version).filter_by(teacher_id=teacher_id).scalar() or 0
+        loaded_from = datetime.now().strftime('%Y-%m-%d')
+        rows = db.session.query(TimeSlot.date, TimeSlot.time, TimeSlot.id).filter(
+            TimeSlot.teacher_id == teacher_id,
+            TimeSlot.is_available.is_(True),
+            TimeSlot.date >= loaded_from,
+        ).order_by(TimeSlot.date, TimeSlot.time).all()
+        by_date = {}
+        for date, time_, slot_id in rows:
+            by_date.setdefault(date, []).append((time_, slot_id))
+        entry = (version, loaded_from, sorted(by_date), by_date)
+        with self._lock:
+            self._teachers[teacher_id] = entry
+        return entry
+
+
+def bump_availability(teacher_id):
+    """在目前交易內遞增老師的時段版本號（提交後記得 availability_index.invalidate）"""
+    # 單一 upsert：兩個交易同時替新老師建立版本列時不會撞主鍵
+    db.session.execute(
+        upsert_insert(AvailabilityVersion).values(teacher_id=teacher_id, version=1)
+        .on_conflict_do_update(index_elements=['teacher_id'], set_={'version': AvailabilityVersion.version + 1})
+    )
+
+
+availability_index = AvailabilityIndex()
 
 
 # ─────────────────────────────────────────────
 # 靜態頁面
 # ─────────────────────────────────────────────
+# 執行 python build_static.py 後，頁面改由 dist/ 提供：內嵌 CSS/JS 拆成帶雜湊檔名的
+# /assets/ 資源（immutable 長期快取），頁面本身以 ETag 重新驗證，並依 Accept-Encoding
+# 回傳預先壓縮的 br/gzip 版本。尚未建置或原始頁面較新時直接回傳 static/ 下的原檔。
+
+STATIC_DIST = os.path.join(app.root_path, 'dist')
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+
+def _load_static_manifest():
+    try:
+        with open(os.path.join(STATIC_DIST, 'manifest.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+static_manifest = _load_static_manifest()
+
+
+def _send_built(relpath, immutable):
+    """依 Accept-Encoding 回傳 dist/ 下的檔案或其預先壓縮版本"""
+    info = static_manifest['files'][relpath]
+    encoding = next((e for e in info['encodings'] if request.accept_encodings[e]), None)
+    filename = relpath + {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+    response = send_from_directory(
+        STATIC_DIST, filename,
+        mimetype=mimetypes.guess_type(relpath)[0],
+        etag=f"{info['etag']}-{encoding}" if encoding else info['etag'],
+        max_age=ASSET_MAX_AGE if immutable else 0,
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def send_page(filename):
+    """回傳頁面：有建置版本用建置版本，否則用原檔"""
+    relpath = static_manifest and static_manifest['pages'].get(filename)
+    source = os.path.join(app.root_path, 'static', filename)
+    if not relpath or os.path.getmtime(source) > static_manifest['built_at']:
+        return send_from_directory('static', filename)
+    return _send_built(relpath, immutable=False)
+
+
+@app.route('/assets/<path:filename>')
+def built_asset(filename):
+    """建置產生的 CSS/JS（檔名含內容雜湊）"""
+    relpath = f'assets/{filename}'
+    if not static_manifest or relpath not in static_manifest['files']:
+        abort(404)
+    return _send_built(relpath, immutable=True)
+
 
 @app.route('/')
 def index():
     """學生預約頁面"""
-    return send_from_directory('static', 'booking.html')
+    return send_page('booking.html')
 
 @app.route('/admin')
 def admin_login():
     """管理後台登入頁"""
-    return send_from_directory('static', 'admin.html')
+    return send_page('admin.html')
 
 @app.route('/dashboard')
 def dashboard():
     """模組管理首頁（需登入）"""
-    return send_from_directory('static', 'index.html')
+    return send_page('index.html')
 
 @app.route('/booking-admin')
 def booking_admin():
     """預約管理頁面（iframe用）"""
-    return send_from_directory('static', 'booking-admin.html')
+    return send_page('booking-admin.html')
 
 @app.route('/teacher-mgmt')
 def teacher_mgmt():
     """師生管理頁面（iframe用）"""
-    return send_from_directory('static', 'teacher-mgmt.html')
+    return send_page('teacher-mgmt.html')
 
 @app.route('/finance')
 def finance():
     """財務報表頁面（iframe用）"""
-    return send_from_directory('static', 'finance.html')
+    return send_page('finance.html')
 
 @app.route('/accounting')
 def accounting():
     """會計科目頁面（iframe用）"""
-    return send_from_directory('static', 'accounting.html')
+    return send_page('accounting.html')
 
 @app.route('/course-schedule')
 def course_schedule():
     """課表系統頁面（iframe用）"""
-    return send_from_directory('static', 'course-schedule.html')
+    return send_page('course-schedule.html')
 
 @app.route('/ceo-report')
 def ceo_report():
     """CEO每日報頁面（iframe用）"""
-    return send_from_directory('static', 'ceo-report.html')
+    return send_page('ceo-report.html')
 
 @app.route('/line-messages')
 def line_messages():
     """LINE 訊息推播頁面（iframe用）"""
-    return send_from_directory('static', 'line-messages.html')
+    return send_page('line-messages.html')
 
 @app.route('/line-notifications')
 def line_notifications():
     """LINE 通知設定頁面（iframe用）"""
-    return send_from_directory('static', 'line-notifications.html')
+    return send_page('line-notifications.html')
 
 @app.route('/line-interactive')
 def line_interactive():
     """LINE 互動功能頁面（iframe用）"""
-    return send_from_directory('static', 'line-interactive.html')
+    return send_page('line-interactive.html')
 
 @app.route('/website-design')
 def website_design():
     """網站設計頁面（iframe用）"""
-    return send_from_directory('static', 'website-design.html')
+    return send_page('website-design.html')
 
 @app.route('/website-content')
 def website_content():
     """內容管理頁面（iframe用）"""
-    return send_from_directory('static', 'website-content.html')
+    return send_page('website-content.html')
 
 @app.route('/online-booking')
 def online_booking():
     """線上報名頁面（iframe用）"""
-    return send_from_directory('static', 'online-booking.html')
+    return send_page('online-booking.html')
 
 @app.route('/attendance')
 def attendance():
     """出席打卡頁面（iframe用）"""
-    return send_from_directory('static', 'attendance.html')
+    return send_page('attendance.html')
 
 @app.route('/grades')
 def grades():
     """成績管理頁面（iframe用）"""
-    return send_from_directory('static', 'grades.html')
+    return send_page('grades.html')
 
 @app.route('/staff-schedule')
 def staff_schedule():
     """排班管理頁面（iframe用）"""
-    return send_from_directory('static', 'staff-schedule.html')
+    return send_page('staff-schedule.html')
 
 
 # ─────────────────────────────────────────────
@@ -501,13 +1125,20 @@ def get_slots():
     date = request.args.get('date')          # YYYY-MM-DD
     days_ahead = request.args.get('days', 14, type=int)
 
+    today = datetime.now().date()
+    end   = today + timedelta(days=days_ahead)
+
+    # 指定老師時由記憶體索引回答
+    if teacher_id:
+        start, stop = (date, date) if date else (str(today), str(end))
+        slots = availability_index.slots(teacher_id, start, stop)
+        if slots is not None:
+            return jsonify(slots)
+
     query = TimeSlot.query.filter_by(is_available=True)
     if teacher_id:
         query = query.filter_by(teacher_id=teacher_id)
 
-    today = datetime.now().date()
-    end   = today + timedelta(days=days_ahead)
-
     if date:
         slots = query.filter_by(date=date).order_by(TimeSlot.time).all()
     else:
@@ -532,23 +1163,37 @@ def create_booking():
         if not data.get(field):
             return jsonify({'error': f'缺少必填欄位：{field}'}), 400
 
-    # 確認時段可用
-    slot = TimeSlot.query.get(data['slot_id'])
-    if not slot or not slot.is_available:
+    # 產生預約編號（須在搶占時段前取得：配發器使用獨立交易寫入）
+    booking_code = 'MU' + datetime.now().strftime('%m%d') + str(booking_code_seq.next())
+
+    # 以單一條件式 UPDATE 搶占時段：只有時段屬於該老師且仍可預約時才會更新，
+    # 多個 worker 同時搶同一時段時只有一個能成功（影響筆數為 1）。
+    # RETURNING 順便取回回應所需的時段與老師資料，成功路徑不需再 SELECT。
+    claimed = db.session.execute(
+        db.update(TimeSlot)
+        .where(
+            TimeSlot.id == data['slot_id'],
+            TimeSlot.teacher_id == data['teacher_id'],
+            TimeSlot.is_available.is_(True),
+        )
+        .values(is_available=False)
+        .returning(
+            TimeSlot.date,
+            TimeSlot.time,
+            db.select(Teacher.name).where(Teacher.id == TimeSlot.teacher_id).scalar_subquery().label('name'),
+            db.select(Teacher.instrument).where(Teacher.id == TimeSlot.teacher_id).scalar_subquery().label('instrument'),
+        )
+    ).first()
+    if claimed is None:
+        db.session.rollback()
+        if db.session.get(Teacher, data['teacher_id']) is None:
+            return jsonify({'error': '找不到老師資料'}), 404
         return jsonify({'error': '此時段已被預約，請選擇其他時段'}), 409
 
-    # 確認老師存在
-    teacher = Teacher.query.get(data['teacher_id'])
-    if not teacher:
-        return jsonify({'error': '找不到老師資料'}), 404
-
     # 計算費用
     courses = data.get('courses', [])
     total = sum(c.get('price', 0) for c in courses)
 
-    # 產生預約編號
-    booking_code = 'MU' + datetime.now().strftime('%m%d') + str(Booking.query.count() + 1001)
-
     booking = Booking(
         booking_code=booking_code,
         teacher_id=data['teacher_id'],
@@ -564,14 +1209,18 @@ def create_booking():
         created_at=datetime.now(),
     )
 
-    slot.is_available = False
     db.session.add(booking)
+    bump_availability(booking.teacher_id)
+    db.session.flush()
+    # claimed 同時帶有時段（date/time）與老師（name/instrument）欄位
+    result = booking.to_dict(teacher=claimed, slot=claimed)
     db.session.commit()
+    availability_index.invalidate(booking.teacher_id)
 
     return jsonify({
         'success': True,
         'booking_code': booking_code,
-        'booking': booking.to_dict()
+        'booking': result
     }), 201
 
 
@@ -586,15 +1235,198 @@ def check_admin():
     if pw != ADMIN_PASSWORD:
         abort(401)
 
+
+def abort_json(status, message):
+    """以 JSON 格式中止請求（供無法直接 return 的輔助函式使用）"""
+    abort(make_response(jsonify({'error': message}), status))
+
+
+# ─────────────────────────────────────────────
+# 列表分頁（keyset）與篩選工具
+# ─────────────────────────────────────────────
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def _encode_cursor(values):
+    """將排序鍵編碼為不透明的 cursor 字串"""
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor, columns):
+    """解析 cursor，依欄位型別還原 datetime；格式錯誤回傳 400"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError('cursor length mismatch')
+        return [
+            datetime.fromisoformat(v) if isinstance(col.type, db.DateTime) and v is not None else v
+            for v, col in zip(values, columns)
+        ]
+    except (ValueError, TypeError, binascii.Error):
+        abort_json(400, '無效的 cursor')
+
+
+def _keyset_conditions(order_columns, values, descending):
+    """
+    排序鍵在 cursor（values）之後的條件，依讀取順序排列。
+    第一欄可為 NULL（如 created_at）：NULL 視為最小值，遞減時排在最後、遞增時排在最前。
+    row value 比較會略過 NULL 列，因此把 NULL 與非 NULL 拆成兩段，各自仍能以索引範圍搜尋。
+    """
+    first, rest, rest_values = order_columns[0], db.tuple_(*order_columns[1:]), db.tuple_(*values[1:])
+    if not first.expression.nullable:
+        key, after = db.tuple_(*order_columns), db.tuple_(*values)
+        return [key < after if descending else key > after]
+    if values[0] is None:
+        in_nulls = db.and_(first.is_(None), rest < rest_values if descending else rest > rest_values)
+        return [in_nulls] if descending else [in_nulls, first.isnot(None)]
+    key, after = db.tuple_(*order_columns), db.tuple_(*values)
+    return [key < after, first.is_(None)] if descending else [key > after]
+
+
+def eager_for_serialize(query):
+    """
+    依模型宣告的 serialize_relations，以 joinedload 在同一個 SELECT 中載入
+    to_dict 需要的關聯，其餘關聯設為 raiseload。
+    序列化期間若意外觸發延遲載入會直接拋錯，確保列表查詢次數固定，
+    不會隨筆數增加（N+1）。
+    """
+    model = query.column_descriptions[0]['entity']
+    relations = getattr(model, 'serialize_relations', ())
+    return query.options(
+        *[joinedload(getattr(model, name)) for name in relations],
+        raiseload('*'),
+    )
+
+
+def _list_response(query, order_columns, descending=True):
+    """
+    管理列表共用回應。
+    未帶 limit/cursor 時維持舊行為（回傳完整陣列）；
+    帶入時改用 keyset 分頁，回傳 {items, next_cursor, has_more[, total]}。
+      - limit          每頁筆數（預設 50，上限 500）
+      - cursor         上一頁回傳的 next_cursor
+      - include_total  1 = 額外回傳符合篩選條件的總筆數
+    order_columns 最後一欄必須是主鍵，確保排序鍵唯一；只有第一欄可為 NULL（NULL 視為最小值）。
+    每種回應模式的查詢次數固定：一次 SELECT，include_total 時再加一次 COUNT；
+    第一欄可為 NULL 時，分頁跨過 NULL 與非 NULL 的交界那一頁多一次 SELECT。
+    """
+    ordering = [c.desc() if descending else c.asc() for c in order_columns]
+    if order_columns[0].expression.nullable:
+        # SQLite 的預設即是如此，PostgreSQL 則相反，明確指定讓兩者一致
+        ordering[0] = ordering[0].nulls_last() if descending else ordering[0].nulls_first()
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+
+    if limit is None and not cursor:
+        return jsonify([row.to_dict() for row in eager_for_serialize(query).order_by(*ordering).all()])
+
+    limit = max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+    result = {}
+    if request.args.get('include_total') in ('1', 'true'):
+        result['total'] = query.order_by(None).count()
+
+    conditions = [None]
+    if cursor:
+        conditions = _keyset_conditions(order_columns, _decode_cursor(cursor, order_columns), descending)
+    rows = []
+    for condition in conditions:
+        page_query = query if condition is None else query.filter(condition)
+        rows += eager_for_serialize(page_query).order_by(*ordering).limit(limit + 1 - len(rows)).all()
+        if len(rows) > limit:
+            break
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    result['items'] = [row.to_dict() for row in rows]
+    result['has_more'] = has_more
+    result['next_cursor'] = (
+        _encode_cursor([getattr(rows[-1], c.key) for c in order_columns]) if has_more else None
+    )
+    return jsonify(result)
+
+
+def _parse_date_arg(name):
+    """讀取 YYYY-MM-DD 查詢參數，格式錯誤回傳 400"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort_json(400, f'日期格式錯誤：{name}')
+
+
+def _filter_date_range(query, column):
+    """
+    套用 date_from / date_to（皆含當日）篩選。
+    DateTime 欄位以 datetime 比較；字串日期欄位（YYYY-MM-DD）以字串比較。
+    """
+    date_from = _parse_date_arg('date_from')
+    date_to = _parse_date_arg('date_to')
+    if isinstance(column.type, db.DateTime):
+        if date_from:
+            query = query.filter(column >= date_from)
+        if date_to:
+            query = query.filter(column < date_to + timedelta(days=1))
+    else:
+        if date_from:
+            query = query.filter(column >= date_from.strftime('%Y-%m-%d'))
+        if date_to:
+            query = query.filter(column <= date_to.strftime('%Y-%m-%d'))
+    return query
+
+
 @app.route('/admin/api/bookings', methods=['GET'])
 def admin_get_bookings():
     check_admin()
     status = request.args.get('status')
-    query  = Booking.query
+    teacher_id = request.args.get('teacher_id', type=int)
+    q = request.args.get('q', '').strip()
+
+    query = Booking.query
     if status:
         query = query.filter_by(status=status)
-    bookings = query.order_by(Booking.created_at.desc()).all()
-    return jsonify([b.to_dict() for b in bookings])
+    if teacher_id:
+        query = query.filter_by(teacher_id=teacher_id)
+    if q:
+        like = f'%{q}%'
+        query = query.filter(db.or_(
+            Booking.student_name.like(like),
+            Booking.student_contact.like(like),
+            Booking.booking_code.like(like),
+            Booking.teacher.has(Teacher.name.like(like)),
+        ))
+    if request.args.get('date_from') or request.args.get('date_to'):
+        # 依上課日期（時段日期）篩選
+        query = _filter_date_range(query.join(TimeSlot, Booking.slot_id == TimeSlot.id), TimeSlot.date)
+    return _list_response(query, [Booking.created_at, Booking.id])
+
+
+@app.route('/admin/api/bookings/stats', methods=['GET'])
+def admin_get_booking_stats():
+    """預約統計（總數、已確認、今日課程、預估收入），供分頁列表頁使用"""
+    check_admin()
+    today = datetime.now().strftime('%Y-%m-%d')
+
+    total, confirmed, revenue = db.session.query(
+        db.func.count(Booking.id),
+        db.func.sum(db.case((Booking.status == 'confirmed', 1), else_=0)),
+        db.func.sum(db.case((Booking.status == 'confirmed', Booking.total_price), else_=0)),
+    ).one()
+    today_count = db.session.query(db.func.count(Booking.id)).join(
+        TimeSlot, Booking.slot_id == TimeSlot.id
+    ).filter(Booking.status == 'confirmed', TimeSlot.date == today).scalar()
+
+    return jsonify({
+        'total': total or 0,
+        'confirmed': confirmed or 0,
+        'today': today_count or 0,
+        'today_date': today,
+        'revenue': revenue or 0,
+    })
 
 
 @app.route('/admin/api/bookings/<int:bid>/cancel', methods=['POST'])
@@ -604,7 +1436,10 @@ def admin_cancel_booking(bid):
     booking.status = 'cancelled'
     if booking.slot:
         booking.slot.is_available = True
+        bump_availability(booking.slot.teacher_id)
     db.session.commit()
+    if booking.slot:
+        availability_index.invalidate(booking.slot.teacher_id)
     return jsonify({'success': True})
 
 
@@ -628,7 +1463,7 @@ def admin_add_teacher():
     )
     db.session.add(teacher)
     db.session.commit()
-    # 自動建立未來 14 天時段
+    # 建立週一～週六固定時段並展開未來時段
     _generate_slots(teacher.id, data.get('times', ['10:00','14:00','16:00','19:00']))
     return jsonify(teacher.to_dict()), 201
 
@@ -653,7 +1488,13 @@ def admin_add_slot():
         is_available=True,
     )
     db.session.add(slot)
-    db.session.commit()
+    try:
+        bump_availability(slot.teacher_id)   # 自動 flush 新時段，撞唯一索引時在此拋出
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': '該老師在此日期時間已有時段'}), 409
+    availability_index.invalidate(slot.teacher_id)
     return jsonify(slot.to_dict()), 201
 
 
@@ -661,11 +1502,108 @@ def admin_add_slot():
 def admin_delete_slot(sid):
     check_admin()
     slot = TimeSlot.query.get_or_404(sid)
+    teacher_id = slot.teacher_id
     db.session.delete(slot)
+    bump_availability(teacher_id)
+    db.session.commit()
+    availability_index.invalidate(teacher_id)
+    return jsonify({'success': True})
+
+
+@app.route('/admin/api/teachers/<int:tid>/availability', methods=['GET'])
+def admin_get_availability(tid):
+    """老師的每週固定時段與今天起的例外"""
+    check_admin()
+    Teacher.query.get_or_404(tid)
+    templates = AvailabilityTemplate.query.filter_by(teacher_id=tid) \
+        .order_by(AvailabilityTemplate.weekday, AvailabilityTemplate.time).all()
+    exceptions = AvailabilityException.query.filter(
+        AvailabilityException.teacher_id == tid,
+        AvailabilityException.date >= datetime.now().strftime('%Y-%m-%d'),
+    ).order_by(AvailabilityException.date, AvailabilityException.time).all()
+    return jsonify({
+        'templates': [t.to_dict() for t in templates],
+        'exceptions': [e.to_dict() for e in exceptions],
+    })
+
+
+@app.route('/admin/api/teachers/<int:tid>/availability', methods=['PUT'])
+def admin_set_availability(tid):
+    """
+    以 {"templates": [{"weekday": 0, "time": "10:00"}, ...]} 取代老師的固定時段，並展開未來時段。
+    已產生的時段不會刪除；要關閉個別時段請用例外或刪除時段。
+    """
+    check_admin()
+    Teacher.query.get_or_404(tid)
+    data = request.get_json() or {}
+    rows = set()
+    for item in data.get('templates', []):
+        try:
+            weekday = int(item['weekday'])
+            t = datetime.strptime(item['time'], '%H:%M').strftime('%H:%M')
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': '固定時段格式錯誤，需有 weekday（0-6）與 time（HH:MM）'}), 400
+        if not 0 <= weekday <= 6:
+            return jsonify({'error': 'weekday 需介於 0（週一）與 6（週日）'}), 400
+        rows.add((weekday, t))
+
+    AvailabilityTemplate.query.filter_by(teacher_id=tid).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(db.insert(AvailabilityTemplate), [
+            {'teacher_id': tid, 'weekday': weekday, 'time': t} for weekday, t in sorted(rows)
+        ])
+    created = materialize_slots([tid])
+    return jsonify({'success': True, 'templates': len(rows), 'created_slots': created})
+
+
+@app.route('/admin/api/teachers/<int:tid>/availability/exceptions', methods=['POST'])
+def admin_add_availability_exception(tid):
+    """新增例外（date 必填，time 省略為整天），並移除該時段尚未被預約的 time_slots"""
+    check_admin()
+    Teacher.query.get_or_404(tid)
+    data = request.get_json() or {}
+    try:
+        date = datetime.strptime(data.get('date', ''), '%Y-%m-%d').strftime('%Y-%m-%d')
+        t = datetime.strptime(data['time'], '%H:%M').strftime('%H:%M') if data.get('time') else None
+    except ValueError:
+        return jsonify({'error': '日期或時間格式錯誤'}), 400
+
+    exception = AvailabilityException(teacher_id=tid, date=date, time=t, note=data.get('note', ''))
+    db.session.add(exception)
+    open_slots = TimeSlot.query.filter_by(teacher_id=tid, date=date, is_available=True)
+    if t:
+        open_slots = open_slots.filter_by(time=t)
+    removed = open_slots.delete(synchronize_session=False)
+    bump_availability(tid)
     db.session.commit()
+    availability_index.invalidate(tid)
+    return jsonify({**exception.to_dict(), 'removed_slots': removed}), 201
+
+
+@app.route('/admin/api/availability/exceptions/<int:xid>', methods=['DELETE'])
+def admin_delete_availability_exception(xid):
+    """刪除例外並依固定時段補回該日時段"""
+    check_admin()
+    exception = AvailabilityException.query.get_or_404(xid)
+    teacher_id = exception.teacher_id
+    db.session.delete(exception)
+    db.session.flush()
+    materialize_slots([teacher_id])
     return jsonify({'success': True})
 
 
+@app.route('/admin/api/slots/extend', methods=['POST'])
+def admin_extend_slots():
+    """為全部在職老師補齊未來 days（預設 SLOT_HORIZON_DAYS）天的時段，可由外部排程呼叫"""
+    check_admin()
+    days = (request.get_json(silent=True) or {}).get('days')
+    if days is not None and (not isinstance(days, int) or isinstance(days, bool)
+                             or not 1 <= days <= SLOT_MAX_HORIZON_DAYS):
+        return jsonify({'error': f'days 需為 1～{SLOT_MAX_HORIZON_DAYS} 的整數'}), 400
+    created = materialize_slots(days_ahead=days)
+    return jsonify({'success': True, 'created_slots': created})
+
+
 # ─────────────────────────────────────────────
 # 學生管理 API
 # ─────────────────────────────────────────────
@@ -673,8 +1611,24 @@ def admin_delete_slot(sid):
 @app.route('/admin/api/students', methods=['GET'])
 def admin_get_students():
     check_admin()
-    students = Student.query.order_by(Student.created_at.desc()).all()
-    return jsonify([s.to_dict() for s in students])
+    is_active = request.args.get('is_active')
+    instrument = request.args.get('instrument')
+    q = request.args.get('q', '').strip()
+
+    query = Student.query
+    if is_active in ('0', '1'):
+        query = query.filter_by(is_active=is_active == '1')
+    if instrument:
+        query = query.filter_by(instrument=instrument)
+    if q:
+        like = f'%{q}%'
+        query = query.filter(db.or_(
+            Student.name.like(like),
+            Student.contact.like(like),
+            Student.student_id.like(like),
+        ))
+    query = _filter_date_range(query, Student.enrollment_date)
+    return _list_response(query, [Student.created_at, Student.id])
 
 
 @app.route('/admin/api/students', methods=['POST'])
@@ -683,8 +1637,7 @@ def admin_add_student():
     data = request.get_json()
     
     # 產生學生編號
-    student_count = Student.query.count()
-    student_id = 'S' + datetime.now().strftime('%Y%m') + str(student_count + 1001)
+    student_id = 'S' + datetime.now().strftime('%Y%m') + str(student_id_seq.next())
     
     student = Student(
         student_id=student_id,
@@ -743,8 +1696,22 @@ def admin_delete_student(sid):
 @app.route('/admin/api/payments', methods=['GET'])
 def admin_get_payments():
     check_admin()
-    payments = Payment.query.order_by(Payment.payment_date.desc()).all()
-    return jsonify([p.to_dict() for p in payments])
+    status = request.args.get('status')
+    student_id = request.args.get('student_id', type=int)
+    month = request.args.get('month')
+    payment_method = request.args.get('payment_method')
+
+    query = Payment.query
+    if status:
+        query = query.filter_by(status=status)
+    if student_id:
+        query = query.filter_by(student_id=student_id)
+    if month:
+        query = query.filter_by(month=month)
+    if payment_method:
+        query = query.filter_by(payment_method=payment_method)
+    query = _filter_date_range(query, Payment.payment_date)
+    return _list_response(query, [Payment.payment_date, Payment.id])
 
 
 @app.route('/admin/api/payments', methods=['POST'])
@@ -762,6 +1729,7 @@ def admin_add_payment():
         note=data.get('note', ''),
     )
     db.session.add(payment)
+    _rollup_payment(payment, 1)
     db.session.commit()
     return jsonify(payment.to_dict()), 201
 
@@ -770,6 +1738,7 @@ def admin_add_payment():
 def admin_delete_payment(pid):
     check_admin()
     payment = Payment.query.get_or_404(pid)
+    _rollup_payment(payment, -1)
     db.session.delete(payment)
     db.session.commit()
     return jsonify({'success': True})
@@ -782,8 +1751,21 @@ def admin_delete_payment(pid):
 @app.route('/admin/api/expenses', methods=['GET'])
 def admin_get_expenses():
     check_admin()
-    expenses = Expense.query.order_by(Expense.expense_date.desc()).all()
-    return jsonify([e.to_dict() for e in expenses])
+    category = request.args.get('category')
+    month = request.args.get('month')  # YYYY-MM
+
+    query = Expense.query
+    if category:
+        query = query.filter_by(category=category)
+    if month:
+        try:
+            start = datetime.strptime(month + '-01', '%Y-%m-%d')
+        except ValueError:
+            abort_json(400, '月份格式錯誤：month')
+        end = (start + timedelta(days=32)).replace(day=1)
+        query = query.filter(Expense.expense_date >= start, Expense.expense_date < end)
+    query = _filter_date_range(query, Expense.expense_date)
+    return _list_response(query, [Expense.expense_date, Expense.id])
 
 
 @app.route('/admin/api/expenses', methods=['POST'])
@@ -799,6 +1781,7 @@ def admin_add_expense():
         note=data.get('note', ''),
     )
     db.session.add(expense)
+    _rollup_expense(expense, 1)
     db.session.commit()
     return jsonify(expense.to_dict()), 201
 
@@ -807,11 +1790,99 @@ def admin_add_expense():
 def admin_delete_expense(eid):
     check_admin()
     expense = Expense.query.get_or_404(eid)
+    _rollup_expense(expense, -1)
     db.session.delete(expense)
     db.session.commit()
     return jsonify({'success': True})
 
 
+# ─────────────────────────────────────────────
+# 財務月結彙總
+# ─────────────────────────────────────────────
+# finance_income_monthly / finance_expense_monthly 是 payments / expenses 的
+# 月結彙總，報表只讀這兩張表（每月幾十筆），不再掃描整本帳。
+# 新增或刪除繳費、支出時在同一交易內以 _rollup_payment / _rollup_expense 增減；
+# 直接寫入帳目的批次作業結束後須呼叫 rebuild_finance_rollups()。
+
+# 由帳目回填彙總（彙總表已有資料時不動作）
+FINANCE_ROLLUP_BACKFILL = [
+    "INSERT INTO finance_income_monthly (month, payment_method, status, amount, count) "
+    "SELECT COALESCE(month, ''), COALESCE(payment_method, ''), COALESCE(status, ''), SUM(amount), COUNT(*) "
+    "FROM payments WHERE NOT EXISTS (SELECT 1 FROM finance_income_monthly) "
+    "GROUP BY COALESCE(month, ''), COALESCE(payment_method, ''), COALESCE(status, '')",
+    "INSERT INTO finance_expense_monthly (month, category, amount, count) "
+    "SELECT SUBSTR(CAST(expense_date AS TEXT), 1, 7), category, SUM(amount), COUNT(*) "
+    "FROM expenses WHERE NOT EXISTS (SELECT 1 FROM finance_expense_monthly) "
+    "GROUP BY SUBSTR(CAST(expense_date AS TEXT), 1, 7), category",
+]
+
+
+def _rollup_add(model, amount, count, **key):
+    """在目前交易內把 amount / count 累加到彙總列，不存在則新增（單一 upsert，並行新增同月份不會撞主鍵）"""
+    stmt = upsert_insert(model).values(amount=amount, count=count, **key)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=list(key),
+        set_={'amount': model.amount + stmt.excluded.amount, 'count': model.count + stmt.excluded.count},
+    ))
+
+
+def _rollup_payment(payment, sign):
+    """繳費新增（sign=1）或刪除（sign=-1）時更新收入彙總"""
+    _rollup_add(
+        IncomeMonthly, sign * payment.amount, sign,
+        month=payment.month or '',
+        payment_method=payment.payment_method or '',
+        status=payment.status or '',
+    )
+
+
+def _rollup_expense(expense, sign):
+    """支出新增（sign=1）或刪除（sign=-1）時更新支出彙總"""
+    _rollup_add(
+        ExpenseMonthly, sign * expense.amount, sign,
+        month=expense.expense_date.strftime('%Y-%m'),
+        category=expense.category,
+    )
+
+
+def rebuild_finance_rollups():
+    """由 payments / expenses 重新計算全部月結彙總"""
+    with db.engine.begin() as conn:
+        conn.execute(db.delete(IncomeMonthly))
+        conn.execute(db.delete(ExpenseMonthly))
+        for sql in FINANCE_ROLLUP_BACKFILL:
+            conn.execute(db.text(sql))
+
+
+@app.cli.command('rebuild-finance')
+def rebuild_finance_command():
+    """重新計算財務月結彙總：flask --app app rebuild-finance"""
+    rebuild_finance_rollups()
+    print('✓ 財務月結彙總已重新計算')
+
+
+def _parse_month_arg(name):
+    """讀取 YYYY-MM 查詢參數，格式錯誤回傳 400"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        abort_json(400, f'月份格式錯誤：{name}')
+    return value
+
+
+def _income_total(*criteria):
+    return db.session.query(db.func.sum(IncomeMonthly.amount)).filter(
+        IncomeMonthly.status == 'paid', *criteria
+    ).scalar() or 0
+
+
+def _expense_total(*criteria):
+    return db.session.query(db.func.sum(ExpenseMonthly.amount)).filter(*criteria).scalar() or 0
+
+
 # ─────────────────────────────────────────────
 # 財務報表 API
 # ─────────────────────────────────────────────
@@ -819,39 +1890,23 @@ def admin_delete_expense(eid):
 @app.route('/admin/api/finance/summary', methods=['GET'])
 def admin_get_finance_summary():
     check_admin()
-    month = request.args.get('month')  # YYYY-MM
-    
+    month = _parse_month_arg('month')  # YYYY-MM，指定時收入/支出只計該月
+
     # 收入統計
-    payments_query = Payment.query.filter_by(status='paid')
-    if month:
-        payments_query = payments_query.filter(Payment.month == month)
-    
-    total_income = db.session.query(db.func.sum(Payment.amount)).filter(
-        Payment.status == 'paid'
-    ).scalar() or 0
-    
+    income_filter = [IncomeMonthly.month == month] if month else []
+    total_income = _income_total(*income_filter)
+
     # 支出統計
-    expenses_query = Expense.query
-    if month:
-        start_date = month + '-01'
-        end_date = month + '-31'
-        expenses_query = expenses_query.filter(
-            Expense.expense_date >= start_date,
-            Expense.expense_date <= end_date
-        )
-    
-    total_expense = db.session.query(db.func.sum(Expense.amount)).scalar() or 0
-    
+    expense_filter = [ExpenseMonthly.month == month] if month else []
+    total_expense = _expense_total(*expense_filter)
+
     # 學生統計
     active_students = Student.query.filter_by(is_active=True).count()
-    
+
     # 本月收入
     current_month = datetime.now().strftime('%Y-%m')
-    month_income = db.session.query(db.func.sum(Payment.amount)).filter(
-        Payment.month == current_month,
-        Payment.status == 'paid'
-    ).scalar() or 0
-    
+    month_income = _income_total(IncomeMonthly.month == current_month)
+
     return jsonify({
         'total_income': total_income,
         'total_expense': total_expense,
@@ -862,24 +1917,367 @@ def admin_get_finance_summary():
     })
 
 
+@app.route('/admin/api/finance/monthly', methods=['GET'])
+def admin_get_finance_monthly():
+    """
+    指定年度（year，預設今年）每月收入、支出、淨額與明細，
+    並附上去年同月數字供年增率比較。只讀月結彙總表。
+    """
+    check_admin()
+    year = request.args.get('year', type=int) or datetime.now().year
+    months = [f'{y}-{m:02d}' for y in (year - 1, year) for m in range(1, 13)]
+
+    income = {}
+    for row in db.session.query(
+        IncomeMonthly.month, IncomeMonthly.payment_method, db.func.sum(IncomeMonthly.amount)
+    ).filter(
+        IncomeMonthly.status == 'paid', IncomeMonthly.month.in_(months)
+    ).group_by(IncomeMonthly.month, IncomeMonthly.payment_method):
+        income.setdefault(row[0], {})[row[1]] = row[2]
+
+    expense = {}
+    for row in db.session.query(
+        ExpenseMonthly.month, ExpenseMonthly.category, db.func.sum(ExpenseMonthly.amount)
+    ).filter(
+        ExpenseMonthly.month.in_(months)
+    ).group_by(ExpenseMonthly.month, ExpenseMonthly.category):
+        expense.setdefault(row[0], {})[row[1]] = row[2]
+
+    def growth(current, previous):
+        return round((current - previous) / previous * 100, 1) if previous else None
+
+    result = []
+    for m in range(1, 13):
+        month = f'{year}-{m:02d}'
+        last_year = f'{year - 1}-{m:02d}'
+        month_income = sum(income.get(month, {}).values())
+        month_expense = sum(expense.get(month, {}).values())
+        last_income = sum(income.get(last_year, {}).values())
+        last_expense = sum(expense.get(last_year, {}).values())
+        result.append({
+            'month': month,
+            'income': month_income,
+            'expense': month_expense,
+            'net_income': month_income - month_expense,
+            'income_by_method': income.get(month, {}),
+            'expense_by_category': expense.get(month, {}),
+            'last_year_income': last_income,
+            'last_year_expense': last_expense,
+            'income_growth': growth(month_income, last_income),
+            'expense_growth': growth(month_expense, last_expense),
+        })
+
+    return jsonify({'year': year, 'months': result})
+
+
 # ─────────────────────────────────────────────
-# 出席打卡 API
+# 營運報表 API
 # ─────────────────────────────────────────────
 
-@app.route('/admin/api/attendance', methods=['GET'])
-def admin_get_attendance():
+REPORT_CACHE_SECONDS = int(os.environ.get('REPORT_CACHE_SECONDS', 300))
+REPORT_TREND_MONTHS = 6
+
+_report_cache = {}
+_report_cache_lock = threading.Lock()
+
+
+def _cached_report(key, build):
+    """以 key（報表種類與期間）快取 build() 的結果 REPORT_CACHE_SECONDS 秒（各 worker 各自快取）"""
+    now = time.monotonic()
+    with _report_cache_lock:
+        hit = _report_cache.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+    value = build()
+    with _report_cache_lock:
+        # 過期項目順便清掉，避免依日期累積
+        for k in [k for k, (expires, _) in _report_cache.items() if expires <= now]:
+            del _report_cache[k]
+        _report_cache[key] = (now + REPORT_CACHE_SECONDS, value)
+    return value
+
+
+def _confirmed_bookings_between(start, end):
+    """start ~ end（含，YYYY-MM-DD）上課的已確認預約查詢"""
+    return db.session.query(Booking).join(TimeSlot, Booking.slot_id == TimeSlot.id).filter(
+        Booking.status == 'confirmed', TimeSlot.date >= start, TimeSlot.date <= end
+    )
+
+
+def _attendance_rate(start, end):
+    total, attended = db.session.query(
+        db.func.count(Attendance.id),
+        db.func.sum(db.case((Attendance.status.in_(('present', 'late')), 1), else_=0)),
+    ).filter(Attendance.date >= start, Attendance.date <= end).one()
+    return round((attended or 0) / total * 100, 1) if total else None
+
+
+def _build_ceo_report(day):
+    today = day.strftime('%Y-%m-%d')
+    yesterday = (day - timedelta(days=1)).strftime('%Y-%m-%d')
+    week_start = day - timedelta(days=day.weekday())
+    week_end = week_start + timedelta(days=6)
+    month = day.strftime('%Y-%m')
+    month_start = day.replace(day=1)
+    month_end = (month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+    # 收入（依繳費日）
+    def paid_on(date):
+        start = datetime.strptime(date, '%Y-%m-%d')
+        return db.session.query(db.func.sum(Payment.amount)).filter(
+            Payment.status == 'paid',
+            Payment.payment_date >= start,
+            Payment.payment_date < start + timedelta(days=1),
+        ).scalar() or 0
+
+    today_income = paid_on(today)
+    yesterday_income = paid_on(yesterday)
+
+    # 學生
+    def enrolled_since(start):
+        return db.func.sum(db.case(
+            (db.and_(Student.enrollment_date >= start, Student.enrollment_date < day + timedelta(days=1)), 1),
+            else_=0,
+        ))
+
+    active_students, new_today, new_week, new_month = db.session.query(
+        db.func.sum(db.case((Student.is_active.is_(True), 1), else_=0)),
+        enrolled_since(day),
+        enrolled_since(week_start),
+        enrolled_since(month_start),
+    ).one()
+
+    # 課程
+    today_classes = _confirmed_bookings_between(today, today).count()
+    week_classes = _confirmed_bookings_between(
+        week_start.strftime('%Y-%m-%d'), week_end.strftime('%Y-%m-%d')
+    ).count()
+    by_teacher = db.session.query(
+        Teacher.name, Teacher.instrument, db.func.count(Booking.id), db.func.sum(Booking.total_price)
+    ).select_from(Booking).join(TimeSlot, Booking.slot_id == TimeSlot.id) \
+     .join(Teacher, Booking.teacher_id == Teacher.id).filter(
+        Booking.status == 'confirmed',
+        TimeSlot.date >= month_start.strftime('%Y-%m-%d'),
+        TimeSlot.date <= month_end.strftime('%Y-%m-%d'),
+    ).group_by(Teacher.id, Teacher.name, Teacher.instrument) \
+     .order_by(db.func.count(Booking.id).desc()).all()
+    by_instrument = {}
+    for _, instrument, count, _ in by_teacher:
+        by_instrument[instrument] = by_instrument.get(instrument, 0) + count
+
+    # 財務（讀月結彙總）
+    trend_months = []
+    cursor = month_start
+    for _ in range(REPORT_TREND_MONTHS):
+        trend_months.insert(0, cursor.strftime('%Y-%m'))
+        cursor = (cursor - timedelta(days=1)).replace(day=1)
+    income = dict(db.session.query(IncomeMonthly.month, db.func.sum(IncomeMonthly.amount)).filter(
+        IncomeMonthly.status == 'paid', IncomeMonthly.month.in_(trend_months)
+    ).group_by(IncomeMonthly.month).all())
+    expense = dict(db.session.query(ExpenseMonthly.month, db.func.sum(ExpenseMonthly.amount)).filter(
+        ExpenseMonthly.month.in_(trend_months)
+    ).group_by(ExpenseMonthly.month).all())
+    expense_mix = db.session.query(ExpenseMonthly.category, db.func.sum(ExpenseMonthly.amount)).filter(
+        ExpenseMonthly.month == month
+    ).group_by(ExpenseMonthly.category).order_by(db.func.sum(ExpenseMonthly.amount).desc()).all()
+    year_income = _income_total(IncomeMonthly.month.like(f'{day.year}-%'))
+
+    month_income = income.get(month, 0)
+    month_expense = expense.get(month, 0)
+
+    return {
+        'date': today,
+        'month': month,
+        'income': {
+            'today': today_income,
+            'yesterday': yesterday_income,
+            'change': round((today_income - yesterday_income) / yesterday_income * 100, 1)
+                      if yesterday_income else None,
+            'month': month_income,
+            'month_expense': month_expense,
+            'month_net': month_income - month_expense,
+            'year': year_income,
+        },
+        'students': {
+            'active': active_students or 0,
+            'new_today': new_today or 0,
+            'new_week': new_week or 0,
+            'new_month': new_month or 0,
+        },
+        'classes': {
+            'today': today_classes,
+            'week': week_classes,
+            'by_teacher': [
+                {'teacher': name, 'instrument': instrument, 'count': count, 'revenue': revenue or 0}
+                for name, instrument, count, revenue in by_teacher
+            ],
+            'by_instrument': [
+                {'instrument': instrument, 'count': count}
+                for instrument, count in sorted(by_instrument.items(), key=lambda x: -x[1])
+            ],
+        },
+        'attendance': {
+            'today': _attendance_rate(today, today),
+            'month': _attendance_rate(month_start.strftime('%Y-%m-%d'), month_end.strftime('%Y-%m-%d')),
+        },
+        'revenue_trend': [
+            {
+                'month': m,
+                'income': income.get(m, 0),
+                'expense': expense.get(m, 0),
+                'net_income': income.get(m, 0) - expense.get(m, 0),
+            }
+            for m in trend_months
+        ],
+        'expense_mix': [{'category': category, 'amount': amount} for category, amount in expense_mix],
+    }
+
+
+@app.route('/admin/api/reports/ceo', methods=['GET'])
+def admin_get_ceo_report():
+    """CEO 每日報的全部指標（date 指定報表日，預設今天），依日期快取"""
     check_admin()
-    date = request.args.get('date')
-    student_id = request.args.get('student_id', type=int)
-    
-    query = Attendance.query
-    if date:
-        query = query.filter_by(date=date)
-    if student_id:
-        query = query.filter_by(student_id=student_id)
-    
-    records = query.order_by(Attendance.created_at.desc()).all()
-    return jsonify([r.to_dict() for r in records])
+    day = _parse_date_arg('date') or datetime.now()
+    day = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    return jsonify(_cached_report(('ceo', day.date()), lambda: _build_ceo_report(day)))
+
+
+# ─────────────────────────────────────────────
+# 出席打卡 API
+# ─────────────────────────────────────────────
+
+ATTENDANCE_STATUSES = ('present', 'late', 'absent', 'leave')
+# 單筆打卡寫入緩衝的提交間隔（毫秒）；0 表示不緩衝，每筆直接寫入
+ATTENDANCE_FLUSH_MS = int(os.environ.get('ATTENDANCE_FLUSH_MS', 200))
+
+
+class AttendanceBuffer:
+    """
+    單筆打卡的寫入緩衝（write-behind）。
+    請求只把資料放進記憶體即回應，背景執行緒每 flush_interval 秒（或累積 max_batch 筆時）
+    以一次 executemany、一次提交寫入，上課前的打卡尖峰共用同一次 fsync。
+    資料庫暫時無法寫入時整批放回緩衝下次重試；整批因個別資料違反約束（例如學生已刪除）失敗時改為逐筆寫入，
+    仍失敗的資料記錄後捨棄，不會擋住之後的打卡。行程正常結束時（atexit）寫出剩餘資料，
+    異常終止則會遺失最後至多 flush_interval 秒的打卡。
+    """
+
+    def __init__(self, flush_interval, max_batch=500):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._rows = []
+        self._full = threading.Event()
+        self._pid = None
+
+    def add(self, values):
+        if not self.flush_interval:
+            self._write([values])
+            return
+        with self._lock:
+            # gunicorn fork 後父行程的執行緒不存在，於子行程第一次使用時啟動
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._rows = []
+                threading.Thread(target=self._run, name='attendance-buffer', daemon=True).start()
+            self._rows.append(values)
+            if len(self._rows) >= self.max_batch:
+                self._full.set()
+
+    def flush(self):
+        """寫出目前緩衝的全部資料，回傳筆數"""
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return 0
+        try:
+            self._write(rows)
+        except (IntegrityError, DataError):
+            return self._write_each(rows)
+        except Exception:
+            with self._lock:
+                self._rows[:0] = rows
+            raise
+        return len(rows)
+
+    def _write_each(self, rows):
+        """逐筆寫入，捨棄違反約束的資料，回傳寫入筆數"""
+        written = 0
+        for index, row in enumerate(rows):
+            try:
+                self._write([row])
+            except (IntegrityError, DataError) as e:
+                print(f'attendance-buffer dropped {row}: {e.orig}')
+            except Exception:
+                with self._lock:
+                    self._rows[:0] = rows[index:]
+                raise
+            else:
+                written += 1
+        return written
+
+    def _write(self, rows):
+        with app.app_context(), db.engine.begin() as conn:
+            conn.execute(db.insert(Attendance), rows)
+
+    def _run(self):
+        while True:
+            self._full.wait(self.flush_interval)
+            self._full.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'attendance-buffer error: {e}')
+
+
+attendance_buffer = AttendanceBuffer(ATTENDANCE_FLUSH_MS / 1000)
+atexit.register(attendance_buffer.flush)
+
+
+def _check_time_fields(value):
+    """把 ISO 時間字串（未提供時為現在）拆成 (YYYY-MM-DD, HH:MM)"""
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00')) if value else datetime.now()
+    return moment.strftime('%Y-%m-%d'), moment.strftime('%H:%M')
+
+
+def _late_minutes_field(data):
+    """請求中的 late_minutes（未提供為 0），不是非負整數時以 400 中止"""
+    value = data.get('late_minutes') or 0
+    try:
+        minutes = int(value)
+    except (TypeError, ValueError):
+        minutes = -1
+    if isinstance(value, (bool, float)) or minutes < 0:
+        abort_json(400, '遲到分鐘須為非負整數')
+    return minutes
+
+
+def _minutes_late(check_time, start_time):
+    """HH:MM 打卡時間比上課時間晚幾分鐘（不晚回傳 0）"""
+    delta = datetime.strptime(check_time, '%H:%M') - datetime.strptime(start_time, '%H:%M')
+    return max(0, int(delta.total_seconds() // 60))
+
+
+@app.route('/admin/api/attendance', methods=['GET'])
+def admin_get_attendance():
+    check_admin()
+    date = request.args.get('date')
+    student_id = request.args.get('student_id', type=int)
+    
+    status = request.args.get('status')
+    q = request.args.get('q', '').strip()
+    
+    query = Attendance.query
+    if date:
+        query = query.filter_by(date=date)
+    if student_id:
+        query = query.filter_by(student_id=student_id)
+    if status:
+        query = query.filter_by(status=status)
+    if q:
+        query = query.filter(Attendance.student.has(Student.name.like(f'%{q}%')))
+    query = _filter_date_range(query, Attendance.date)
+    
+    return _list_response(query, [Attendance.created_at, Attendance.id])
 
 
 @app.route('/admin/api/attendance', methods=['POST'])
@@ -887,22 +2285,14 @@ def admin_add_attendance():
     check_admin()
     data = request.get_json()
     
-    check_time_str = data.get('check_time', '')
-    if check_time_str:
-        check_datetime = datetime.fromisoformat(check_time_str.replace('Z', '+00:00'))
-        date = check_datetime.strftime('%Y-%m-%d')
-        time = check_datetime.strftime('%H:%M')
-    else:
-        now = datetime.now()
-        date = now.strftime('%Y-%m-%d')
-        time = now.strftime('%H:%M')
-    
+    date, time = _check_time_fields(data.get('check_time', ''))
+
     attendance = Attendance(
         student_id=data['student_id'],
         date=date,
         check_time=time,
         status=data.get('status', 'present'),
-        late_minutes=data.get('late_minutes', 0),
+        late_minutes=_late_minutes_field(data),
         course=data.get('course', ''),
         note=data.get('note', ''),
     )
@@ -911,6 +2301,131 @@ def admin_add_attendance():
     return jsonify(attendance.to_dict()), 201
 
 
+@app.route('/admin/api/attendance/check-in', methods=['POST'])
+def admin_check_in():
+    """
+    單筆打卡（櫃台／報到機用）：驗證後放入寫入緩衝，立即回應 202，
+    紀錄約在 ATTENDANCE_FLUSH_MS 毫秒內寫入資料庫（回應不含 id）。
+    """
+    check_admin()
+    data = request.get_json() or {}
+    student_id = data.get('student_id')
+    student = db.session.get(Student, student_id) if isinstance(student_id, int) else None
+    if not student:
+        return jsonify({'error': '找不到學生'}), 404
+    status = data.get('status', 'present')
+    if status not in ATTENDANCE_STATUSES:
+        return jsonify({'error': '狀態須為 present / late / absent / leave'}), 400
+    try:
+        date, time = _check_time_fields(data.get('check_time', ''))
+    except ValueError:
+        return jsonify({'error': '時間格式錯誤'}), 400
+
+    values = {
+        'student_id': student.id,
+        'date': date,
+        'check_time': time,
+        'status': status,
+        'late_minutes': _late_minutes_field(data),
+        'course': data.get('course', ''),
+        'note': data.get('note', ''),
+        'created_at': datetime.now(),
+    }
+    attendance_buffer.add(values)
+    return jsonify({'success': True, 'record': {**values, 'student_name': student.name}}), 202
+
+
+@app.route('/admin/api/attendance/roll-call', methods=['POST'])
+def admin_roll_call():
+    """
+    整班點名，全班在同一個交易內寫入。
+    body: {shift_id | slot_id | date + start_time, course, entries: [{student_id, status, check_time, note}]}
+    上課時間取自排班（shift_id）或可預約時段（slot_id），也可直接指定。
+    出席/遲到的遲到分鐘數由 check_time（未提供為現在）與上課時間計算；
+    未指定 status 時依是否晚到判定 present / late。
+    同一學生同日同課程已有紀錄時改為更新，重送不會產生重複資料。
+    """
+    check_admin()
+    data = request.get_json() or {}
+    date, start_time, course = data.get('date'), data.get('start_time'), data.get('course')
+    if data.get('shift_id'):
+        shift = db.session.get(Shift, data['shift_id'])
+        if not shift:
+            return jsonify({'error': '找不到排班'}), 404
+        date, start_time, course = shift.date, shift.start_time, course or shift.course
+    elif data.get('slot_id'):
+        slot = db.session.get(TimeSlot, data['slot_id'])
+        if not slot:
+            return jsonify({'error': '找不到時段'}), 404
+        date, start_time, course = slot.date, slot.time, course or slot.teacher.instrument
+    now = datetime.now()
+    date = date or now.strftime('%Y-%m-%d')
+    course = course or ''
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+        if start_time:
+            datetime.strptime(start_time, '%H:%M')
+    except ValueError:
+        return jsonify({'error': '日期或上課時間格式錯誤'}), 400
+
+    entries = data.get('entries')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': '請提供點名名單 entries'}), 400
+    rows, errors = {}, []
+    for index, entry in enumerate(entries, 1):
+        student_id = entry.get('student_id') if isinstance(entry, dict) else None
+        status = entry.get('status') if isinstance(entry, dict) else None
+        if not isinstance(student_id, int):
+            errors.append({'row': index, 'error': '缺少 student_id'})
+            continue
+        if status is not None and status not in ATTENDANCE_STATUSES:
+            errors.append({'row': index, 'error': '狀態須為 present / late / absent / leave'})
+            continue
+        check_time = entry.get('check_time') or (start_time if status in ('absent', 'leave') else None)
+        check_time = check_time or now.strftime('%H:%M')
+        try:
+            late = _minutes_late(check_time, start_time) if start_time else 0
+        except ValueError:
+            errors.append({'row': index, 'error': 'check_time 格式須為 HH:MM'})
+            continue
+        status = status or ('late' if late else 'present')
+        rows[student_id] = {
+            'student_id': student_id,
+            'date': date,
+            'check_time': check_time,
+            'status': status,
+            'late_minutes': late if status == 'late' else 0,
+            'course': course,
+            'note': entry.get('note', ''),
+        }
+    known = {row[0] for row in db.session.execute(db.select(Student.id).where(Student.id.in_(rows)))}
+    errors += [{'student_id': sid, 'error': '找不到學生'} for sid in rows if sid not in known]
+    if errors:
+        return jsonify({'error': '點名資料有誤', 'errors': errors}), 400
+
+    existing = dict(db.session.execute(
+        db.select(Attendance.student_id, Attendance.id).where(
+            Attendance.date == date, Attendance.course == course, Attendance.student_id.in_(rows),
+        )
+    ).all())
+    updates = [{'id': existing[sid], **values} for sid, values in rows.items() if sid in existing]
+    inserts = [values for sid, values in rows.items() if sid not in existing]
+    if updates:
+        db.session.execute(db.update(Attendance), updates)
+    if inserts:
+        db.session.execute(db.insert(Attendance), inserts)
+    db.session.commit()
+    return jsonify({
+        'success': True,
+        'date': date,
+        'start_time': start_time,
+        'course': course,
+        'created': len(inserts),
+        'updated': len(updates),
+        'summary': collections.Counter(values['status'] for values in rows.values()),
+    })
+
+
 @app.route('/admin/api/attendance/<int:aid>', methods=['DELETE'])
 def admin_delete_attendance(aid):
     check_admin()
@@ -922,34 +2437,53 @@ def admin_delete_attendance(aid):
 
 @app.route('/admin/api/attendance/stats', methods=['GET'])
 def admin_get_attendance_stats():
+    """
+    每位在學學生的出席統計，支援 date_from / date_to / course 篩選。
+    以單一 GROUP BY student_id, status 查詢彙總（走 ix_attendance_student_status 覆蓋索引），
+    沒有紀錄的學生也會列出（全部為 0）。
+    """
     check_admin()
-    
-    # 統計每個學生的出席情況
-    students = Student.query.filter_by(is_active=True).all()
-    stats = []
-    
-    for student in students:
-        records = Attendance.query.filter_by(student_id=student.id).all()
-        total = len(records)
-        present = len([r for r in records if r.status == 'present'])
-        late = len([r for r in records if r.status == 'late'])
-        absent = len([r for r in records if r.status == 'absent'])
-        leave = len([r for r in records if r.status == 'leave'])
-        
-        rate = round((present + late) / total * 100, 1) if total > 0 else 0
-        
-        stats.append({
-            'student_id': student.id,
-            'student_name': student.name,
-            'total': total,
-            'present': present,
-            'late': late,
-            'absent': absent,
-            'leave': leave,
-            'attendance_rate': rate
+    course = request.args.get('course')
+    date_from = _parse_date_arg('date_from')
+    date_to = _parse_date_arg('date_to')
+
+    # 篩選條件放在 JOIN 條件上，才不會把沒有紀錄的學生濾掉
+    join_on = [Attendance.student_id == Student.id]
+    if course:
+        join_on.append(Attendance.course == course)
+    if date_from:
+        join_on.append(Attendance.date >= date_from.strftime('%Y-%m-%d'))
+    if date_to:
+        join_on.append(Attendance.date <= date_to.strftime('%Y-%m-%d'))
+
+    rows = db.session.query(Student.id, Student.name, Attendance.status, db.func.count(Attendance.id)) \
+        .outerjoin(Attendance, db.and_(*join_on)) \
+        .filter(Student.is_active.is_(True)) \
+        .group_by(Student.id, Student.name, Attendance.status) \
+        .order_by(Student.id).all()
+
+    stats = {}
+    for student_id, name, status, count in rows:
+        entry = stats.setdefault(student_id, {
+            'student_id': student_id,
+            'student_name': name,
+            'total': 0,
+            'present': 0,
+            'late': 0,
+            'absent': 0,
+            'leave': 0,
         })
-    
-    return jsonify(stats)
+        if status is None:
+            continue
+        entry['total'] += count
+        if status in entry:
+            entry[status] += count
+
+    for entry in stats.values():
+        total = entry['total']
+        entry['attendance_rate'] = round((entry['present'] + entry['late']) / total * 100, 1) if total > 0 else 0
+
+    return jsonify(list(stats.values()))
 
 
 # ─────────────────────────────────────────────
@@ -991,35 +2525,114 @@ def admin_delete_exam(eid):
 @app.route('/admin/api/grades', methods=['GET'])
 def admin_get_grades():
     check_admin()
+    return _list_response(_filter_grades(Grade.query), [Grade.created_at, Grade.id])
+
+
+def _filter_grades(query):
+    """套用成績列表共用的 exam_id / student_id / q（學生姓名）篩選"""
     exam_id = request.args.get('exam_id', type=int)
     student_id = request.args.get('student_id', type=int)
-    
-    query = Grade.query
+    q = request.args.get('q', '').strip()
+
     if exam_id:
-        query = query.filter_by(exam_id=exam_id)
+        query = query.filter(Grade.exam_id == exam_id)
     if student_id:
-        query = query.filter_by(student_id=student_id)
-    
-    grades = query.order_by(Grade.created_at.desc()).all()
-    return jsonify([g.to_dict() for g in grades])
+        query = query.filter(Grade.student_id == student_id)
+    if q:
+        query = query.filter(Grade.student.has(Student.name.like(f'%{q}%')))
+    return query
+
+
+@app.route('/admin/api/grades/summary', methods=['GET'])
+def admin_get_grades_summary():
+    """
+    符合篩選條件（同成績列表）的成績摘要：筆數、平均、最高、最低、及格率。
+    及格以各考試的 pass_score 判斷，單一彙總查詢。
+    """
+    check_admin()
+    query = db.session.query(
+        db.func.count(Grade.id),
+        db.func.avg(Grade.score),
+        db.func.max(Grade.score),
+        db.func.min(Grade.score),
+        db.func.sum(db.case((Grade.score >= Exam.pass_score, 1), else_=0)),
+    ).join(Exam, Grade.exam_id == Exam.id)
+    count, avg, high, low, passed = _filter_grades(query).one()
+
+    return jsonify({
+        'count': count,
+        'avg_score': round(avg) if count else 0,
+        'max_score': high or 0,
+        'min_score': low or 0,
+        'pass_rate': round((passed or 0) / count * 100) if count else 0,
+    })
+
+
+@app.route('/admin/api/grades/stats', methods=['GET'])
+def admin_get_grades_stats():
+    """
+    每位有成績的在學學生的成績分析：次數、平均、最高、最低、進步幅度（最近一次減第一次，依考試日期）。
+    以視窗函式標出每位學生的第一次與最近一次成績，再 GROUP BY student_id，單一查詢。
+    """
+    check_admin()
+    ranked = db.session.query(
+        Grade.student_id.label('student_id'),
+        Grade.score.label('score'),
+        db.func.row_number().over(
+            partition_by=Grade.student_id, order_by=(Exam.date, Grade.id)
+        ).label('first_rn'),
+        db.func.row_number().over(
+            partition_by=Grade.student_id, order_by=(Exam.date.desc(), Grade.id.desc())
+        ).label('last_rn'),
+    ).join(Exam, Grade.exam_id == Exam.id).subquery()
+
+    rows = db.session.query(
+        Student.id,
+        Student.name,
+        db.func.count(ranked.c.score),
+        db.func.avg(ranked.c.score),
+        db.func.max(ranked.c.score),
+        db.func.min(ranked.c.score),
+        db.func.sum(db.case((ranked.c.first_rn == 1, ranked.c.score), else_=0)),
+        db.func.sum(db.case((ranked.c.last_rn == 1, ranked.c.score), else_=0)),
+    ).join(ranked, ranked.c.student_id == Student.id) \
+        .filter(Student.is_active.is_(True)) \
+        .group_by(Student.id, Student.name) \
+        .order_by(Student.id).all()
+
+    return jsonify([{
+        'student_id': student_id,
+        'student_name': name,
+        'count': count,
+        'avg_score': round(avg),
+        'max_score': high,
+        'min_score': low,
+        'improvement': last - first if count >= 2 else 0,
+    } for student_id, name, count, avg, high, low, first, last in rows])
 
 
 @app.route('/admin/api/grades', methods=['POST'])
 def admin_add_grade():
     check_admin()
     data = request.get_json()
+    try:
+        score = _integral_score(data['score'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': '分數須為整數'}), 400
     
     grade = Grade(
         exam_id=data['exam_id'],
         student_id=data['student_id'],
-        score=data['score'],
+        score=score,
         note=data.get('note', ''),
     )
     db.session.add(grade)
-    db.session.commit()
+    db.session.flush()
     
-    # 計算排名
+    # 計算排名，與新增的成績一併提交
     _calculate_ranks(data['exam_id'])
+    _refresh_next_trends(data['exam_id'], [data['student_id']])
+    db.session.commit()
     
     return jsonify(grade.to_dict()), 201
 
@@ -1029,36 +2642,199 @@ def admin_delete_grade(gid):
     check_admin()
     grade = Grade.query.get_or_404(gid)
     exam_id = grade.exam_id
+    student_id = grade.student_id
     db.session.delete(grade)
-    db.session.commit()
+    db.session.flush()
     
-    # 重新計算排名
+    # 重新計算排名，與刪除一併提交
     _calculate_ranks(exam_id)
+    _refresh_next_trends(exam_id, [student_id])
+    db.session.commit()
     
     return jsonify({'success': True})
 
 
-def _calculate_ranks(exam_id):
-    """計算某次考試的排名"""
-    grades = Grade.query.filter_by(exam_id=exam_id).order_by(Grade.score.desc()).all()
-    
-    for idx, grade in enumerate(grades, 1):
-        grade.rank = idx
-        
-        # 計算進退步趨勢
-        student_grades = Grade.query.filter_by(student_id=grade.student_id).order_by(Grade.created_at).all()
-        if len(student_grades) >= 2:
-            prev_score = student_grades[-2].score
-            curr_score = grade.score
-            if curr_score > prev_score + 5:
-                grade.trend = 'up'
-            elif curr_score < prev_score - 5:
-                grade.trend = 'down'
-            else:
-                grade.trend = 'stable'
-    
+@app.route('/admin/api/exams/<int:eid>/grades:bulk', methods=['POST'])
+def admin_bulk_grades(eid):
+    """
+    整批登記一次考試的成績單。
+    請求：{"grades": [{"student_id": 1, "score": 92, "note": ""}, ...]}
+    同一學生已有成績則更新，否則新增；全部在同一交易內以 executemany 寫入，
+    最後只計算一次排名與趨勢，回傳依名次排序的成績單。
+    任何一列有誤則整批不寫入，回傳 400 與各列錯誤。
+    """
+    check_admin()
+    exam = Exam.query.get_or_404(eid)
+    data = request.get_json()
+    rows = data.get('grades') if isinstance(data, dict) else data
+    if not isinstance(rows, list) or not rows:
+        return jsonify({'error': '缺少成績資料'}), 400
+
+    errors = []
+    sheet = {}
+    for idx, row in enumerate(rows):
+        try:
+            student_id = int(row['student_id'])
+            score = _integral_score(row['score'])
+        except (KeyError, TypeError, ValueError):
+            errors.append({'row': idx, 'error': '缺少或無效的 student_id / score（分數須為整數）'})
+            continue
+        if not 0 <= score <= (exam.max_score or 100):
+            errors.append({'row': idx, 'error': f'分數需介於 0 與 {exam.max_score or 100} 之間'})
+        elif student_id in sheet:
+            errors.append({'row': idx, 'error': f'學生重複：{student_id}'})
+        else:
+            sheet[student_id] = {'row': idx, 'score': score, 'note': row.get('note', '')}
+
+    known = set(db.session.execute(
+        db.select(Student.id).where(Student.id.in_(sheet))
+    ).scalars())
+    errors.extend(
+        {'row': g['row'], 'error': f'找不到學生：{sid}'}
+        for sid, g in sheet.items() if sid not in known
+    )
+    if errors:
+        return jsonify({'error': '成績資料有誤，未寫入任何資料', 'errors': errors}), 400
+
+    existing = dict(db.session.execute(
+        db.select(Grade.student_id, Grade.id).where(Grade.exam_id == eid, Grade.student_id.in_(sheet))
+    ).all())
+    updates = [
+        {'id': existing[sid], 'score': g['score'], 'note': g['note']}
+        for sid, g in sheet.items() if sid in existing
+    ]
+    inserts = [
+        {'exam_id': eid, 'student_id': sid, 'score': g['score'], 'note': g['note']}
+        for sid, g in sheet.items() if sid not in existing
+    ]
+    if updates:
+        db.session.execute(db.update(Grade), updates)
+    if inserts:
+        db.session.execute(db.insert(Grade), inserts)
+
+    _calculate_ranks(eid)
+    _refresh_next_trends(eid, list(sheet))
     db.session.commit()
 
+    ranked = eager_for_serialize(Grade.query.filter_by(exam_id=eid)).order_by(Grade.rank, Grade.id).all()
+    return jsonify({
+        'exam': exam.to_dict(),
+        'inserted': len(inserts),
+        'updated': len(updates),
+        'grades': [g.to_dict() for g in ranked],
+    })
+
+
+def _integral_score(value):
+    """成績分數轉為整數：92、92.0、"92" 皆可；92.5、"92.5" 與布林值一律拋出 ValueError"""
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, str):
+        value = float(value)
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(value)
+    return int(value)
+
+
+def _calculate_ranks(exam_id):
+    """
+    在目前交易內計算某次考試的排名與進退步趨勢（由呼叫端提交）。
+    排名以單一 window function UPDATE 完成，且只寫入名次有變動的列；
+    趨勢以一次「每位學生前一次考試成績」查詢計算。查詢次數與人數無關。
+    """
+    ranked = (
+        db.select(
+            Grade.id,
+            db.func.row_number().over(order_by=(Grade.score.desc(), Grade.id)).label('new_rank'),
+        )
+        .where(Grade.exam_id == exam_id)
+        .subquery()
+    )
+    db.session.execute(
+        db.update(Grade)
+        .where(Grade.id == ranked.c.id, Grade.rank.is_distinct_from(ranked.c.new_rank))
+        .values(rank=ranked.c.new_rank)
+        .execution_options(synchronize_session=False)
+    )
+    _refresh_trends(exam_id)
+
+
+def _trend(score, prev_score):
+    """與前一次考試相比：進步/退步超過 5 分為 up/down，否則 stable；無前次成績為 None"""
+    if prev_score is None:
+        return None
+    if score > prev_score + 5:
+        return 'up'
+    if score < prev_score - 5:
+        return 'down'
+    return 'stable'
+
+
+def _refresh_trends(exam_id, student_ids=None):
+    """
+    重算某次考試（可限定部分學生）的趨勢，只更新有變動的列。
+    「前一次考試」為該學生考試日期早於本次的最近一筆成績。
+    """
+    exam_date = db.select(Exam.date).where(Exam.id == exam_id).scalar_subquery()
+    students = db.select(Grade.student_id).where(Grade.exam_id == exam_id)
+    if student_ids is not None:
+        students = students.where(Grade.student_id.in_(student_ids))
+    previous = (
+        db.select(
+            Grade.student_id,
+            Grade.score,
+            db.func.row_number().over(
+                partition_by=Grade.student_id,
+                order_by=(Exam.date.desc(), Grade.created_at.desc(), Grade.id.desc()),
+            ).label('rn'),
+        )
+        .join(Exam, Exam.id == Grade.exam_id)
+        .where(Exam.date < exam_date, Grade.student_id.in_(students))
+        .subquery()
+    )
+    current = (
+        db.select(Grade.id, Grade.score, Grade.trend, previous.c.score)
+        .outerjoin(previous, db.and_(previous.c.student_id == Grade.student_id, previous.c.rn == 1))
+        .where(Grade.exam_id == exam_id)
+    )
+    if student_ids is not None:
+        current = current.where(Grade.student_id.in_(student_ids))
+
+    changes = []
+    for grade_id, score, trend, prev_score in db.session.execute(current):
+        new_trend = _trend(score, prev_score)
+        if new_trend != trend:
+            changes.append({'id': grade_id, 'trend': new_trend})
+    if changes:
+        db.session.execute(db.update(Grade), changes)
+
+
+def _refresh_next_trends(exam_id, student_ids):
+    """學生在 exam_id 的成績新增/修改/刪除後，在目前交易內重算其下一次考試的趨勢（前次成績已改變，由呼叫端提交）"""
+    following = (
+        db.select(
+            Grade.student_id,
+            Grade.exam_id,
+            db.func.row_number().over(
+                partition_by=Grade.student_id,
+                order_by=(Exam.date, Grade.created_at, Grade.id),
+            ).label('rn'),
+        )
+        .join(Exam, Exam.id == Grade.exam_id)
+        .where(
+            Grade.student_id.in_(student_ids),
+            Exam.date > db.select(Exam.date).where(Exam.id == exam_id).scalar_subquery(),
+        )
+        .subquery()
+    )
+    by_exam = {}
+    for student_id, next_exam_id in db.session.execute(
+        db.select(following.c.student_id, following.c.exam_id).where(following.c.rn == 1)
+    ):
+        by_exam.setdefault(next_exam_id, []).append(student_id)
+    for next_exam_id, ids in by_exam.items():
+        _refresh_trends(next_exam_id, ids)
+
 
 # ─────────────────────────────────────────────
 # 排班管理 API
@@ -1067,8 +2843,43 @@ def _calculate_ranks(exam_id):
 @app.route('/admin/api/shifts', methods=['GET'])
 def admin_get_shifts():
     check_admin()
-    shifts = Shift.query.order_by(Shift.date, Shift.start_time).all()
-    return jsonify([s.to_dict() for s in shifts])
+    teacher_id = request.args.get('teacher_id', type=int)
+
+    query = Shift.query
+    if teacher_id:
+        query = query.filter_by(teacher_id=teacher_id)
+    query = _filter_date_range(query, Shift.date)
+    return _list_response(query, [Shift.date, Shift.start_time, Shift.id], descending=False)
+
+
+@app.route('/admin/api/shifts/hours', methods=['GET'])
+def admin_get_shift_hours():
+    """
+    每位教師的排班數、已完成代課數與已核准請假數，供工時與薪資計算。
+    month（YYYY-MM）篩選排班日期、代課日期與請假開始日期，省略時統計全部。
+    每張表各一次 GROUP BY 查詢，再加上教師列表。
+    """
+    check_admin()
+    month = _parse_month_arg('month')
+
+    def counts(column, group_column, *conditions):
+        query = db.session.query(group_column, db.func.count()).filter(*conditions)
+        if month:
+            query = query.filter(column >= f'{month}-01', column <= f'{month}-31')
+        return dict(query.group_by(group_column).all())
+
+    shifts = counts(Shift.date, Shift.teacher_id)
+    substitutes = counts(Substitute.date, Substitute.substitute_teacher_id, Substitute.status == 'completed')
+    leaves = counts(Leave.start_date, Leave.teacher_id, Leave.status == 'approved')
+
+    return jsonify([{
+        'teacher_id': t.id,
+        'teacher_name': t.name,
+        'hourly_rate': t.hourly_rate,
+        'shifts': shifts.get(t.id, 0),
+        'completed_substitutes': substitutes.get(t.id, 0),
+        'approved_leaves': leaves.get(t.id, 0),
+    } for t in Teacher.query.order_by(Teacher.id)])
 
 
 @app.route('/admin/api/shifts', methods=['POST'])
@@ -1100,8 +2911,19 @@ def admin_delete_shift(sid):
 @app.route('/admin/api/substitutes', methods=['GET'])
 def admin_get_substitutes():
     check_admin()
-    substitutes = Substitute.query.order_by(Substitute.created_at.desc()).all()
-    return jsonify([s.to_dict() for s in substitutes])
+    status = request.args.get('status')
+    teacher_id = request.args.get('teacher_id', type=int)
+
+    query = Substitute.query
+    if status:
+        query = query.filter_by(status=status)
+    if teacher_id:
+        query = query.filter(db.or_(
+            Substitute.original_teacher_id == teacher_id,
+            Substitute.substitute_teacher_id == teacher_id,
+        ))
+    query = _filter_date_range(query, Substitute.date)
+    return _list_response(query, [Substitute.created_at, Substitute.id])
 
 
 @app.route('/admin/api/substitutes', methods=['POST'])
@@ -1143,8 +2965,16 @@ def admin_reject_substitute(sid):
 @app.route('/admin/api/leaves', methods=['GET'])
 def admin_get_leaves():
     check_admin()
-    leaves = Leave.query.order_by(Leave.created_at.desc()).all()
-    return jsonify([l.to_dict() for l in leaves])
+    status = request.args.get('status')
+    teacher_id = request.args.get('teacher_id', type=int)
+
+    query = Leave.query
+    if status:
+        query = query.filter_by(status=status)
+    if teacher_id:
+        query = query.filter_by(teacher_id=teacher_id)
+    query = _filter_date_range(query, Leave.start_date)
+    return _list_response(query, [Leave.created_at, Leave.id])
 
 
 @app.route('/admin/api/leaves', methods=['POST'])
@@ -1184,6 +3014,1025 @@ def admin_reject_leave(lid):
     return jsonify({'success': True})
 
 
+# ─────────────────────────────────────────────
+# 資料匯出 API（CSV / XLSX 串流）
+# ─────────────────────────────────────────────
+# 匯出以 yield_per 分批讀取欄位值（不建立 ORM 物件），邊讀邊寫出回應，
+# 記憶體用量與筆數無關。XLSX 以 zipfile 串流寫出最小的 Office Open XML 檔案，不需額外套件。
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def _date_part(value):
+    """DateTime 欄位只匯出日期"""
+    return value.date().isoformat() if value else None
+
+
+def _minutes(value):
+    return value.isoformat(' ', 'minutes') if value else None
+
+
+def _course_names(courses_json):
+    """預約的課程 JSON 轉成以頓號分隔的名稱"""
+    return '、'.join(c.get('name', '') for c in app.json.loads(courses_json or '[]'))
+
+
+# 每種匯出：columns 為 (標題, 欄位[, 轉換函式])；date 套用 date_from / date_to；
+# month 為套用 month=YYYY-MM 的 DateTime 欄位（選填）；filters 為可用的等值篩選參數；
+# joins 為 LEFT JOIN 的 (資料表, 條件)
+EXPORTS = {
+    'payments': {
+        'columns': [
+            ('編號', Payment.id), ('學號', Student.student_id), ('學生', Student.name),
+            ('月份', Payment.month), ('金額', Payment.amount), ('繳費日期', Payment.payment_date, _date_part),
+            ('付款方式', Payment.payment_method), ('狀態', Payment.status), ('備註', Payment.note),
+            ('建立時間', Payment.created_at),
+        ],
+        'joins': [(Student, Payment.student_id == Student.id)],
+        'date': Payment.payment_date,
+        'filters': {'status': Payment.status, 'month': Payment.month, 'payment_method': Payment.payment_method},
+        'order': Payment.id,
+    },
+    'expenses': {
+        'columns': [
+            ('編號', Expense.id), ('日期', Expense.expense_date, _date_part), ('類別', Expense.category),
+            ('金額', Expense.amount), ('說明', Expense.description), ('備註', Expense.note),
+            ('建立時間', Expense.created_at),
+        ],
+        'joins': [],
+        'date': Expense.expense_date,
+        'month': Expense.expense_date,
+        'filters': {'category': Expense.category},
+        'order': Expense.id,
+    },
+    'attendance': {
+        'columns': [
+            ('編號', Attendance.id), ('日期', Attendance.date), ('時間', Attendance.check_time),
+            ('學號', Student.student_id), ('學生', Student.name), ('課程', Attendance.course),
+            ('狀態', Attendance.status), ('遲到分鐘', Attendance.late_minutes), ('備註', Attendance.note),
+        ],
+        'joins': [(Student, Attendance.student_id == Student.id)],
+        'date': Attendance.date,
+        'filters': {'status': Attendance.status, 'course': Attendance.course, 'student_id': Attendance.student_id},
+        'order': Attendance.id,
+    },
+    'bookings': {
+        'columns': [
+            ('預約編號', Booking.booking_code), ('上課日期', TimeSlot.date), ('時間', TimeSlot.time),
+            ('老師', Teacher.name), ('樂器', Teacher.instrument), ('學生', Booking.student_name),
+            ('聯絡方式', Booking.student_contact), ('年齡', Booking.student_age), ('程度', Booking.student_level),
+            ('課程', Booking.courses_json, _course_names), ('金額', Booking.total_price),
+            ('狀態', Booking.status), ('備註', Booking.student_note), ('建立時間', Booking.created_at),
+        ],
+        'joins': [(TimeSlot, Booking.slot_id == TimeSlot.id), (Teacher, Booking.teacher_id == Teacher.id)],
+        'date': TimeSlot.date,
+        'filters': {'status': Booking.status, 'teacher_id': Booking.teacher_id},
+        'order': Booking.id,
+    },
+    'grades': {
+        'columns': [
+            ('編號', Grade.id), ('考試', Exam.name), ('考試日期', Exam.date), ('學號', Student.student_id),
+            ('學生', Student.name), ('分數', Grade.score), ('名次', Grade.rank), ('趨勢', Grade.trend),
+            ('備註', Grade.note),
+        ],
+        'joins': [(Exam, Grade.exam_id == Exam.id), (Student, Grade.student_id == Student.id)],
+        'date': Exam.date,
+        'filters': {'exam_id': Grade.exam_id, 'student_id': Grade.student_id},
+        'order': Grade.id,
+    },
+}
+
+
+def _export_statement(spec):
+    """依查詢參數組出匯出的 SELECT（參數錯誤在開始串流前就回傳 400）"""
+    stmt = db.select(*[column[1] for column in spec['columns']]).select_from(spec['order'].class_)
+    for target, on in spec['joins']:
+        stmt = stmt.outerjoin(target, on)
+    stmt = _filter_date_range(stmt, spec['date'])
+    month = _parse_month_arg('month') if 'month' in spec else None
+    if month:
+        start = datetime.strptime(month, '%Y-%m')
+        end = (start + timedelta(days=32)).replace(day=1)
+        stmt = stmt.where(spec['month'] >= start, spec['month'] < end)
+    for arg, column in spec['filters'].items():
+        value = request.args.get(arg, '').strip()
+        if not value:
+            continue
+        if column.type.python_type is int:
+            # 轉換失敗不可當作未篩選，否則會默默匯出整張表
+            try:
+                value = int(value)
+            except ValueError:
+                abort_json(400, f'{arg} 須為整數')
+        stmt = stmt.where(column == value)
+    return stmt.order_by(spec['order']).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+
+def _export_rows(spec, stmt):
+    """
+    逐列產生輸出值。只有 DateTime 與指定轉換函式的欄位需要逐值處理，其餘原樣輸出
+    （None 由 CSV / XLSX 寫出時處理）。以 Core 連線執行，省去 ORM 的逐列處理。
+    """
+    converters = []
+    for index, column in enumerate(spec['columns']):
+        if len(column) > 2:
+            converters.append((index, column[2]))
+        elif isinstance(column[1].type, db.DateTime):
+            converters.append((index, _minutes))
+    for row in db.session.connection().execute(stmt):
+        if converters:
+            row = list(row)
+            for index, convert in converters:
+                row[index] = convert(row[index])
+        yield row
+
+
+class _Echo:
+    """csv.writer 的輸出目標：直接回傳寫入的字串"""
+    def write(self, value):
+        return value
+
+
+def _csv_stream(headers, rows):
+    writer = csv.writer(_Echo())
+    # BOM 讓 Excel 以 UTF-8 開啟中文
+    yield '\ufeff' + writer.writerow(headers)
+    chunk = []
+    for row in rows:
+        chunk.append(writer.writerow(row))
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk.clear()
+    if chunk:
+        yield ''.join(chunk)
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """zipfile 的寫入目標；不可 seek，zipfile 會改用 data descriptor 邊寫邊輸出"""
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'
+    ),
+}
+
+# XML 1.0 不允許的控制字元
+XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append('<c/>')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            text = xml_escape(XML_INVALID_CHARS.sub('', str(value)))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f'<row>{"".join(cells)}</row>'.encode('utf-8')
+
+
+def _xlsx_stream(headers, rows):
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(_xlsx_row(headers))
+            for count, row in enumerate(rows, 1):
+                sheet.write(_xlsx_row(row))
+                if count % EXPORT_BATCH_SIZE == 0:
+                    yield buffer.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.take()
+
+
+@app.route('/admin/api/export/<name>', methods=['GET'])
+def admin_export(name):
+    """
+    串流匯出：payments / expenses / attendance / bookings / grades。
+    參數：format=csv|xlsx（預設 csv）、date_from / date_to，以及各匯出的篩選欄位（見 EXPORTS）。
+    """
+    check_admin()
+    spec = EXPORTS.get(name)
+    if not spec:
+        return jsonify({'error': '不支援的匯出項目'}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': '格式須為 csv 或 xlsx'}), 400
+    stmt = _export_statement(spec)
+    headers = [column[0] for column in spec['columns']]
+    stream = _csv_stream if fmt == 'csv' else _xlsx_stream
+    response = app.response_class(
+        stream_with_context(stream(headers, _export_rows(spec, stmt))),
+        mimetype=EXPORT_FORMATS[fmt],
+    )
+    filename = f'{name}-{datetime.now():%Y%m%d}.{fmt}'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+# ─────────────────────────────────────────────
+# 批次匯入 API
+# ─────────────────────────────────────────────
+# 接受 JSON 陣列（或 {"rows": [...]}）、text/csv 本文或 multipart 上傳的 file 欄位。
+# 逐列驗證，通過的列每 IMPORT_CHUNK_SIZE 筆以 executemany 寫入並提交一次；
+# 驗證失敗的列不寫入，於回應中列出列號與原因。CSV 欄位可用英文欄名或匯出檔的中文標題。
+
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_ERRORS = 200
+PAYMENT_STATUSES = ('paid', 'pending', 'cancelled')
+
+
+def _cell(row, key):
+    value = row.get(key)
+    return '' if value is None else str(value).strip()
+
+
+def _int_cell(row, key, errors, label, default=None):
+    value = _cell(row, key)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        errors.append(f'{label}須為整數')
+
+
+def _date_cell(row, key, errors, label, fmt='%Y-%m-%d'):
+    value = _cell(row, key)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, fmt)
+    except ValueError:
+        errors.append(f'{label}格式錯誤')
+
+
+def _student_ref(row, errors):
+    """列中指定學生的方式：student_id（資料庫 id）或 student_no（學號）"""
+    ref = {'student_id': _int_cell(row, 'student_id', errors, '學生 id'), 'student_no': _cell(row, 'student_no')}
+    if ref['student_id'] is None and not ref['student_no'] and not errors:
+        errors.append('缺少學生（student_id 或 student_no）')
+    return ref
+
+
+def _resolve_students(chunk):
+    """把整批的學生參照一次查回資料庫 id；找不到的列回傳錯誤"""
+    ids = {values['student_id'] for _, values in chunk if values['student_id'] is not None}
+    codes = {values['student_no'] for _, values in chunk if values['student_id'] is None}
+    known = set()
+    if ids:
+        known = {row[0] for row in db.session.execute(db.select(Student.id).where(Student.id.in_(ids)))}
+    by_code = {}
+    if codes:
+        by_code = dict(db.session.execute(
+            db.select(Student.student_id, Student.id).where(Student.student_id.in_(codes))
+        ).all())
+    kept, rejected = [], []
+    for index, values in chunk:
+        student_id = values.pop('student_id')
+        student_no = values.pop('student_no')
+        if student_id is None:
+            student_id = by_code.get(student_no)
+        elif student_id not in known:
+            student_id = None
+        if student_id is None:
+            rejected.append((index, ['找不到學生']))
+            continue
+        values['student_id'] = student_id
+        kept.append((index, values))
+    return kept, rejected
+
+
+def _parse_student(row, errors):
+    values = {key: _cell(row, key) for key in (
+        'name', 'contact', 'email', 'level', 'instrument', 'parent_name', 'parent_contact', 'address', 'note',
+    )}
+    if not values['name']:
+        errors.append('缺少姓名')
+    if not values['contact']:
+        errors.append('缺少聯絡方式')
+    if len(values['name']) > 50:
+        errors.append('姓名過長')
+    values['age'] = _int_cell(row, 'age', errors, '年齡')
+    values['enrollment_date'] = _date_cell(row, 'enrollment_date', errors, '入學日期') or datetime.now()
+    return values
+
+
+def _insert_students(rows):
+    prefix = 'S' + datetime.now().strftime('%Y%m')
+    for values, number in zip(rows, student_id_seq.reserve(len(rows))):
+        values['student_id'] = prefix + str(number)
+        values['is_active'] = True
+    db.session.execute(db.insert(Student), rows)
+
+
+def _parse_payment(row, errors):
+    values = _student_ref(row, errors)
+    values['amount'] = _int_cell(row, 'amount', errors, '金額')
+    if values['amount'] is None and '金額須為整數' not in errors:
+        errors.append('缺少金額')
+    values['payment_date'] = _date_cell(row, 'payment_date', errors, '繳費日期') or datetime.now()
+    values['month'] = _cell(row, 'month') or values['payment_date'].strftime('%Y-%m')
+    try:
+        datetime.strptime(values['month'], '%Y-%m')
+    except ValueError:
+        errors.append('月份格式錯誤')
+    values['payment_method'] = _cell(row, 'payment_method') or 'cash'
+    values['status'] = _cell(row, 'status') or 'paid'
+    if values['status'] not in PAYMENT_STATUSES:
+        errors.append('狀態須為 paid / pending / cancelled')
+    values['note'] = _cell(row, 'note')
+    return values
+
+
+def _insert_payments(rows):
+    db.session.execute(db.insert(Payment), rows)
+    # 收入彙總依 (月份, 付款方式, 狀態) 合併後更新，與帳目在同一交易
+    totals = collections.defaultdict(lambda: [0, 0])
+    for values in rows:
+        total = totals[(values['month'], values['payment_method'], values['status'])]
+        total[0] += values['amount']
+        total[1] += 1
+    for (month, method, status), (amount, count) in totals.items():
+        _rollup_add(IncomeMonthly, amount, count, month=month, payment_method=method, status=status)
+
+
+def _parse_attendance(row, errors):
+    values = _student_ref(row, errors)
+    day = _date_cell(row, 'date', errors, '日期')
+    if day is None and '日期格式錯誤' not in errors:
+        errors.append('缺少日期')
+    values['date'] = day.strftime('%Y-%m-%d') if day else None
+    check_time = _date_cell(row, 'check_time', errors, '時間', fmt='%H:%M')
+    values['check_time'] = check_time.strftime('%H:%M') if check_time else '00:00'
+    values['status'] = _cell(row, 'status') or 'present'
+    if values['status'] not in ATTENDANCE_STATUSES:
+        errors.append('狀態須為 present / late / absent / leave')
+    values['late_minutes'] = _int_cell(row, 'late_minutes', errors, '遲到分鐘', default=0)
+    values['course'] = _cell(row, 'course')
+    values['note'] = _cell(row, 'note')
+    return values
+
+
+def _insert_attendance(rows):
+    db.session.execute(db.insert(Attendance), rows)
+
+
+# aliases 為匯出檔中文標題對應的欄名；resolve 在寫入前整批查詢參照的學生
+IMPORTS = {
+    'students': {
+        'parse': _parse_student,
+        'insert': _insert_students,
+        'aliases': {
+            '姓名': 'name', '學生': 'name', '聯絡方式': 'contact', 'Email': 'email', '年齡': 'age',
+            '程度': 'level', '樂器': 'instrument', '家長姓名': 'parent_name', '家長聯絡方式': 'parent_contact',
+            '地址': 'address', '備註': 'note', '入學日期': 'enrollment_date',
+        },
+    },
+    'payments': {
+        'parse': _parse_payment,
+        'resolve': _resolve_students,
+        'insert': _insert_payments,
+        'aliases': {
+            '學號': 'student_no', '月份': 'month', '金額': 'amount', '繳費日期': 'payment_date',
+            '付款方式': 'payment_method', '狀態': 'status', '備註': 'note',
+        },
+    },
+    'attendance': {
+        'parse': _parse_attendance,
+        'resolve': _resolve_students,
+        'insert': _insert_attendance,
+        'aliases': {
+            '學號': 'student_no', '日期': 'date', '時間': 'check_time', '課程': 'course',
+            '狀態': 'status', '遲到分鐘': 'late_minutes', '備註': 'note',
+        },
+    },
+}
+
+
+def _import_source(aliases):
+    """依 Content-Type 逐列讀取匯入資料；CSV 邊讀邊解析，不先載入整個檔案"""
+    if request.mimetype == 'application/json':
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get('rows')
+        if not isinstance(data, list):
+            abort_json(400, 'JSON 須為陣列或 {"rows": [...]}')
+        return iter(data)
+    if 'file' in request.files:
+        stream = request.files['file'].stream
+    elif request.mimetype in ('text/csv', 'text/plain'):
+        stream = request.stream
+    else:
+        abort_json(400, '請以 JSON、text/csv 或上傳 file 欄位提供資料')
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    return (
+        {aliases.get(key.strip(), key.strip()): value for key, value in row.items() if key}
+        for row in reader
+    )
+
+
+def run_import(spec, rows, dry_run=False):
+    """驗證並分批寫入，回傳匯入結果摘要"""
+    result = {'imported': 0, 'failed': 0, 'errors': []}
+    chunk = []
+
+    def reject(index, messages):
+        result['failed'] += 1
+        if len(result['errors']) < IMPORT_MAX_ERRORS:
+            result['errors'].append({'row': index, 'errors': messages})
+
+    def flush():
+        batch = chunk[:]
+        chunk.clear()
+        if 'resolve' in spec:
+            batch, rejected = spec['resolve'](batch)
+            for index, messages in rejected:
+                reject(index, messages)
+        if not batch:
+            return
+        if dry_run:
+            result['imported'] += len(batch)
+            return
+        try:
+            spec['insert']([values for _, values in batch])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        else:
+            result['imported'] += len(batch)
+            return
+        # 整批違反約束時逐列以 savepoint 重寫，只有真正出錯的列列入錯誤
+        for index, values in batch:
+            try:
+                with db.session.begin_nested():
+                    spec['insert']([values])
+            except IntegrityError as exc:
+                reject(index, [f'寫入失敗：{exc.orig}'])
+            else:
+                result['imported'] += 1
+        db.session.commit()
+
+    for index, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            reject(index, ['每列須為物件'])
+            continue
+        errors = []
+        values = spec['parse'](row, errors)
+        if errors:
+            reject(index, errors)
+            continue
+        chunk.append((index, values))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            flush()
+    flush()
+    result['errors'].sort(key=lambda error: error['row'])
+    return result
+
+
+@app.route('/admin/api/import/<name>', methods=['POST'])
+def admin_import(name):
+    """
+    批次匯入：students / payments / attendance。
+    dry_run=1 只驗證不寫入。回應的 row 為資料列序號（CSV 不含標題列，從 1 起算）。
+    """
+    check_admin()
+    spec = IMPORTS.get(name)
+    if not spec:
+        return jsonify({'error': '不支援的匯入項目'}), 404
+    dry_run = request.args.get('dry_run') in ('1', 'true')
+    result = run_import(spec, _import_source(spec['aliases']), dry_run=dry_run)
+    return jsonify({'success': result['failed'] == 0, 'dry_run': dry_run, **result})
+
+
+# ─────────────────────────────────────────────
+# LINE 發送佇列
+# ─────────────────────────────────────────────
+# 請求處理只把訊息寫入 line_outbox（enqueue_line_message），立即回應；
+# 每個 worker 的背景執行緒（或獨立的 flask line-worker 行程）以條件式 UPDATE 認領待送訊息，
+# 經由共用連線池的 requests.Session 呼叫 LINE API。
+# 429 / 5xx / 連線錯誤依 Retry-After 或指數退避重試，其他 4xx 直接標記失敗。
+
+LINE_API_BASE = 'https://api.line.me/v2/bot/message/'
+LINE_MAX_ATTEMPTS = int(os.environ.get('LINE_MAX_ATTEMPTS', 6))
+LINE_BATCH_SIZE = 20
+LINE_SENDER_CONCURRENCY = int(os.environ.get('LINE_SENDER_CONCURRENCY', 4))
+LINE_MULTICAST_MAX = 500       # multicast 每次最多 500 位收件者
+LINE_LEASE_SECONDS = 120       # 認領後未回報結果的訊息，逾時視為可重新認領
+LINE_RETRY_BASE_SECONDS = 2
+LINE_RETRY_MAX_SECONDS = 600
+# LINE Messaging API 速率限制：(次數, 秒)；broadcast / narrowcast 每小時 60 次，其餘每秒 2,000 次
+LINE_RATE_LIMITS = {'broadcast': (60, 3600), 'default': (2000, 1)}
+
+
+class RateLimiter:
+    """簡單的 token bucket；acquire() 回傳需等待的秒數（0 代表已取得）"""
+
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.fill_rate = rate / per
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.fill_rate
+
+
+def enqueue_line_message(kind, payload, access_token=None):
+    """把一則 LINE API 呼叫加入佇列（隨目前交易提交），回傳 LineOutbox"""
+    message = LineOutbox(
+        kind=kind,
+        payload=json.dumps(payload, ensure_ascii=False),
+        access_token=access_token if access_token != os.environ.get('LINE_CHANNEL_ACCESS_TOKEN') else None,
+        status='pending',
+        next_attempt_at=datetime.now(),
+        retry_key=str(uuid.uuid4()),
+    )
+    db.session.add(message)
+    line_sender.wake()
+    return message
+
+
+def _retry_delay(attempts, retry_after=None):
+    if retry_after:
+        try:
+            return min(float(retry_after), LINE_RETRY_MAX_SECONDS)
+        except ValueError:
+            pass
+    delay = min(LINE_RETRY_BASE_SECONDS * 2 ** (attempts - 1), LINE_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class BackgroundWorker:
+    """
+    每個行程一條的背景執行緒，反覆呼叫 drain() 處理資料表中的待辦工作；
+    drain() 回傳 0 時休息 idle_seconds 秒，或直到 wake() 被呼叫。
+    """
+    name = 'background-worker'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        if os.environ.get('LINE_SENDER_THREAD', '1') == '0':
+            return
+        with self._lock:
+            # gunicorn --preload fork 後執行緒不會跟著複製，需在子行程重新啟動
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self.reset()
+            self._thread = threading.Thread(target=self.run_forever, name=self.name, daemon=True)
+            self._thread.start()
+
+    def reset(self):
+        """新行程啟動執行緒前呼叫，子類別可在此丟棄不能跨 fork 共用的資源"""
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run_forever(self, idle_seconds=5):
+        while True:
+            self._wakeup.clear()
+            try:
+                with app.app_context():
+                    processed = self.drain()
+            except Exception as e:
+                print(f'{self.name} error: {e}')
+                processed = 0
+            if not processed:
+                self._wakeup.wait(idle_seconds)
+
+    def drain(self):
+        raise NotImplementedError
+
+
+class LineSender(BackgroundWorker):
+    """背景發送 line_outbox"""
+    name = 'line-sender'
+
+    def __init__(self):
+        super().__init__()
+        self._session = None
+        self._executor = None
+        self._limiters = {kind: RateLimiter(*limit) for kind, limit in LINE_RATE_LIMITS.items()}
+
+    def reset(self):
+        self._session = None
+        self._executor = None
+
+    @property
+    def executor(self):
+        """同一批認領的訊息以多條執行緒同時發送（共用同一個 Session 連線池）"""
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=LINE_SENDER_CONCURRENCY, thread_name_prefix='line-send'
+            )
+        return self._executor
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+            self._session = session
+        return self._session
+
+    def drain(self):
+        """認領並發送一批到期的訊息，回傳處理筆數"""
+        now = datetime.now()
+        due = db.select(LineOutbox.id).where(
+            LineOutbox.status.in_(('pending', 'sending')),
+            LineOutbox.next_attempt_at <= now,
+        ).order_by(LineOutbox.next_attempt_at, LineOutbox.id).limit(LINE_BATCH_SIZE)
+        # 條件式 UPDATE 認領：多個 worker 同時執行時，同一筆只會被一個認領
+        claimed = db.session.execute(
+            db.update(LineOutbox)
+            .where(
+                LineOutbox.id.in_(due.scalar_subquery()),
+                LineOutbox.status.in_(('pending', 'sending')),
+                LineOutbox.next_attempt_at <= now,
+            )
+            .values(status='sending', next_attempt_at=now + timedelta(seconds=LINE_LEASE_SECONDS))
+            .returning(LineOutbox.id, LineOutbox.kind, LineOutbox.payload, LineOutbox.access_token, LineOutbox.attempts,
+                       LineOutbox.retry_key)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.session.commit()
+
+        for row, values in zip(claimed, self.executor.map(self._send, claimed)):
+            db.session.execute(
+                db.update(LineOutbox).where(LineOutbox.id == row.id)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+        return len(claimed)
+
+    def _send(self, row):
+        """發送一筆並回傳要寫回 line_outbox 的欄位"""
+        limiter = self._limiters.get(row.kind, self._limiters['default'])
+        wait = limiter.acquire()
+        if wait:
+            # 超過速率限制：不計入重試次數，延後到可發送時
+            return {'status': 'pending', 'next_attempt_at': datetime.now() + timedelta(seconds=wait)}
+
+        access_token = row.access_token or os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
+        attempts = row.attempts + 1
+        headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+        if row.kind != 'reply' and row.retry_key:
+            # reply 不接受重試金鑰（reply token 本身只能用一次）
+            headers['X-Line-Retry-Key'] = row.retry_key
+        try:
+            response = self.session.post(
+                LINE_API_BASE + row.kind,
+                data=row.payload.encode('utf-8'),
+                headers=headers,
+                timeout=10,
+            )
+        except Exception as e:
+            status, error, retry_after = None, f'連線失敗: {e}', None
+        else:
+            # 409 且帶 X-Line-Accepted-Request-Id：先前某次嘗試已被 LINE 接受，視為已發送
+            if response.status_code == 200 or (
+                    response.status_code == 409 and response.headers.get('X-Line-Accepted-Request-Id')):
+                return {'status': 'sent', 'attempts': attempts, 'last_status': response.status_code,
+                        'last_error': None, 'sent_at': datetime.now()}
+            status, error = response.status_code, response.text[:1000]
+            retry_after = response.headers.get('Retry-After')
+
+        retryable = status is None or status == 429 or status >= 500
+        if retryable and attempts < LINE_MAX_ATTEMPTS:
+            return {'status': 'pending', 'attempts': attempts, 'last_status': status, 'last_error': error,
+                    'next_attempt_at': datetime.now() + timedelta(seconds=_retry_delay(attempts, retry_after))}
+        return {'status': 'failed', 'attempts': attempts, 'last_status': status, 'last_error': error}
+
+
+line_sender = LineSender()
+
+
+@app.before_request
+def _start_line_workers():
+    line_sender.ensure_started()
+    line_event_processor.ensure_started()
+
+
+@app.cli.command('line-worker')
+def line_worker_command():
+    """以獨立行程處理 LINE webhook 事件並發送佇列：flask --app app line-worker"""
+    print('✓ LINE 事件與發送佇列處理中（Ctrl+C 結束）')
+    threading.Thread(target=line_event_processor.run_forever, name=line_event_processor.name, daemon=True).start()
+    line_sender.run_forever()
+
+
+@app.route('/admin/api/line/outbox', methods=['GET'])
+def admin_get_line_outbox():
+    """發送佇列狀態：各狀態筆數與訊息列表（支援 status 篩選與分頁）"""
+    check_admin()
+    if request.args.get('summary'):
+        counts = dict(db.session.query(LineOutbox.status, db.func.count()).group_by(LineOutbox.status).all())
+        return jsonify({status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'failed')})
+    query = LineOutbox.query
+    status = request.args.get('status')
+    if status:
+        query = query.filter_by(status=status)
+    return _list_response(query, [LineOutbox.created_at, LineOutbox.id])
+
+
+@app.route('/admin/api/line/outbox/<int:mid>', methods=['GET'])
+def admin_get_line_outbox_item(mid):
+    check_admin()
+    return jsonify(LineOutbox.query.get_or_404(mid).to_dict())
+
+
+@app.route('/admin/api/line/outbox/<int:mid>/retry', methods=['POST'])
+def admin_retry_line_outbox_item(mid):
+    """將失敗的訊息重新排入佇列"""
+    check_admin()
+    message = LineOutbox.query.get_or_404(mid)
+    if message.status != 'failed':
+        return jsonify({'error': '只能重送失敗的訊息'}), 400
+    message.status = 'pending'
+    message.attempts = 0
+    message.next_attempt_at = datetime.now()
+    db.session.commit()
+    line_sender.wake()
+    return jsonify(message.to_dict()), 202
+
+
+# ─────────────────────────────────────────────
+# LINE 自動回覆
+# ─────────────────────────────────────────────
+
+LINE_DEFAULT_REPLY = '您好！感謝您的訊息。'
+AUTO_REPLY_MATCH_TYPES = ('contains', 'exact', 'regex')
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick 多字串比對：一次掃描文字即找出所有出現的關鍵字，
+    耗時與文字長度成正比，不隨關鍵字數量增加。
+    """
+
+    def __init__(self, keywords):
+        """keywords 為 [(keyword, value), ...]，keyword 需已轉小寫"""
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for keyword, value in keywords:
+            node = 0
+            for ch in keyword:
+                if ch not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[node][ch] = len(self._goto) - 1
+                node = self._goto[node][ch]
+            self._out[node].append((keyword, value))
+
+        # 以 BFS 建立失敗連結，並把後綴節點的輸出併入
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                if node:
+                    self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def search(self, text):
+        """依序產生文字中出現的 (keyword, value)"""
+        node = 0
+        for ch in text:
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            yield from self._out[node]
+
+
+class AutoReplyEngine:
+    """
+    把啟用中的 AutoReplyRule 編譯成：exact 的字典、contains 的單一 Aho-Corasick 比對器，
+    以及依優先序排列的 regex 列表。規則有異動（筆數、最後修改時間改變）時才重新編譯。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._compiled = None
+
+    def match(self, text):
+        """回傳 (rule_id, 回覆文字)；沒有規則符合時 rule_id 為 None，回覆預設訊息"""
+        exact, matcher, regexes = self._rules()
+        normalized = text.strip().lower()
+
+        # 規則以 (priority, -id, reply) 表示，取最大者：優先序高者勝，同優先序取較早建立的規則
+        best = None
+        if normalized in exact:
+            best = (exact[normalized], normalized, {})
+        for keyword, rule in matcher.search(normalized):
+            if best is None or rule[:2] > best[0][:2]:
+                best = (rule, keyword, {})
+        for rule, pattern in regexes:
+            if best and rule[:2] < best[0][:2]:
+                break   # 已依優先序排序，之後的 regex 不可能勝出
+            found = pattern.search(text)
+            if found:
+                best = (rule, found.group(0), found.groupdict())
+                break
+
+        if best is None:
+            return None, LINE_DEFAULT_REPLY
+        (_, neg_id, reply), keyword, groups = best
+        values = {'text': text, 'keyword': keyword, **{k: v or '' for k, v in groups.items()}}
+        return -neg_id, re.sub(r'\{(\w+)\}', lambda m: values.get(m.group(1), m.group(0)), reply)
+
+    def _rules(self):
+        signature = tuple(db.session.query(
+            db.func.count(AutoReplyRule.id), db.func.max(AutoReplyRule.updated_at)
+        ).one())
+        with self._lock:
+            if signature != self._signature or self._compiled is None:
+                self._compiled = self._compile(AutoReplyRule.query.filter_by(is_active=True).all())
+                self._signature = signature
+            return self._compiled
+
+    @staticmethod
+    def _compile(rules):
+        exact, keywords, regexes = {}, [], []
+        for rule in rules:
+            key = (rule.priority, -rule.id, rule.reply)
+            if rule.match_type == 'regex':
+                try:
+                    regexes.append((key, re.compile(rule.keywords, re.IGNORECASE)))
+                except re.error:
+                    continue
+            else:
+                for keyword in rule.keyword_list():
+                    keyword = keyword.lower()
+                    if rule.match_type == 'exact':
+                        if keyword not in exact or key[:2] > exact[keyword][:2]:
+                            exact[keyword] = key
+                    else:
+                        keywords.append((keyword, key))
+        regexes.sort(key=lambda r: r[0][:2], reverse=True)
+        return exact, KeywordMatcher(keywords), regexes
+
+
+auto_reply_engine = AutoReplyEngine()
+
+
+def _apply_reply_rule(rule, data):
+    """檢查並套用規則欄位，有誤時回傳錯誤訊息"""
+    match_type = data.get('match_type', rule.match_type or 'contains')
+    if match_type not in AUTO_REPLY_MATCH_TYPES:
+        return 'match_type 需為 contains、exact 或 regex'
+    keywords = data.get('keywords', rule.keywords or '')
+    if isinstance(keywords, list):
+        keywords = ','.join(str(k).strip() for k in keywords)
+    keywords = (keywords or '').strip()
+    reply = (data.get('reply', rule.reply or '') or '').strip()
+    if not keywords or not reply:
+        return '關鍵字與回覆內容不可為空'
+    if match_type == 'regex':
+        try:
+            re.compile(keywords)
+        except re.error as e:
+            return f'正規表示式錯誤：{e}'
+    try:
+        priority = int(data.get('priority', rule.priority or 0))
+    except (TypeError, ValueError):
+        return 'priority 需為整數'
+
+    rule.match_type = match_type
+    rule.keywords = keywords
+    rule.reply = reply
+    rule.priority = priority
+    rule.is_active = bool(data.get('is_active', True if rule.is_active is None else rule.is_active))
+    return None
+
+
+@app.route('/admin/api/line/replies', methods=['GET'])
+def admin_get_reply_rules():
+    check_admin()
+    rules = AutoReplyRule.query.order_by(AutoReplyRule.priority.desc(), AutoReplyRule.id).all()
+    return jsonify([r.to_dict() for r in rules])
+
+
+@app.route('/admin/api/line/replies', methods=['POST'])
+def admin_add_reply_rule():
+    check_admin()
+    rule = AutoReplyRule()
+    error = _apply_reply_rule(rule, request.get_json() or {})
+    if error:
+        return jsonify({'error': error}), 400
+    db.session.add(rule)
+    db.session.commit()
+    return jsonify(rule.to_dict()), 201
+
+
+@app.route('/admin/api/line/replies/<int:rid>', methods=['PUT'])
+def admin_update_reply_rule(rid):
+    check_admin()
+    rule = AutoReplyRule.query.get_or_404(rid)
+    error = _apply_reply_rule(rule, request.get_json() or {})
+    if error:
+        db.session.rollback()
+        return jsonify({'error': error}), 400
+    rule.updated_at = datetime.now()
+    db.session.commit()
+    return jsonify(rule.to_dict())
+
+
+@app.route('/admin/api/line/replies/<int:rid>', methods=['DELETE'])
+def admin_delete_reply_rule(rid):
+    check_admin()
+    rule = AutoReplyRule.query.get_or_404(rid)
+    db.session.delete(rule)
+    db.session.commit()
+    return jsonify({'success': True})
+
+
+@app.route('/admin/api/line/replies/test', methods=['POST'])
+def admin_test_reply_rules():
+    """以目前規則試算某段文字的自動回覆"""
+    check_admin()
+    text = (request.get_json() or {}).get('text', '')
+    rule_id, reply = auto_reply_engine.match(text)
+    return jsonify({'rule_id': rule_id, 'reply': reply})
+
+
 # ─────────────────────────────────────────────
 # LINE 串接 API
 # ─────────────────────────────────────────────
@@ -1257,44 +4106,24 @@ def line_broadcast():
     if not message:
         return jsonify({'error': '訊息內容不可為空'}), 400
     
-    try:
-        import requests
-        
-        # 群發訊息 API
-        url = 'https://api.line.me/v2/bot/message/broadcast'
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            'messages': [
-                {
-                    'type': 'text',
-                    'text': message
-                }
-            ]
-        }
-        
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        
-        if response.status_code == 200:
-            return jsonify({
-                'success': True,
-                'message': '訊息已發送',
-                'recipients': recipients
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': 'LINE API 呼叫失敗',
-                'details': response.text
-            }), response.status_code
-            
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'發送失敗: {str(e)}'
-        }), 500
+    # 群發訊息 API（由發送佇列送出）
+    outbox = enqueue_line_message('broadcast', {
+        'messages': [
+            {
+                'type': 'text',
+                'text': message
+            }
+        ]
+    }, access_token)
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'message': '訊息已排入發送佇列',
+        'recipients': recipients,
+        'outbox_id': outbox.id,
+        'status': outbox.status,
+    }), 202
 
 
 @app.route('/admin/api/line/push', methods=['POST'])
@@ -1313,177 +4142,427 @@ def line_push():
     if not user_id or not message:
         return jsonify({'error': '缺少必要參數'}), 400
     
-    try:
-        import requests
-        
-        url = 'https://api.line.me/v2/bot/message/push'
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            'to': user_id,
+    outbox = enqueue_line_message('push', {
+        'to': user_id,
+        'messages': [
+            {
+                'type': 'text',
+                'text': message
+            }
+        ]
+    }, access_token)
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'message': '訊息已排入發送佇列',
+        'outbox_id': outbox.id,
+        'status': outbox.status,
+    }), 202
+
+
+def _follower_segment(spec):
+    """
+    依條件篩選仍在追蹤的 LINE 好友（條件之間為 AND）：
+      relation      student / parent
+      active        只限在學學生
+      student_ids   指定學生（陣列或逗號分隔）
+      instrument    學生的樂器
+      level         學生的程度
+      teacher_id    曾向該老師預約且仍有效的學生（以學生或家長聯絡方式比對預約紀錄）
+      unpaid_month  該月份（YYYY-MM）尚無已繳費紀錄的在學學生
+    """
+    query = LineFollower.query.filter(LineFollower.is_following.is_(True))
+    if spec.get('relation'):
+        query = query.filter(LineFollower.relation == spec['relation'])
+
+    student_filters = []
+    if spec.get('active') in (True, 1, '1', 'true'):
+        student_filters.append(Student.is_active.is_(True))
+    student_ids = spec.get('student_ids')
+    if student_ids:
+        if isinstance(student_ids, str):
+            student_ids = student_ids.split(',')
+        try:
+            student_filters.append(Student.id.in_([int(i) for i in student_ids]))
+        except (TypeError, ValueError):
+            abort_json(400, 'student_ids 格式錯誤')
+    if spec.get('instrument'):
+        student_filters.append(Student.instrument == spec['instrument'])
+    if spec.get('level'):
+        student_filters.append(Student.level == spec['level'])
+    if spec.get('teacher_id'):
+        try:
+            teacher_id = int(spec['teacher_id'])
+        except (TypeError, ValueError):
+            abort_json(400, 'teacher_id 格式錯誤')
+        contacts = db.select(Booking.student_contact).where(
+            Booking.teacher_id == teacher_id, Booking.status == 'confirmed'
+        )
+        student_filters.append(db.or_(Student.contact.in_(contacts), Student.parent_contact.in_(contacts)))
+    if spec.get('unpaid_month'):
+        month = str(spec['unpaid_month'])
+        try:
+            datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            abort_json(400, '月份格式錯誤：unpaid_month')
+        paid = db.select(Payment.student_id).where(Payment.month == month, Payment.status == 'paid')
+        student_filters += [Student.is_active.is_(True), Student.id.not_in(paid)]
+
+    if student_filters:
+        query = query.join(Student, LineFollower.student_id == Student.id).filter(*student_filters)
+    return query
+
+
+@app.route('/admin/api/line/followers', methods=['GET'])
+def admin_get_line_followers():
+    """LINE 好友列表，可用 _follower_segment 的條件篩選（搭配 limit=1&include_total=1 可預估人數）"""
+    check_admin()
+    query = _follower_segment(request.args)
+    return _list_response(query, [LineFollower.followed_at, LineFollower.id])
+
+
+@app.route('/admin/api/line/followers/<int:fid>', methods=['PUT'])
+def admin_update_line_follower(fid):
+    """連結好友與學生（relation：student 本人 / parent 家長）"""
+    check_admin()
+    follower = LineFollower.query.get_or_404(fid)
+    data = request.get_json() or {}
+    if 'student_id' in data:
+        if data['student_id'] and db.session.get(Student, data['student_id']) is None:
+            return jsonify({'error': '找不到學生'}), 404
+        follower.student_id = data['student_id'] or None
+    if data.get('relation'):
+        if data['relation'] not in ('student', 'parent'):
+            return jsonify({'error': 'relation 需為 student 或 parent'}), 400
+        follower.relation = data['relation']
+    follower.display_name = data.get('display_name', follower.display_name)
+    db.session.commit()
+    return jsonify(follower.to_dict())
+
+
+@app.route('/admin/api/line/multicast', methods=['POST'])
+def line_multicast():
+    """
+    依條件（segment，欄位同 _follower_segment）發送給符合的 LINE 好友。
+    收件者每 500 位一批排入發送佇列，由 LineSender 同時發送。
+    """
+    check_admin()
+    data = request.get_json() or {}
+    
+    access_token = data.get('access_token') or os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
+    if not access_token:
+        return jsonify({'error': '尚未設定 LINE Channel Access Token'}), 400
+    
+    message = data.get('message')
+    if not message:
+        return jsonify({'error': '訊息內容不可為空'}), 400
+    
+    user_ids = [user_id for (user_id,) in _follower_segment(data.get('segment') or {})
+                .with_entities(LineFollower.user_id).distinct().order_by(LineFollower.user_id)]
+    if not user_ids:
+        return jsonify({'error': '沒有符合條件的 LINE 好友'}), 400
+    
+    outbox = [
+        enqueue_line_message('multicast', {
+            'to': user_ids[i:i + LINE_MULTICAST_MAX],
             'messages': [
                 {
                     'type': 'text',
                     'text': message
                 }
             ]
-        }
-        
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        
-        if response.status_code == 200:
-            return jsonify({
-                'success': True,
-                'message': '訊息已發送'
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': 'LINE API 呼叫失敗',
-                'details': response.text
-            }), response.status_code
-            
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'發送失敗: {str(e)}'
-        }), 500
+        }, access_token)
+        for i in range(0, len(user_ids), LINE_MULTICAST_MAX)
+    ]
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'message': '訊息已排入發送佇列',
+        'recipients': len(user_ids),
+        'batches': len(outbox),
+        'outbox_ids': [m.id for m in outbox],
+    }), 202
 
 
 @app.route('/webhook/line', methods=['POST'])
 def line_webhook():
-    """LINE Webhook 接收訊息與事件"""
+    """
+    LINE Webhook 接收訊息與事件。
+    只驗證簽名並把事件存入 line_events 後立即回應（避免逾時重送），
+    實際處理由 LineEventProcessor 在背景批次進行。
+    """
     
     # 取得 Channel Secret
     channel_secret = os.environ.get('LINE_CHANNEL_SECRET', '')
     
-    # 取得簽名驗證
-    signature = request.headers.get('X-Line-Signature', '')
-    body = request.get_data(as_text=True)
-    
-    # 驗證簽名
+    # 以原始位元組驗證簽名（固定時間比較）
+    body = request.get_data()
     if channel_secret:
-        try:
-            import hashlib
-            import hmac
-            import base64
-            
-            hash_value = hmac.new(
-                channel_secret.encode('utf-8'),
-                body.encode('utf-8'),
-                hashlib.sha256
-            ).digest()
-            
-            expected_signature = base64.b64encode(hash_value).decode()
-            
-            if signature != expected_signature:
-                return jsonify({'error': 'Invalid signature'}), 403
-        except Exception as e:
-            print(f'Signature verification error: {e}')
-            return jsonify({'error': 'Signature verification failed'}), 403
+        signature = request.headers.get('X-Line-Signature', '').encode('utf-8')
+        expected_signature = base64.b64encode(
+            hmac.new(channel_secret.encode('utf-8'), body, hashlib.sha256).digest()
+        )
+        if not hmac.compare_digest(signature, expected_signature):
+            return jsonify({'error': 'Invalid signature'}), 403
+    
+    try:
+        events = json.loads(body).get('events', [])
+    except (ValueError, AttributeError):
+        return jsonify({'error': 'Invalid payload'}), 400
     
-    # 處理事件
+    if events:
+        _store_line_events(events)
+        line_event_processor.wake()
+    return jsonify({'success': True})
+
+
+def _store_line_events(events):
+    """存入事件；webhookEventId 已存在者（LINE 重送）略過"""
+    rows = [{
+        'webhook_event_id': event.get('webhookEventId'),
+        'event_type': event.get('type'),
+        'payload': json.dumps(event, ensure_ascii=False),
+        'status': 'pending',
+        'received_at': datetime.now(),
+    } for event in events]
+    ids = [row['webhook_event_id'] for row in rows if row['webhook_event_id']]
+    seen = set(db.session.scalars(
+        db.select(LineEvent.webhook_event_id).where(LineEvent.webhook_event_id.in_(ids))
+    )) if ids else set()
+    rows = [row for row in rows if row['webhook_event_id'] not in seen]
+    if not rows:
+        return
     try:
-        events = request.json.get('events', [])
+        db.session.execute(db.insert(LineEvent), rows)
+        db.session.commit()
+    except IntegrityError:
+        # 同一批事件被同時重送：逐筆寫入，已存在者略過
+        db.session.rollback()
+        for row in rows:
+            try:
+                db.session.execute(db.insert(LineEvent), row)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+
+
+LINE_EVENT_BATCH_SIZE = 50
+LINE_EVENT_LEASE_SECONDS = 300   # 認領後未寫回結果（worker 中途結束）的事件，逾時視為可重新認領
+
+
+class LineEventProcessor(BackgroundWorker):
+    """背景批次處理 line_events"""
+    name = 'line-events'
+
+    def drain(self):
+        """認領一批待處理事件，處理後與產生的回覆訊息一併提交，回傳處理筆數"""
+        now = datetime.now()
+        # 待處理，或認領逾時（含遷移前遺留、沒有認領時間的 processing）
+        claimable = db.or_(
+            LineEvent.status == 'pending',
+            db.and_(LineEvent.status == 'processing', db.or_(
+                LineEvent.claimed_at.is_(None),
+                LineEvent.claimed_at < now - timedelta(seconds=LINE_EVENT_LEASE_SECONDS),
+            )),
+        )
+        due = db.select(LineEvent.id).where(claimable).order_by(LineEvent.id).limit(LINE_EVENT_BATCH_SIZE)
+        claimed = db.session.execute(
+            db.update(LineEvent)
+            .where(LineEvent.id.in_(due.scalar_subquery()), claimable)
+            .values(status='processing', claimed_at=now)
+            .returning(LineEvent.id, LineEvent.payload)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.session.commit()
+        if not claimed:
+            return 0
+
         access_token = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
+        results = []
+        for row in claimed:
+            try:
+                with db.session.begin_nested():
+                    _handle_line_event(json.loads(row.payload), access_token)
+                results.append({'id': row.id, 'status': 'done', 'error': None, 'processed_at': datetime.now()})
+            except Exception as e:
+                print(f'Webhook event error: {e}')
+                results.append({'id': row.id, 'status': 'failed', 'error': str(e), 'processed_at': datetime.now()})
+        db.session.execute(db.update(LineEvent), results)
+        db.session.commit()
+        return len(claimed)
+
+
+line_event_processor = LineEventProcessor()
+
+
+def _handle_line_event(event, access_token):
+    """處理單一 webhook 事件（回覆訊息加入發送佇列）"""
+    event_type = event.get('type')
+    
+    if event_type == 'message':
+        # 處理訊息事件
+        reply_token = event.get('replyToken')
+        message = event.get('message', {})
+        message_type = message.get('type')
         
-        for event in events:
-            event_type = event.get('type')
+        if message_type == 'text':
+            # 關鍵字自動回覆（規則存於 line_reply_rules）
+            _, reply_text = auto_reply_engine.match(message.get('text', ''))
             
-            if event_type == 'message':
-                # 處理訊息事件
-                reply_token = event.get('replyToken')
-                message = event.get('message', {})
-                message_type = message.get('type')
-                user_id = event.get('source', {}).get('userId')
-                
-                if message_type == 'text':
-                    message_text = message.get('text', '').lower()
-                    
-                    # 簡單的關鍵字回覆
-                    reply_text = '您好！感謝您的訊息。'
-                    
-                    if '課程' in message_text or '上課' in message_text:
-                        reply_text = '我們提供鋼琴、吉他、小提琴等多種音樂課程。詳細資訊請來電洽詢：02-1234-5678'
-                    elif '收費' in message_text or '價格' in message_text:
-                        reply_text = '課程收費：\n鋼琴 NT$1,200/堂\n吉他 NT$1,000/堂\n小提琴 NT$1,500/堂\n歡迎預約體驗！'
-                    elif '地址' in message_text or '位置' in message_text:
-                        reply_text = '地址：台北市中正區音樂街123號\n營業時間：週一至週日 09:00-21:00'
-                    elif '預約' in message_text or '報名' in message_text:
-                        reply_text = '預約方式：\n1. 線上預約：https://music-web.com\n2. 來電預約：02-1234-5678\n3. LINE 私訊預約'
-                    
-                    # 回覆訊息
-                    if access_token and reply_token:
-                        _line_reply(access_token, reply_token, reply_text)
-                        
-            elif event_type == 'follow':
-                # 用戶加入好友
-                user_id = event.get('source', {}).get('userId')
-                reply_token = event.get('replyToken')
-                
-                welcome_message = '歡迎加入音樂補習班！\n\n您可以透過 LINE 查詢：\n• 課程資訊\n• 收費標準\n• 預約課程\n• 地址與營業時間\n\n請直接傳送訊息給我們！'
-                
-                if access_token and reply_token:
-                    _line_reply(access_token, reply_token, welcome_message)
+            # 回覆訊息
+            if access_token and reply_token:
+                _line_reply(access_token, reply_token, reply_text)
                 
-                # 可以將 user_id 儲存到資料庫
-                print(f'New follower: {user_id}')
-                
-            elif event_type == 'unfollow':
-                # 用戶封鎖
-                user_id = event.get('source', {}).get('userId')
-                print(f'User unfollowed: {user_id}')
+    elif event_type == 'follow':
+        # 用戶加入好友
+        user_id = event.get('source', {}).get('userId')
+        reply_token = event.get('replyToken')
         
-        return jsonify({'success': True})
+        welcome_message = '歡迎加入音樂補習班！\n\n您可以透過 LINE 查詢：\n• 課程資訊\n• 收費標準\n• 預約課程\n• 地址與營業時間\n\n請直接傳送訊息給我們！'
         
-    except Exception as e:
-        print(f'Webhook error: {e}')
-        return jsonify({'error': str(e)}), 500
+        if access_token and reply_token:
+            _line_reply(access_token, reply_token, welcome_message)
+        
+        if user_id:
+            _set_follower(user_id, True)
+        
+    elif event_type == 'unfollow':
+        # 用戶封鎖
+        user_id = event.get('source', {}).get('userId')
+        if user_id:
+            _set_follower(user_id, False)
+
+
+def _set_follower(user_id, following):
+    """記錄加入或封鎖；重新加入的好友保留原本的學生連結"""
+    follower = LineFollower.query.filter_by(user_id=user_id).first()
+    if follower is None:
+        follower = LineFollower(user_id=user_id)
+        db.session.add(follower)
+    follower.is_following = following
+    if following:
+        follower.followed_at = datetime.now()
+        follower.unfollowed_at = None
+    else:
+        follower.unfollowed_at = datetime.now()
+
+
+@app.route('/admin/api/line/events', methods=['GET'])
+def admin_get_line_events():
+    """webhook 事件處理狀態（status 篩選與分頁；summary=1 回傳各狀態筆數）"""
+    check_admin()
+    if request.args.get('summary'):
+        counts = dict(db.session.query(LineEvent.status, db.func.count()).group_by(LineEvent.status).all())
+        return jsonify({status: counts.get(status, 0) for status in ('pending', 'processing', 'done', 'failed')})
+    query = LineEvent.query
+    status = request.args.get('status')
+    if status:
+        query = query.filter_by(status=status)
+    return _list_response(query, [LineEvent.received_at, LineEvent.id])
 
 
 def _line_reply(access_token, reply_token, text):
-    """回覆 LINE 訊息的輔助函式"""
-    try:
-        import requests
-        
-        url = 'https://api.line.me/v2/bot/message/reply'
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            'replyToken': reply_token,
-            'messages': [
-                {
-                    'type': 'text',
-                    'text': text
-                }
-            ]
-        }
-        
-        requests.post(url, headers=headers, json=payload, timeout=10)
-    except Exception as e:
-        print(f'LINE reply error: {e}')
+    """回覆 LINE 訊息的輔助函式（加入發送佇列，隨目前交易提交）"""
+    enqueue_line_message('reply', {
+        'replyToken': reply_token,
+        'messages': [
+            {
+                'type': 'text',
+                'text': text
+            }
+        ]
+    }, access_token)
 
 
 # ─────────────────────────────────────────────
 # 工具函式
 # ─────────────────────────────────────────────
 
-def _generate_slots(teacher_id, times, days_ahead=14):
+SLOT_HORIZON_DAYS = int(os.environ.get('SLOT_HORIZON_DAYS', 30))
+SLOT_MAX_HORIZON_DAYS = 365   # 單次展開的上限，避免一次請求寫入數十萬個時段
+DEFAULT_WEEKDAYS = range(6)   # 週一～週六（週日不排課）
+
+
+def _generate_slots(teacher_id, times, days_ahead=None):
+    """為新老師建立週一～週六的固定時段，並展開未來 days_ahead 天"""
+    db.session.execute(db.insert(AvailabilityTemplate), [
+        {'teacher_id': teacher_id, 'weekday': weekday, 'time': t}
+        for weekday in DEFAULT_WEEKDAYS for t in dict.fromkeys(times)
+    ])
+    materialize_slots([teacher_id], days_ahead)
+
+
+def materialize_slots(teacher_ids=None, days_ahead=None):
+    """
+    依固定時段與例外，補齊 teacher_ids（預設全部在職老師）明天起 days_ahead 天內缺少的時段。
+    既有時段（含已被預約者）不會變動。查詢數固定：範本、例外、既有時段各一次，再一次批次新增。
+    回傳新增的時段數。
+    """
+    days_ahead = days_ahead or SLOT_HORIZON_DAYS
     today = datetime.now().date()
+    start, end = str(today + timedelta(days=1)), str(today + timedelta(days=days_ahead))
+
+    templates = db.session.query(AvailabilityTemplate.teacher_id, AvailabilityTemplate.weekday, AvailabilityTemplate.time) \
+        .join(Teacher, AvailabilityTemplate.teacher_id == Teacher.id).filter(Teacher.is_active.is_(True))
+    if teacher_ids is not None:
+        templates = templates.filter(AvailabilityTemplate.teacher_id.in_(teacher_ids))
+    by_teacher = {}
+    for teacher_id, weekday, t in templates:
+        by_teacher.setdefault(teacher_id, {}).setdefault(weekday, []).append(t)
+    if not by_teacher:
+        db.session.commit()
+        return 0
+
+    exceptions = db.session.query(AvailabilityException.teacher_id, AvailabilityException.date, AvailabilityException.time) \
+        .filter(AvailabilityException.teacher_id.in_(by_teacher),
+                AvailabilityException.date >= start, AvailabilityException.date <= end)
+    closed_days = set()
+    closed_slots = set()
+    for teacher_id, date, t in exceptions:
+        if t:
+            closed_slots.add((teacher_id, date, t))
+        else:
+            closed_days.add((teacher_id, date))
+
+    existing = set(map(tuple, db.session.query(TimeSlot.teacher_id, TimeSlot.date, TimeSlot.time).filter(
+        TimeSlot.teacher_id.in_(by_teacher), TimeSlot.date >= start, TimeSlot.date <= end
+    )))
+
+    rows = []
     for offset in range(1, days_ahead + 1):
-        date = today + timedelta(days=offset)
-        if date.weekday() == 6:   # 週日不排課
-            continue
-        for t in times:
-            existing = TimeSlot.query.filter_by(teacher_id=teacher_id, date=str(date), time=t).first()
-            if not existing:
-                slot = TimeSlot(teacher_id=teacher_id, date=str(date), time=t, is_available=True)
-                db.session.add(slot)
+        day = today + timedelta(days=offset)
+        date = str(day)
+        for teacher_id, weekly in by_teacher.items():
+            if (teacher_id, date) in closed_days:
+                continue
+            for t in weekly.get(day.weekday(), ()):
+                key = (teacher_id, date, t)
+                if key not in existing and key not in closed_slots:
+                    rows.append({'teacher_id': teacher_id, 'date': date, 'time': t, 'is_available': True})
+
+    changed = {row['teacher_id'] for row in rows}
+    if rows:
+        # 與另一個請求/排程同時展開時，對方已新增的時段直接略過
+        db.session.execute(
+            upsert_insert(TimeSlot).on_conflict_do_nothing(index_elements=['teacher_id', 'date', 'time']), rows
+        )
+    for teacher_id in changed:
+        bump_availability(teacher_id)
     db.session.commit()
+    for teacher_id in changed:
+        availability_index.invalidate(teacher_id)
+    return len(rows)
+
+
+@app.cli.command('extend-slots')
+@click.option('--days', type=click.IntRange(1, SLOT_MAX_HORIZON_DAYS), default=None,
+              help='展開天數（預設 SLOT_HORIZON_DAYS）')
+def extend_slots_command(days):
+    """為全部在職老師補齊未來時段（建議每日排程執行）：flask --app app extend-slots"""
+    created = materialize_slots(days_ahead=days)
+    print(f'✓ 已新增 {created} 個時段')
 
 
 def seed():
@@ -1518,6 +4597,205 @@ def seed():
     print('範例資料建立完成')
 
 
+# ─────────────────────────────────────────────
+# 資料庫遷移
+# ─────────────────────────────────────────────
+# db.create_all() 只會建立不存在的資料表，不會變更已存在的資料表；
+# 既有資料庫（如正式環境的 booking.db）的結構變更一律寫成下列遷移。
+# 每筆遷移為 (id, [SQL 或 函式(conn), ...])，依序執行一次，套用紀錄存於 schema_migrations。
+# SQL 須可重複執行（IF NOT EXISTS），新資料庫經 create_all 建好後再跑也不會出錯；
+# 需要依資料計算（不便以各資料庫通用 SQL 表達）的步驟寫成函式，在同一交易內執行。
+# 新增遷移只能附加在最後，已發布的項目不可修改。
+
+# 原本寫死在 webhook 的關鍵字回覆，作為預設規則
+DEFAULT_REPLY_RULES = [
+    ('課程,上課', '我們提供鋼琴、吉他、小提琴等多種音樂課程。詳細資訊請來電洽詢：02-1234-5678', 40),
+    ('收費,價格', '課程收費：\n鋼琴 NT$1,200/堂\n吉他 NT$1,000/堂\n小提琴 NT$1,500/堂\n歡迎預約體驗！', 30),
+    ('地址,位置', '地址：台北市中正區音樂街123號\n營業時間：週一至週日 09:00-21:00', 20),
+    ('預約,報名', '預約方式：\n1. 線上預約：https://music-web.com\n2. 來電預約：02-1234-5678\n3. LINE 私訊預約', 10),
+]
+
+
+def _seed_reply_rules(conn):
+    """尚無任何自動回覆規則時建立預設規則"""
+    if conn.execute(db.select(db.func.count(AutoReplyRule.id))).scalar():
+        return
+    now = datetime.now()
+    conn.execute(db.insert(AutoReplyRule), [
+        {'keywords': keywords, 'match_type': 'contains', 'reply': reply, 'priority': priority,
+         'is_active': True, 'created_at': now, 'updated_at': now}
+        for keywords, reply, priority in DEFAULT_REPLY_RULES
+    ])
+
+
+def _backfill_availability_templates(conn):
+    """
+    由在職老師近四週起的時段推回每週固定時段（已有固定時段的老師略過）。
+    更早的時段多是已不再開放的臨時加課，不納入。
+    """
+    teachers = {row[0] for row in conn.execute(db.select(Teacher.id).where(Teacher.is_active.is_(True)))}
+    teachers -= {row[0] for row in conn.execute(db.select(AvailabilityTemplate.teacher_id).distinct())}
+    if not teachers:
+        return
+    since = str(datetime.now().date() - timedelta(weeks=4))
+    weekly = set()
+    for teacher_id, date, t in conn.execute(
+        db.select(TimeSlot.teacher_id, TimeSlot.date, TimeSlot.time).distinct()
+        .where(TimeSlot.teacher_id.in_(teachers), TimeSlot.date >= since)
+    ):
+        weekly.add((teacher_id, datetime.strptime(date, '%Y-%m-%d').weekday(), t))
+    if weekly:
+        conn.execute(db.insert(AvailabilityTemplate), [
+            {'teacher_id': teacher_id, 'weekday': weekday, 'time': t} for teacher_id, weekday, t in sorted(weekly)
+        ])
+
+
+def _add_column(table, column, ddl):
+    """回傳一個遷移步驟：資料表缺少 column 時以 ALTER TABLE 補上（新資料庫已由 create_all 建立）"""
+    def step(conn):
+        if column not in {c['name'] for c in db.inspect(conn).get_columns(table)}:
+            conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    return step
+
+
+def _backfill_line_retry_keys(conn):
+    """既有的發送佇列各配一個重試金鑰"""
+    ids = [row[0] for row in conn.execute(db.select(LineOutbox.id).where(LineOutbox.retry_key.is_(None)))]
+    if ids:
+        conn.execute(
+            db.update(LineOutbox).where(LineOutbox.id == db.bindparam('row_id'))
+            .values(retry_key=db.bindparam('key')),
+            [{'row_id': row_id, 'key': str(uuid.uuid4())} for row_id in ids],
+        )
+
+
+def _dedupe_time_slots(conn):
+    """
+    同一老師同一日期時間只保留一個時段：優先保留已被預約、其次已關閉、再其次最早建立的，
+    指向其他重複時段的預約改指向保留的時段，之後才能建立唯一索引。
+    """
+    dups = (
+        db.select(TimeSlot.teacher_id, TimeSlot.date, TimeSlot.time)
+        .group_by(TimeSlot.teacher_id, TimeSlot.date, TimeSlot.time)
+        .having(db.func.count() > 1)
+        .subquery()
+    )
+    rows = conn.execute(
+        db.select(TimeSlot.id, TimeSlot.teacher_id, TimeSlot.date, TimeSlot.time, TimeSlot.is_available)
+        .join(dups, db.and_(TimeSlot.teacher_id == dups.c.teacher_id,
+                            TimeSlot.date == dups.c.date, TimeSlot.time == dups.c.time))
+        .order_by(TimeSlot.id)
+    ).all()
+    if not rows:
+        return
+    booked = {row[0] for row in conn.execute(
+        db.select(Booking.slot_id).distinct().where(Booking.slot_id.in_([row.id for row in rows]))
+    )}
+    groups = {}
+    for row in rows:
+        groups.setdefault((row.teacher_id, row.date, row.time), []).append(row)
+    remap = {}
+    for slots in groups.values():
+        keep = min(slots, key=lambda slot: (slot.id not in booked, bool(slot.is_available), slot.id))
+        remap.update((slot.id, keep.id) for slot in slots if slot.id != keep.id)
+    moved = [{'old_slot': old, 'new_slot': new} for old, new in remap.items() if old in booked]
+    if moved:
+        conn.execute(
+            db.update(Booking).where(Booking.slot_id == db.bindparam('old_slot'))
+            .values(slot_id=db.bindparam('new_slot')),
+            moved,
+        )
+    removed = list(remap)
+    for start in range(0, len(removed), 500):
+        conn.execute(db.delete(TimeSlot).where(TimeSlot.id.in_(removed[start:start + 500])))
+    # 其他 worker 記憶體中的時段索引依版本號失效
+    for teacher_id in {teacher_id for teacher_id, _, _ in groups}:
+        conn.execute(
+            upsert_insert(AvailabilityVersion).values(teacher_id=teacher_id, version=1)
+            .on_conflict_do_update(index_elements=['teacher_id'], set_={'version': AvailabilityVersion.version + 1})
+        )
+
+
+MIGRATIONS = [
+    ('0001_composite_indexes', [
+        'CREATE INDEX IF NOT EXISTS ix_time_slots_teacher_avail_date_time '
+        'ON time_slots (teacher_id, is_available, date, time)',
+        'CREATE INDEX IF NOT EXISTS ix_attendance_student_date ON attendance (student_id, date)',
+        'CREATE INDEX IF NOT EXISTS ix_attendance_date ON attendance (date)',
+        'CREATE INDEX IF NOT EXISTS ix_grades_exam_score ON grades (exam_id, score)',
+        'CREATE INDEX IF NOT EXISTS ix_grades_student_created ON grades (student_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_payments_status_month ON payments (status, month)',
+        'CREATE INDEX IF NOT EXISTS ix_bookings_status_created ON bookings (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_bookings_created ON bookings (created_at)',
+    ]),
+    # 序列起點接在既有編號之後（MU+MMDD+序號、S+YYYYMM+序號）
+    # 聚合 SELECT 必回傳一列，NOT EXISTS 須放在外層查詢才能略過已存在的序號
+    ('0002_seed_sequences', [
+        "INSERT INTO sequences (name, next_value) "
+        "SELECT 'booking_code', seed.next_value FROM ("
+        "SELECT COALESCE(MAX(CAST(SUBSTR(booking_code, 7) AS INTEGER)), 1000) + 1 AS next_value FROM bookings"
+        ") AS seed WHERE NOT EXISTS (SELECT 1 FROM sequences WHERE name = 'booking_code')",
+        "INSERT INTO sequences (name, next_value) "
+        "SELECT 'student_id', seed.next_value FROM ("
+        "SELECT COALESCE(MAX(CAST(SUBSTR(student_id, 8) AS INTEGER)), 1000) + 1 AS next_value FROM students"
+        ") AS seed WHERE NOT EXISTS (SELECT 1 FROM sequences WHERE name = 'student_id')",
+    ]),
+    # 出席統計的覆蓋索引：GROUP BY student_id, status 與日期/課程篩選都不必回表
+    ('0003_attendance_stats_index', [
+        'CREATE INDEX IF NOT EXISTS ix_attendance_student_status '
+        'ON attendance (student_id, status, date, course)',
+    ]),
+    # 財務月結彙總表由 create_all 建立，這裡以既有帳目回填
+    ('0004_finance_rollups', FINANCE_ROLLUP_BACKFILL),
+    ('0005_availability_templates', [_backfill_availability_templates]),
+    ('0006_default_reply_rules', [_seed_reply_rules]),
+    ('0007_unique_time_slots', [
+        _dedupe_time_slots,
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_time_slots_teacher_date_time ON time_slots (teacher_id, date, time)',
+    ]),
+    ('0008_line_retry_keys', [
+        _add_column('line_outbox', 'retry_key', 'VARCHAR(36)'),
+        _backfill_line_retry_keys,
+    ]),
+    ('0009_line_event_claims', [_add_column('line_events', 'claimed_at', 'TIMESTAMP')]),
+]
+
+
+def run_migrations():
+    """套用尚未執行的遷移，回傳本次套用的 id 列表"""
+    applied = {m.id for m in SchemaMigration.query.all()}
+    done = []
+    for migration_id, statements in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        try:
+            with db.engine.begin() as conn:
+                for step in statements:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(db.text(step))
+                conn.execute(
+                    SchemaMigration.__table__.insert().values(id=migration_id, applied_at=datetime.now())
+                )
+        except IntegrityError:
+            # 只有其他 worker 已同時套用（並記錄）同一筆遷移時才略過，其餘錯誤照常拋出
+            db.session.rollback()
+            if db.session.get(SchemaMigration, migration_id) is None:
+                raise
+            continue
+        done.append(migration_id)
+    return done
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """建立缺少的資料表並套用遷移：flask --app app migrate"""
+    db.create_all()
+    done = run_migrations()
+    print(f'✓ 已套用遷移：{", ".join(done)}' if done else '✓ 資料庫結構已是最新')
+
+
 # ─────────────────────────────────────────────
 # 應用程式初始化（適用於 Render/Production）
 # ─────────────────────────────────────────────
@@ -1526,6 +4804,7 @@ def seed():
 with app.app_context():
     try:
         db.create_all()
+        run_migrations()
         print('✓ 資料庫初始化完成')
         # 建立範例資料（如果需要）
         if Teacher.query.count() == 0:
@@ -1545,6 +4824,7 @@ if __name__ == '__main__':
         # 建立所有資料表（包括新增的）
         # 這個指令只會建立不存在的資料表，不會影響已存在的資料表
         db.create_all()
+        run_migrations()
         print('✓ 資料庫已初始化（所有資料表已建立）')
         seed()
     print('\n  學生預約頁面：http://localhost:5000')
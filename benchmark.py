@@ -0,0 +1,299 @@
+"""
+端點效能基準：python benchmark.py --profile large
+
+以 generate_data.py 的負載設定檔產生資料集（第一次執行時產生並快取於 instance/，每天重建一次，
+因為時段與歷史資料以當天為基準），每次執行先複製一份乾淨的資料庫，再以 Flask test client
+依序呼叫熱門端點，量測延遲百分位數（p50 / p95 / p99）與每秒請求數。
+
+結果與 benchmarks/baseline-<profile>.json 比較：p50 或 p95（樣本數足夠時）超過基準值
+×（1 + 門檻），且差距大於 MIN_REGRESSION_MS，即視為退步，列出後以結束碼 1 結束，可直接放進 CI。
+--save-baseline 以本次結果覆寫基準檔。基準值與機器有關，請在同一台機器上產生與比較。
+
+一律使用 instance/ 下的 SQLite 檔案（忽略 DATABASE_URL），不會寫入正式資料庫。
+"""
+
+import gc
+import glob
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+from datetime import datetime, timedelta
+
+import click
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+INSTANCE_DIR = os.path.join(ROOT, 'instance')
+BASELINE_DIR = os.path.join(ROOT, 'benchmarks')
+RUN_DB = os.path.join(INSTANCE_DIR, 'benchmark-run.db')
+# 產生方式改變（如日期時間的儲存格式）時遞增，讓舊的快取資料集失效
+DATASET_VERSION = 2
+
+# 預設退步門檻（相對基準值的比例）與絕對誤差下限（毫秒）
+DEFAULT_THRESHOLD = 0.25
+MIN_REGRESSION_MS = 2.0
+WARMUP_REQUESTS = 3
+# 樣本數少於此值時 p95 幾乎等於最大值、太不穩定，只比較 p50
+MIN_SAMPLES_FOR_P95 = 20
+
+
+# ─────────────────────────────────────────────
+# 量測案例
+# ─────────────────────────────────────────────
+# 每個案例：method、path（str.format 可用 ctx 的欄位與 i）、body(ctx, i)（選填）、
+# status 為預期的狀態碼、requests 為量測次數、threshold 覆寫預設門檻（寫入類較不穩定）。
+# ctx 由 _context() 依資料集準備；寫入類案例每次請求使用不同的時段/學生，互不衝突。
+
+def _booking_body(ctx, i):
+    slot_id, teacher_id = ctx['open_slots'][i]
+    return {
+        'teacher_id': teacher_id,
+        'slot_id': slot_id,
+        'student_name': f'壓測{i}',
+        'student_contact': '0900000000',
+        'courses': ctx['courses'][:1],
+    }
+
+
+def _grade_sheet(ctx, i):
+    # 整份成績單分數輪替，每次都有名次變動
+    return {'grades': [
+        {'student_id': student_id, 'score': (index * 7 + i) % 101}
+        for index, student_id in enumerate(ctx['exam_students'])
+    ]}
+
+
+def _single_grade(ctx, i):
+    return {'exam_id': ctx['exam_id'], 'student_id': ctx['ungraded'][i], 'score': 50 + i % 50}
+
+
+CASES = {
+    'slots_teacher': {'method': 'GET', 'path': '/api/slots?teacher_id={teacher_id}', 'requests': 500},
+    'slots_all': {'method': 'GET', 'path': '/api/slots?days=14', 'requests': 50},
+    'book': {'method': 'POST', 'path': '/api/book', 'body': _booking_body, 'status': 201,
+             'requests': 200, 'threshold': 0.5},
+    # 預約管理頁的分頁列表與課表頁的本週預約
+    'admin_bookings': {'method': 'GET', 'path': '/admin/api/bookings?limit=50', 'requests': 200},
+    'admin_bookings_week': {
+        'method': 'GET', 'requests': 100,
+        'path': '/admin/api/bookings?status=confirmed&date_from={today}&date_to={week_ahead}',
+    },
+    'attendance_stats': {'method': 'GET', 'path': '/admin/api/attendance/stats', 'requests': 10},
+    'attendance_stats_month': {
+        'method': 'GET', 'path': '/admin/api/attendance/stats?date_from={month_ago}', 'requests': 10,
+    },
+    'finance_summary': {'method': 'GET', 'path': '/admin/api/finance/summary', 'requests': 300},
+    'grades_bulk': {'method': 'POST', 'path': '/admin/api/exams/{exam_id}/grades:bulk', 'body': _grade_sheet,
+                    'requests': 20, 'threshold': 0.5},
+    'grade_add': {'method': 'POST', 'path': '/admin/api/grades', 'body': _single_grade, 'status': 201,
+                  'requests': 50, 'threshold': 0.5},
+}
+
+
+def _context(total):
+    """準備各案例需要的參數；total 為各案例最多會用到的筆數（含暖身）"""
+    from app import db, Course, Exam, Grade, Student, Teacher, TimeSlot
+
+    today = datetime.now().date()
+    teacher_id = db.session.execute(
+        db.select(TimeSlot.teacher_id).where(TimeSlot.date > str(today), TimeSlot.is_available.is_(True))
+        .group_by(TimeSlot.teacher_id).order_by(db.func.count().desc()).limit(1)
+    ).scalar()
+    open_slots = db.session.execute(
+        db.select(TimeSlot.id, TimeSlot.teacher_id)
+        .join(Teacher, Teacher.id == TimeSlot.teacher_id)
+        .where(TimeSlot.date > str(today), TimeSlot.is_available.is_(True), Teacher.is_active.is_(True))
+        .order_by(TimeSlot.date, TimeSlot.id).limit(total)
+    ).all()
+    exam_id = db.session.execute(db.select(Exam.id).order_by(Exam.date.desc(), Exam.id.desc()).limit(1)).scalar()
+    exam_students = db.session.execute(
+        db.select(Grade.student_id).where(Grade.exam_id == exam_id).order_by(Grade.student_id)
+    ).scalars().all()
+    ungraded = db.session.execute(
+        db.select(Student.id).where(Student.id.not_in(exam_students)).order_by(Student.id).limit(total)
+    ).scalars().all()
+    return {
+        'today': str(today),
+        'month_ago': str(today - timedelta(days=30)),
+        'week_ahead': str(today + timedelta(days=6)),
+        'month': today.strftime('%Y-%m'),
+        'teacher_id': teacher_id,
+        'open_slots': open_slots,
+        'courses': [c.to_dict() for c in Course.query.filter_by(is_active=True)],
+        'exam_id': exam_id,
+        'exam_students': exam_students,
+        'ungraded': ungraded,
+    }
+
+
+# ─────────────────────────────────────────────
+# 量測與比較
+# ─────────────────────────────────────────────
+
+def _percentile(samples, pct):
+    """最近排名法；samples 須已排序"""
+    return samples[max(0, math.ceil(pct / 100 * len(samples)) - 1)]
+
+
+def run_case(client, headers, ctx, name, case, requests):
+    method, status = case['method'], case.get('status', 200)
+    latencies = []
+    started = None
+    gc.collect()
+    for i in range(WARMUP_REQUESTS + requests):
+        if i == WARMUP_REQUESTS:
+            started = time.perf_counter()
+        path = case['path'].format(i=i, **ctx)
+        body = case['body'](ctx, i) if 'body' in case else None
+        begin = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers=headers)
+        elapsed = time.perf_counter() - begin
+        if response.status_code != status:
+            raise click.ClickException(
+                f'{name}: {method} {path} 回傳 {response.status_code}（預期 {status}）：'
+                f'{response.get_data(as_text=True)[:200]}'
+            )
+        if i >= WARMUP_REQUESTS:
+            latencies.append(elapsed * 1000)
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': requests,
+        'p50_ms': round(_percentile(latencies, 50), 3),
+        'p95_ms': round(_percentile(latencies, 95), 3),
+        'p99_ms': round(_percentile(latencies, 99), 3),
+        'mean_ms': round(sum(latencies) / requests, 3),
+        'rps': round(requests / wall, 1),
+    }
+
+
+def compare(results, baseline, threshold):
+    """回傳退步項目 [(案例, 指標, 基準值, 本次值)]；基準檔沒有的案例略過"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        limit = CASES[name].get('threshold', threshold)
+        metrics = ('p50_ms', 'p95_ms') if result['requests'] >= MIN_SAMPLES_FOR_P95 else ('p50_ms',)
+        for metric in metrics:
+            before, now = base[metric], result[metric]
+            if now > before * (1 + limit) and now - before > MIN_REGRESSION_MS:
+                regressions.append((name, metric, before, now))
+    return regressions
+
+
+def _prepare_database(profile, seed_value):
+    """
+    準備本次執行的資料庫。資料集依（設定檔、種子、日期）快取：已快取時複製一份並回傳 None，
+    否則回傳快取檔路徑，由呼叫端在匯入 app 後產生資料再存成快取。
+    """
+    os.makedirs(INSTANCE_DIR, exist_ok=True)
+    for path in glob.glob(RUN_DB + '*'):
+        os.remove(path)
+    dataset = os.path.join(
+        INSTANCE_DIR, f'benchmark-{profile}-{seed_value}-v{DATASET_VERSION}-{datetime.now():%Y%m%d}.db'
+    )
+    for stale in glob.glob(os.path.join(INSTANCE_DIR, f'benchmark-{profile}-{seed_value}-*.db')):
+        if stale != dataset:
+            os.remove(stale)
+    if os.path.exists(dataset):
+        shutil.copyfile(dataset, RUN_DB)
+        return None
+    return dataset
+
+
+def _print_table(results, baseline):
+    print(f'\n{"案例":<26}{"次數":>6}{"p50":>10}{"p95":>10}{"p99":>10}{"req/s":>9}{"基準 p95":>11}')
+    for name, r in results.items():
+        base = baseline.get(name, {}).get('p95_ms')
+        base = f'{base:>10.2f}' if base is not None else f'{"-":>10}'
+        print(f'{name:<26}{r["requests"]:>6}{r["p50_ms"]:>10.2f}{r["p95_ms"]:>10.2f}'
+              f'{r["p99_ms"]:>10.2f}{r["rps"]:>9.1f} {base}')
+
+
+@click.command()
+@click.option('--profile', type=click.Choice(['small', 'medium', 'large']), default='large', show_default=True,
+              help='資料集的負載設定檔（見 generate_data.py）')
+@click.option('--seed', 'seed_value', type=int, default=42, show_default=True, help='資料集亂數種子')
+@click.option('--case', 'only', multiple=True, type=click.Choice(list(CASES)), help='只量測指定案例（可重複）')
+@click.option('--requests', 'scale', type=float, default=1.0, show_default=True, help='各案例量測次數的倍數')
+@click.option('--threshold', type=float, default=DEFAULT_THRESHOLD, show_default=True,
+              help='退步門檻（相對基準值的比例）')
+@click.option('--baseline', 'baseline_path', type=click.Path(dir_okay=False), help='基準檔路徑')
+@click.option('--save-baseline', is_flag=True, help='以本次結果覆寫基準檔')
+@click.option('--output', type=click.Path(dir_okay=False), help='另存本次結果')
+def main(profile, seed_value, only, scale, threshold, baseline_path, save_baseline, output):
+    """量測熱門端點的延遲與吞吐量，並與基準比較"""
+    dataset = _prepare_database(profile, seed_value)
+    os.environ.pop('DATABASE_URL', None)
+    os.environ['SQLITE_PATH'] = RUN_DB
+    os.environ['LINE_SENDER_THREAD'] = '0'
+
+    # app 在匯入時依環境變數連線，須在設定好 SQLITE_PATH 之後才匯入
+    from app import app, db, ADMIN_PASSWORD
+    from generate_data import PROFILES, Generator
+
+    with app.app_context():
+        if dataset:
+            print(f'產生資料集：{profile}（seed={seed_value}），之後同一天會重複使用')
+            Generator(PROFILES[profile], random.Random(seed_value)).run()
+            db.session.execute(db.text('PRAGMA wal_checkpoint(TRUNCATE)'))
+            db.session.commit()
+            db.engine.dispose()
+            shutil.copyfile(RUN_DB, dataset)
+
+        cases = {name: case for name, case in CASES.items() if not only or name in only}
+        counts = {name: max(1, round(case['requests'] * scale)) for name, case in cases.items()}
+        ctx = _context(WARMUP_REQUESTS + max(counts.values()))
+        client = app.test_client()
+        headers = {'X-Admin-Password': ADMIN_PASSWORD}
+        results = {}
+        for name, case in cases.items():
+            results[name] = run_case(client, headers, ctx, name, case, counts[name])
+            print(f'  {name:<26} p95 {results[name]["p95_ms"]:>9.2f} ms')
+        db.engine.dispose()
+
+    baseline_path = baseline_path or os.path.join(BASELINE_DIR, f'baseline-{profile}.json')
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    _print_table(results, baseline)
+
+    report = {
+        'profile': profile,
+        'seed': seed_value,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'\n✓ 已寫入基準檔：{os.path.relpath(baseline_path, ROOT)}')
+        return
+    if not baseline:
+        print(f'\n尚無基準檔（{os.path.relpath(baseline_path, ROOT)}），以 --save-baseline 建立')
+        return
+
+    regressions = compare(results, baseline, threshold)
+    if regressions:
+        print('\n✗ 效能退步：')
+        for name, metric, before, now in regressions:
+            print(f'  {name} {metric}: {before:.2f} → {now:.2f} ms（+{(now / before - 1) * 100:.0f}%）')
+        sys.exit(1)
+    print('\n✓ 沒有超過門檻的退步')
+
+
+if __name__ == '__main__':
+    main()
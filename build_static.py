@@ -0,0 +1,314 @@
+"""
+靜態頁面建置：python build_static.py
+
+把 static/ 下每個頁面的內嵌 <style>/<script> 抽成帶內容雜湊檔名的外部檔，
+多頁共用的部分另外打包成 common.*.css / common.*.js，全部縮小後預先壓縮成 .gz（與 .br），
+輸出到 dist/。app.py 讀取 dist/manifest.json 依 Accept-Encoding 回傳壓縮版本，
+帶雜湊的資源以 Cache-Control: immutable 長期快取，頁面本身則以 ETag 重新驗證。
+
+Brotli 為選用：未安裝 brotli 套件時只產生 gzip。
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(ROOT, 'static')
+DIST_DIR = os.path.join(ROOT, 'dist')
+
+# 出現在至少這麼多頁的相同函式才放進共用 JS
+SHARED_JS_MIN_PAGES = 2
+# 壓縮後至少要小這麼多才保留壓縮版本
+MIN_COMPRESSION_GAIN = 0.9
+
+STYLE_RE = re.compile(r'<style>(.*?)</style>', re.S)
+SCRIPT_RE = re.compile(r'<script>(.*?)</script>', re.S)
+# 頁面的 JS 慣例：頂層函式從行首 function 開始，到行首的 } 結束
+FUNCTION_RE = re.compile(r'^(?:async )?function \w+\(.*?^\}\n?', re.S | re.M)
+PRESERVE_RE = re.compile(r'(<(pre|textarea)\b.*?</\2>)', re.S | re.I)
+
+# 在這些字元之後的 / 是正規表示式而不是除號
+REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%~^<>\n')
+REGEX_KEYWORD_RE = re.compile(r'\b(?:return|typeof|case|in|of)\s*$')
+
+
+# ─────────────────────────────────────────────
+# 縮小
+# ─────────────────────────────────────────────
+
+def minify_css(css):
+    """移除註解與多餘空白"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """
+    移除註解、行首縮排與空行，連續空白縮成一個。
+    字串、樣板字串與正規表示式原樣保留；換行保留，避免影響自動補分號。
+    """
+    out = []
+    # 模式堆疊：'code' 或 'template'；code 模式記錄 { 深度以辨識 ${...} 的結尾
+    modes = [['code', 0]]
+    i, n = 0, len(js)
+
+    def last_significant():
+        for ch in reversed(out):
+            for c in reversed(ch):
+                if c not in ' \t':
+                    return c
+        return '\n'
+
+    while i < n:
+        c = js[i]
+        mode = modes[-1]
+        if mode[0] == 'template':
+            if c == '\\':
+                out.append(js[i:i + 2])
+                i += 2
+            elif c == '`':
+                out.append(c)
+                modes.pop()
+                i += 1
+            elif js.startswith('${', i):
+                out.append('${')
+                modes.append(['code', 0])
+                i += 2
+            else:
+                out.append(c)
+                i += 1
+            continue
+
+        if c in '\'"':
+            j = i + 1
+            while j < n and js[j] != c:
+                j += 2 if js[j] == '\\' else 1
+            out.append(js[i:j + 1])
+            i = j + 1
+        elif c == '`':
+            out.append(c)
+            modes.append(['template', 0])
+            i += 1
+        elif js.startswith('//', i):
+            while i < n and js[i] != '\n':
+                i += 1
+        elif js.startswith('/*', i):
+            end = js.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            out.append('\n' if '\n' in js[i:end] else ' ')
+            i = end
+        elif c == '/' and (last_significant() in REGEX_PRECEDERS or REGEX_KEYWORD_RE.search(''.join(out[-8:]))):
+            j, in_class = i + 1, False
+            while j < n and (in_class or js[j] != '/') and js[j] != '\n':
+                if js[j] == '\\':
+                    j += 1
+                elif js[j] == '[':
+                    in_class = True
+                elif js[j] == ']':
+                    in_class = False
+                j += 1
+            out.append(js[i:j + 1])
+            i = j + 1
+        elif c in ' \t\r\n':
+            j = i
+            while j < n and js[j] in ' \t\r\n':
+                j += 1
+            newline = '\n' in js[i:j]
+            while out and out[-1] in (' ', '\n'):
+                newline = out.pop() == '\n' or newline
+            if out:
+                out.append('\n' if newline else ' ')
+            i = j
+        else:
+            if c == '{':
+                mode[1] += 1
+            elif c == '}':
+                if mode[1] == 0 and len(modes) > 1:
+                    # ${...} 結束，回到樣板字串
+                    modes.pop()
+                else:
+                    mode[1] -= 1
+            out.append(c)
+            i += 1
+    return ''.join(out).strip()
+
+
+def minify_html(html):
+    """移除 HTML 註解、行首縮排與空行（<pre>、<textarea> 內容不動）"""
+    parts = PRESERVE_RE.split(html)
+    result = []
+    # split 後依序為：一般內容、保留區塊、標籤名、一般內容……
+    for index in range(0, len(parts), 3):
+        chunk = re.sub(r'<!--.*?-->', '', parts[index], flags=re.S)
+        chunk = '\n'.join(line.strip() for line in chunk.splitlines() if line.strip())
+        result.append(chunk)
+        if index + 1 < len(parts):
+            result.append(parts[index + 1])
+    return ''.join(result)
+
+
+# ─────────────────────────────────────────────
+# 共用程式碼
+# ─────────────────────────────────────────────
+
+def css_rules(css):
+    """依頂層大括號切出規則（@media 等巢狀區塊視為一條）"""
+    rules, depth, start = [], 0, 0
+    for i, c in enumerate(css):
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                rules.append(css[start:i + 1])
+                start = i + 1
+    return rules
+
+
+def shared_css_prefix(pages):
+    """
+    所有頁面第一個 <style> 開頭都相同的規則。
+    只取共同前綴：規則在各頁原本就排在最前面，移到先載入的共用檔不會改變層疊順序，
+    也不會把某頁沒有的規則套用到該頁。
+    """
+    sheets = []
+    for html in pages.values():
+        match = STYLE_RE.search(html)
+        if not match:
+            return []
+        sheets.append(css_rules(minify_css(match.group(1))))
+    prefix = []
+    for rules in zip(*sheets):
+        if len(set(rules)) != 1:
+            break
+        prefix.append(rules[0])
+    return prefix
+
+
+def shared_functions(pages):
+    """在多頁中逐字相同的頂層函式，依首次出現順序"""
+    seen = {}
+    for html in pages.values():
+        for script in SCRIPT_RE.findall(html):
+            for fn in set(FUNCTION_RE.findall(script)):
+                seen.setdefault(fn.rstrip('\n'), []).append(html)
+    return [fn for fn, where in seen.items() if len(where) >= SHARED_JS_MIN_PAGES]
+
+
+# ─────────────────────────────────────────────
+# 輸出
+# ─────────────────────────────────────────────
+
+def _write(files, relpath, content):
+    """寫入檔案與其預先壓縮版本，記錄 ETag 與可用的編碼"""
+    data = content.encode('utf-8')
+    path = os.path.join(DIST_DIR, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    encodings = []
+    variants = [('gzip', '.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli:
+        variants.insert(0, ('br', '.br', lambda d: brotli.compress(d, quality=11)))
+    for encoding, suffix, compress in variants:
+        packed = compress(data)
+        if len(packed) < len(data) * MIN_COMPRESSION_GAIN:
+            with open(path + suffix, 'wb') as f:
+                f.write(packed)
+            encodings.append(encoding)
+    files[relpath] = {
+        'etag': hashlib.sha256(data).hexdigest()[:16],
+        'encodings': encodings,
+        'size': len(data),
+    }
+
+
+def _asset(files, name, ext, content):
+    """寫入帶內容雜湊的資源檔，回傳網址"""
+    digest = hashlib.sha256(content.encode('utf-8')).hexdigest()[:10]
+    relpath = f'assets/{name}.{digest}.{ext}'
+    _write(files, relpath, content)
+    return '/' + relpath
+
+
+def build():
+    pages = {}
+    for filename in sorted(os.listdir(SOURCE_DIR)):
+        if filename.endswith('.html'):
+            with open(os.path.join(SOURCE_DIR, filename), encoding='utf-8') as f:
+                pages[filename] = f.read()
+
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    files = {}
+    common_css = shared_css_prefix(pages)
+    common_fns = shared_functions(pages)
+    common_css_url = _asset(files, 'common', 'css', ''.join(common_css)) if common_css else None
+    common_js_url = _asset(files, 'common', 'js', minify_js('\n'.join(common_fns))) if common_fns else None
+
+    manifest_pages = {}
+    for filename, html in pages.items():
+        name = filename[:-len('.html')]
+        counter = {'style': 0, 'script': 0}
+
+        def replace_style(match):
+            counter['style'] += 1
+            rules = css_rules(minify_css(match.group(1)))
+            links = []
+            if counter['style'] == 1 and common_css_url:
+                rules = rules[len(common_css):]
+                links.append(common_css_url)
+            if rules:
+                suffix = '' if counter['style'] == 1 else f'-{counter["style"]}'
+                links.append(_asset(files, name + suffix, 'css', ''.join(rules)))
+            return ''.join(f'<link rel="stylesheet" href="{url}">' for url in links)
+
+        def replace_script(match):
+            counter['script'] += 1
+            script = match.group(1)
+            tags = []
+            used = [fn for fn in common_fns if fn in script]
+            for fn in used:
+                script = script.replace(fn, '')
+            if used and counter['script'] == 1:
+                tags.append(common_js_url)
+            elif used:
+                # 共用函式不在第一段 script：保留原樣，不拆出
+                script = match.group(1)
+            script = minify_js(script)
+            if script:
+                suffix = '' if counter['script'] == 1 else f'-{counter["script"]}'
+                tags.append(_asset(files, name + suffix, 'js', script))
+            return ''.join(f'<script src="{url}"></script>' for url in tags)
+
+        html = STYLE_RE.sub(replace_style, html)
+        html = SCRIPT_RE.sub(replace_script, html)
+        relpath = f'pages/{filename}'
+        _write(files, relpath, minify_html(html))
+        manifest_pages[filename] = relpath
+
+    manifest = {'built_at': time.time(), 'pages': manifest_pages, 'files': files}
+    with open(os.path.join(DIST_DIR, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return pages, files
+
+
+if __name__ == '__main__':
+    sources, built = build()
+    raw = sum(len(html.encode('utf-8')) for html in sources.values())
+    minified = sum(info['size'] for info in built.values())
+    print(f'✓ 已建置 {len(sources)} 個頁面、{len(built) - len(sources)} 個資源檔')
+    print(f'  原始 {raw / 1024:.1f} KB → 縮小後 {minified / 1024:.1f} KB'
+          f'（壓縮格式：{"br, gzip" if brotli else "gzip"}）')
@@ -0,0 +1,460 @@
+"""
+測試資料產生器：python generate_data.py --profile large --seed 42
+
+以 seed() 的範例資料為基礎，依負載設定檔產生大量、擬真的資料（老師、學生、預約、
+出席、繳費、支出、考試成績），供效能測試與壓力測試使用。
+全部以 Core executemany 分批寫入，不建立 ORM 物件；寫完帳目後重算財務月結彙總，
+時段異動則遞增老師的版本號，與正常請求寫入後的狀態一致。
+
+同一個 --seed 在同一天產生相同的資料（日期以今天為基準往前推算歷史、往後展開時段）。
+資料庫沿用 app.py 的設定，建議以 SQLITE_PATH 指向另一個檔案，避免混入正式資料：
+
+    SQLITE_PATH=/tmp/load.db python generate_data.py --profile large
+"""
+
+import itertools
+import math
+import random
+import time
+from datetime import date, datetime, timedelta
+
+import click
+
+from app import (
+    app, db, seed, run_migrations, materialize_slots, rebuild_finance_rollups,
+    bump_availability, availability_index, booking_code_seq, student_id_seq,
+    _calculate_ranks, ATTENDANCE_STATUSES, PAYMENT_STATUSES,
+    Teacher, AvailabilityTemplate, TimeSlot, Course, Student, Payment, Expense,
+    Attendance, Exam, Grade, Booking,
+)
+
+# 每次 executemany 的筆數
+INSERT_BATCH_SIZE = 10000
+
+# 負載設定檔：各資料表的目標筆數與歷史年數
+PROFILES = {
+    'small': {
+        'teachers': 10, 'students': 500, 'bookings': 5000, 'attendance': 20000,
+        'years': 1, 'exams': 8, 'exam_size': 100, 'future_booked': 0.3,
+    },
+    'medium': {
+        'teachers': 25, 'students': 5000, 'bookings': 50000, 'attendance': 300000,
+        'years': 2, 'exams': 40, 'exam_size': 500, 'future_booked': 0.4,
+    },
+    'large': {
+        'teachers': 50, 'students': 20000, 'bookings': 500000, 'attendance': 2000000,
+        'years': 3, 'exams': 120, 'exam_size': 1000, 'future_booked': 0.5,
+    },
+}
+
+SURNAMES = '陳林黃張李王吳劉蔡楊許鄭謝洪郭邱曾廖賴徐周葉蘇莊呂江何蕭羅高潘簡朱鍾彭游詹胡施沈余盧梁趙顏柯翁魏孫戴'
+GIVEN_NAMES = [
+    '雅婷', '建宏', '怡婷', '家豪', '志明', '淑芬', '俊傑', '美玲', '宗翰', '欣怡', '冠宇', '佳穎', '承恩', '詩涵',
+    '柏翰', '宜蓁', '品妤', '子晴', '宥廷', '思妤', '彥廷', '雨萱', '睿恩', '芷若', '宇軒', '沛珊', '安妮', '書豪',
+]
+INSTRUMENTS = ['鋼琴', '吉他', '小提琴', '大提琴', '長笛', '爵士鼓', '聲樂', '烏克麗麗', '薩克斯風', '電貝斯']
+LEVELS = ['初學', '初級', '中級', '高級']
+LESSON_TIMES = ['09:00', '10:00', '11:00', '13:00', '14:00', '15:00', '16:00', '17:00', '18:00', '19:00', '20:00']
+PAYMENT_METHODS = ['cash', 'transfer', 'credit_card']
+# 各狀態依出現比例展開的抽樣池（與 ATTENDANCE_STATUSES / PAYMENT_STATUSES 對應）
+ATTENDANCE_POOL = [s for s, weight in zip(ATTENDANCE_STATUSES, (82, 10, 5, 3)) for _ in range(weight)]
+PAYMENT_POOL = [s for s, weight in zip(PAYMENT_STATUSES, (90, 8, 2)) for _ in range(weight)]
+# (類別, 說明, 每月筆數, 金額下限, 金額上限)
+EXPENSE_ITEMS = [
+    ('租金', '教室租金', 1, 80000, 120000),
+    ('薪資', '老師鐘點費', 20, 8000, 40000),
+    ('水電', '水電瓦斯', 2, 3000, 9000),
+    ('設備', '樂器維修與耗材', 4, 500, 15000),
+    ('行銷', '廣告與活動', 3, 2000, 20000),
+    ('雜支', '文具與清潔', 6, 100, 3000),
+]
+EXAM_NAMES = ['期中檢定', '期末檢定', '樂理測驗', '視唱測驗', '術科考核', '模擬考']
+
+
+def _batches(rows, size=INSERT_BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _bulk_insert(model, rows):
+    """
+    分批寫入，單一交易提交；回傳新增筆數。
+    INSERT 只編譯一次，參數直接交給資料庫驅動程式 executemany，只有需要轉換的欄位
+    （如 SQLite 的 DateTime）經過型別處理；欄位預設值不會套用，rows 須列出所有欄位。
+    型別處理須取方言實作（dialect_impl）：通用的 db.DateTime 本身沒有 bind_processor，
+    直接交給 sqlite3 會存成沒有微秒的文字，與 ORM 寫入的格式不同（見 _check_datetime_text）。
+    次要索引在寫入前移除、寫完後重建（同一交易內，失敗時一併 rollback）。
+    """
+    table = model.__table__
+    count = 0
+    with db.engine.begin() as conn:
+        for index in table.indexes:
+            index.drop(conn)
+        for batch in _batches(rows):
+            if not count:
+                dialect = conn.dialect
+                compiled = db.insert(model).compile(dialect=dialect, column_keys=list(batch[0]))
+                keys = compiled.positiontup if dialect.positional else list(batch[0])
+                processors = [(key, table.c[key].type.dialect_impl(dialect).bind_processor(dialect)) for key in keys]
+            params = [
+                tuple([process(row[key]) if process else row[key] for key, process in processors])
+                for row in batch
+            ]
+            if not dialect.positional:
+                params = [dict(zip(keys, values)) for values in params]
+            conn.exec_driver_sql(compiled.string, params)
+            count += len(batch)
+        for index in table.indexes:
+            index.create(conn)
+    return count
+
+
+def _check_datetime_text():
+    """
+    確認批次寫入的 DateTime 與 ORM 寫入的文字完全相同。SQLite 以文字比較日期時間，
+    格式不同（如少了 .000000）時 keyset 分頁的 cursor 邊界列會在下一頁重複出現。
+    """
+    raw = db.cast(Student.created_at, db.String)
+    generated = db.session.execute(db.select(raw).where(Student.created_at.isnot(None)).limit(1)).scalar()
+    if generated is None:
+        return
+    db.session.commit()
+    student = Student(student_id='CHECK', name='格式檢查', contact='-', created_at=datetime.fromisoformat(generated))
+    db.session.add(student)
+    db.session.flush()
+    written = db.session.execute(db.select(raw).where(Student.id == student.id)).scalar()
+    db.session.rollback()   # 只為取得 ORM 寫入的文字，不保留這一列
+    if written != generated:
+        raise click.ClickException(f'產生的日期時間格式 {generated!r} 與 ORM 寫入的 {written!r} 不同')
+
+
+def _new_ids(model, after):
+    """依寫入順序取回 id 大於 after 的新資料 id"""
+    return db.session.execute(db.select(model.id).where(model.id > after).order_by(model.id)).scalars().all()
+
+
+def _max_id(model):
+    return db.session.execute(db.select(db.func.max(model.id))).scalar() or 0
+
+
+def _name(rng):
+    return rng.choice(SURNAMES) + rng.choice(GIVEN_NAMES)
+
+
+def _phone(rng):
+    return '09' + ''.join(rng.choices('0123456789', k=8))
+
+
+def _moment(rng, day):
+    """day 當天營業時間內（09:00～21:00）的隨機時刻"""
+    return datetime(day.year, day.month, day.day, 9) + timedelta(minutes=int(rng.random() * 720))
+
+
+class Generator:
+    """依設定檔與亂數種子依序產生各資料表；後面的資料表參照前面產生的 id"""
+
+    def __init__(self, profile, rng):
+        self.profile = profile
+        self.rng = rng
+        self.today = datetime.now().date()
+        self.start = self.today - timedelta(days=365 * profile['years'])
+        self.counts = {}
+
+    def run(self):
+        for step in (self.teachers, self.students, self.bookings, self.attendance,
+                     self.payments, self.expenses, self.grades):
+            started = time.perf_counter()
+            name, count = step()
+            self.counts[name] = count
+            print(f'  {name:<11} {count:>9,} 筆  {time.perf_counter() - started:6.1f}s')
+        _check_datetime_text()
+        return self.counts
+
+    def _day(self, start=None, end=None):
+        """start ~ end（預設歷史起點～昨天）之間的隨機日期"""
+        start = start or self.start
+        end = end or self.today - timedelta(days=1)
+        return start + timedelta(days=self.rng.randrange((end - start).days + 1))
+
+    def teachers(self):
+        rng = self.rng
+        existing = db.session.query(db.func.count(Teacher.id)).scalar()
+        after = _max_id(Teacher)
+        _bulk_insert(Teacher, ({
+            'name': _name(rng),
+            'instrument': rng.choice(INSTRUMENTS),
+            'bio': f'音樂系畢業，{rng.randint(2, 20)}年教學資歷。',
+            'hourly_rate': rng.choice([800, 1000, 1200, 1500, 1800]),
+            'is_active': rng.random() < 0.9,
+        } for _ in range(max(self.profile['teachers'] - existing, 0))))
+        new_ids = _new_ids(Teacher, after)
+        # 新老師的每週固定時段：週一～週六各 4～8 個
+        templates = []
+        for teacher_id in new_ids:
+            for weekday in range(6):
+                for t in sorted(rng.sample(LESSON_TIMES, rng.randint(4, 8))):
+                    templates.append({'teacher_id': teacher_id, 'weekday': weekday, 'time': t})
+        _bulk_insert(AvailabilityTemplate, templates)
+        materialize_slots(new_ids)
+        self.teacher_ids = db.session.execute(
+            db.select(Teacher.id).where(Teacher.is_active.is_(True))
+        ).scalars().all()
+        self.courses = [c.to_dict() for c in Course.query.filter_by(is_active=True)]
+        return 'teachers', len(new_ids)
+
+    def students(self):
+        rng = self.rng
+        count = self.profile['students']
+        numbers = student_id_seq.reserve(count)
+        self.enrolled = []
+        rows = []
+        for number in numbers:
+            enrolled = _moment(rng, self._day())
+            self.enrolled.append(enrolled.date())
+            age = rng.randint(5, 60)
+            rows.append({
+                'student_id': 'S' + enrolled.strftime('%Y%m') + str(number),
+                'name': _name(rng),
+                'contact': _phone(rng),
+                'email': f'student{number}@example.com',
+                'age': age,
+                'level': rng.choice(LEVELS),
+                'instrument': rng.choice(INSTRUMENTS),
+                'parent_name': _name(rng) if age < 18 else '',
+                'parent_contact': _phone(rng) if age < 18 else '',
+                'address': '',
+                'note': '',
+                'enrollment_date': enrolled,
+                'is_active': rng.random() < 0.85,
+                'created_at': enrolled,
+            })
+        after = _max_id(Student)
+        _bulk_insert(Student, rows)
+        self.student_ids = _new_ids(Student, after)
+        return 'students', count
+
+    def bookings(self):
+        """過去的預約各配一個已過期的時段；未來的時段依 future_booked 比例預約"""
+        rng = self.rng
+        capacity = len(self.teacher_ids) * (self.today - self.start).days * len(LESSON_TIMES)
+        past = min(int(self.profile['bookings'] * 0.9), capacity)
+        slot_after = _max_id(TimeSlot)
+        # (老師, 日期, 時間) 在 time_slots 上唯一，抽到重複的鍵就重抽
+        keys = {}
+        while len(keys) < past:
+            keys.setdefault((rng.choice(self.teacher_ids), self._day(), rng.choice(LESSON_TIMES)), rng.random() < 0.92)
+        _bulk_insert(TimeSlot, ({
+            'teacher_id': teacher_id, 'date': str(day), 'time': t, 'is_available': not confirmed,
+        } for (teacher_id, day, t), confirmed in keys.items()))
+        past_slots = list(zip(_new_ids(TimeSlot, slot_after),
+                              ((teacher_id, day, confirmed) for (teacher_id, day, _), confirmed in keys.items())))
+
+        # 未來時段（materialize_slots 已展開）
+        future = db.session.execute(
+            db.select(TimeSlot.id, TimeSlot.teacher_id, TimeSlot.date, TimeSlot.time)
+            .where(TimeSlot.date > str(self.today), TimeSlot.is_available.is_(True))
+            .order_by(TimeSlot.id)
+        ).all()
+        taken = rng.sample(future, min(int(len(future) * self.profile['future_booked']),
+                                       self.profile['bookings'] - past))
+        with db.engine.begin() as conn:
+            for batch in _batches(taken, 500):
+                conn.execute(
+                    db.update(TimeSlot).where(TimeSlot.id.in_([slot_id for slot_id, *_ in batch]))
+                    .values(is_available=False)
+                )
+        for teacher_id in {teacher_id for _, teacher_id, _, _ in taken}:
+            bump_availability(teacher_id)
+        db.session.commit()
+        for teacher_id in self.teacher_ids:
+            availability_index.invalidate(teacher_id)
+
+        entries = [(slot_id, (teacher_id, date.fromisoformat(day), True)) for slot_id, teacher_id, day, _ in taken]
+        numbers = booking_code_seq.reserve(len(past_slots) + len(entries))
+        # 選課組合：單堂為主，部分預約同時選兩門（預先編碼 JSON）
+        choices = [[course] for course in self.courses] * 3 + [
+            list(pair) for pair in itertools.combinations(self.courses, 2)
+        ]
+        choices = [(app.json.dumps(courses), sum(c['price'] for c in courses)) for courses in choices]
+
+        def rows():
+            for number, (slot_id, (teacher_id, lesson, confirmed)) in zip(numbers, past_slots + entries):
+                created = _moment(rng, min(lesson - timedelta(days=rng.randint(1, 21)), self.today))
+                courses_json, total_price = rng.choice(choices)
+                yield {
+                    'booking_code': 'MU' + created.strftime('%m%d') + str(number),
+                    'teacher_id': teacher_id,
+                    'slot_id': slot_id,
+                    'student_name': _name(rng),
+                    'student_contact': _phone(rng),
+                    'student_age': str(rng.randint(5, 60)),
+                    'student_level': rng.choice(LEVELS),
+                    'student_note': '',
+                    'courses_json': courses_json,
+                    'total_price': total_price,
+                    'status': 'confirmed' if confirmed else 'cancelled',
+                    'created_at': created,
+                }
+        return 'bookings', _bulk_insert(Booking, rows())
+
+    def attendance(self):
+        """
+        學生自入學起每週上固定的課，總筆數依在學週數比例分配；
+        目標筆數超過每人每週一堂時，每人同時修多門課（同一學生、日期、課程只有一筆）。
+        """
+        rng = self.rng
+        weeks = [(self.today - enrolled).days // 7 for enrolled in self.enrolled]
+        per_week = self.profile['attendance'] / max(sum(weeks), 1)
+        per_course = min(math.ceil(per_week), len(self.courses))
+        course_names = [c['name'] for c in self.courses]
+
+        def rows():
+            for student_id, enrolled, available in zip(self.student_ids, self.enrolled, weeks):
+                lessons = min(round(available * per_week), available * per_course)
+                # 各門課的名稱與上課時間
+                schedule = [
+                    (course, int(rng.choice(LESSON_TIMES)[:2]) * 60)
+                    for course in rng.sample(course_names, per_course)
+                ]
+                first = datetime(enrolled.year, enrolled.month, enrolled.day)
+                for lesson in range(lessons):
+                    course, start_minutes = schedule[lesson % per_course]
+                    status = rng.choice(ATTENDANCE_POOL)
+                    late = 1 + int(rng.random() * 30) if status == 'late' else 0
+                    minutes = start_minutes + late - (int(rng.random() * 11) if status == 'present' else 0)
+                    # 打卡時刻即建立時間
+                    checked = first + timedelta(days=7 * (lesson // per_course), minutes=minutes)
+                    yield {
+                        'student_id': student_id,
+                        'date': checked.date().isoformat(),
+                        'check_time': f'{minutes // 60:02d}:{minutes % 60:02d}',
+                        'status': status,
+                        'late_minutes': late,
+                        'course': course,
+                        'note': '',
+                        'created_at': checked,
+                    }
+        return 'attendance', _bulk_insert(Attendance, rows())
+
+    def payments(self):
+        """在學期間每月一筆學費"""
+        rng = self.rng
+        month_end = self.today.replace(day=1)
+
+        def rows():
+            for student_id, enrolled in zip(self.student_ids, self.enrolled):
+                fee = rng.choice([c['price'] for c in self.courses]) * 4
+                method = rng.choice(PAYMENT_METHODS)
+                month = enrolled.replace(day=1)
+                while month <= month_end:
+                    paid = _moment(rng, month + timedelta(days=rng.randint(0, 9)))
+                    yield {
+                        'student_id': student_id,
+                        'amount': fee,
+                        'payment_date': paid,
+                        'payment_method': method,
+                        'status': rng.choice(PAYMENT_POOL),
+                        'month': month.strftime('%Y-%m'),
+                        'note': '',
+                        'created_at': paid,
+                    }
+                    month = (month + timedelta(days=32)).replace(day=1)
+        count = _bulk_insert(Payment, rows())
+        return 'payments', count
+
+    def expenses(self):
+        rng = self.rng
+
+        def rows():
+            month = self.start.replace(day=1)
+            while month <= self.today:
+                for category, description, per_month, low, high in EXPENSE_ITEMS:
+                    for _ in range(per_month):
+                        spent = _moment(rng, month + timedelta(days=rng.randint(0, 27)))
+                        yield {
+                            'category': category,
+                            'amount': rng.randrange(low, high, 10),
+                            'expense_date': spent,
+                            'description': description,
+                            'note': '',
+                            'created_at': spent,
+                        }
+                month = (month + timedelta(days=32)).replace(day=1)
+        count = _bulk_insert(Expense, rows())
+        rebuild_finance_rollups()
+        return 'expenses', count
+
+    def grades(self):
+        """考試依日期平均分布，每次抽 exam_size 位學生應考；寫完後逐次計算排名與趨勢"""
+        rng = self.rng
+        total = self.profile['exams']
+        span = (self.today - self.start).days
+        after = _max_id(Exam)
+        _bulk_insert(Exam, ({
+            'name': f'{rng.choice(EXAM_NAMES)} #{index + 1}',
+            'date': str(self.start + timedelta(days=span * (index + 1) // (total + 1))),
+            'max_score': 100,
+            'pass_score': 60,
+            'created_at': datetime.combine(self.start, datetime.min.time()),
+        } for index in range(total)))
+        exams = db.session.execute(
+            db.select(Exam.id, Exam.date).where(Exam.id > after).order_by(Exam.id)
+        ).all()
+        size = min(self.profile['exam_size'], len(self.student_ids))
+        # 每位學生有固定的程度，各次成績在其附近起伏，趨勢才有意義
+        ability = {student_id: rng.gauss(72, 12) for student_id in self.student_ids}
+
+        def rows():
+            for exam_id, exam_date in exams:
+                graded = datetime.strptime(exam_date, '%Y-%m-%d') + timedelta(days=3)
+                for student_id in rng.sample(self.student_ids, size):
+                    yield {
+                        'exam_id': exam_id,
+                        'student_id': student_id,
+                        'score': max(0, min(100, round(rng.gauss(ability[student_id], 8)))),
+                        'rank': None,
+                        'trend': None,
+                        'note': '',
+                        'created_at': graded,
+                    }
+        count = _bulk_insert(Grade, rows())
+        for exam_id, _ in exams:
+            _calculate_ranks(exam_id)
+        db.session.commit()
+        return 'grades', count
+
+
+@click.command()
+@click.option('--profile', type=click.Choice(list(PROFILES)), default='small', show_default=True,
+              help='負載設定檔')
+@click.option('--seed', 'seed_value', type=int, default=42, show_default=True, help='亂數種子')
+@click.option('--reset', is_flag=True, help='先刪除資料庫中所有資料表再重建')
+@click.option('--teachers', type=int, help='覆寫老師人數')
+@click.option('--students', type=int, help='覆寫學生人數')
+@click.option('--bookings', type=int, help='覆寫預約筆數')
+@click.option('--attendance', type=int, help='覆寫出席筆數')
+@click.option('--years', type=int, help='覆寫歷史年數')
+@click.option('--exams', type=int, help='覆寫考試次數')
+def main(profile, seed_value, reset, **overrides):
+    """依負載設定檔產生測試資料"""
+    settings = dict(PROFILES[profile], **{k: v for k, v in overrides.items() if v is not None})
+    with app.app_context():
+        if reset:
+            db.drop_all()
+            db.create_all()
+            run_migrations()
+        elif Student.query.count():
+            raise click.UsageError('資料庫已有學生資料；請加上 --reset 清空重建，或以 SQLITE_PATH 指向新的資料庫')
+        seed()
+        print(f'產生測試資料：{profile}（seed={seed_value}）→ {db.engine.url}')
+        started = time.perf_counter()
+        counts = Generator(settings, random.Random(seed_value)).run()
+    print(f'✓ 共 {sum(counts.values()):,} 筆，耗時 {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
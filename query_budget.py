@@ -0,0 +1,206 @@
+"""
+SQL 查詢數預算：python query_budget.py
+
+以 SQLAlchemy 的 before_cursor_execute 事件計算每個請求實際送出的 SQL 數，
+與 BUDGETS 宣告的上限比較。超出時列出該請求的每一句 SQL、執行次數與呼叫位置
+（專案程式碼中最內層的一行），N+1（同一句 SQL 重複執行）一眼可見；有任何路由超出預算時
+以結束碼 1 結束，可直接放進 CI。
+
+資料集與 benchmark.py 共用（預設 small 設定檔，列表都有多筆資料，N+1 才會現形），
+每次執行複製一份乾淨的資料庫，不會寫入正式資料庫。
+
+新增或修改路由時，在 BUDGETS 加上（或調整）對應的項目；預算應是與資料筆數無關的固定值。
+其他腳本也可直接使用 QueryCounter：
+
+    with QueryCounter(db.engine) as counter:
+        client.get('/admin/api/grades?limit=50', headers=headers)
+    counter.check(3, 'grades')   # 超出時拋出 QueryBudgetExceeded
+"""
+
+import collections
+import os
+import random
+import shutil
+import sys
+import threading
+import traceback
+
+import click
+from sqlalchemy import event
+
+from benchmark import RUN_DB, _booking_body, _context, _grade_sheet, _prepare_database, _single_grade
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# ─────────────────────────────────────────────
+# 查詢計數
+# ─────────────────────────────────────────────
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    """
+    在 with 區塊內記錄 engine 送出的每一句 SQL 與其呼叫位置。
+    只記錄進入區塊的執行緒，背景執行緒（LINE 發送、寫入緩衝）的查詢不計入。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []    # [(sql, 呼叫位置)]
+        self._thread = None
+
+    def __enter__(self):
+        self.statements = []
+        self._thread = threading.get_ident()
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self._thread:
+            self.statements.append((' '.join(statement.split()), _call_site()))
+
+    def report(self):
+        """依第一次出現的順序列出每一句 SQL 的次數與呼叫位置"""
+        grouped = collections.OrderedDict()
+        for sql, site in self.statements:
+            grouped.setdefault(sql, collections.Counter())[site] += 1
+        lines = []
+        for sql, sites in grouped.items():
+            total = sum(sites.values())
+            where = '、'.join(f'{site}（{n}）' if len(sites) > 1 else site for site, n in sites.items())
+            lines.append(f'    {total}× {where}\n        {sql[:300]}{"…" if len(sql) > 300 else ""}')
+        return '\n'.join(lines)
+
+    def check(self, budget, label=''):
+        if self.count > budget:
+            raise QueryBudgetExceeded(f'{label} 執行了 {self.count} 句 SQL（預算 {budget}）：\n{self.report()}')
+
+
+def _call_site():
+    """堆疊中最內層的專案程式碼（略過套件與本檔），格式 檔名:行號 函式"""
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        if not os.path.isabs(frame.filename):
+            continue    # <string> 等動態產生的程式碼
+        path = os.path.abspath(frame.filename)
+        if path.startswith(ROOT + os.sep) and path != os.path.abspath(__file__) and 'site-packages' not in path:
+            return f'{os.path.relpath(path, ROOT)}:{frame.lineno} {frame.name}'
+    return '（未知）'
+
+
+# ─────────────────────────────────────────────
+# 各路由的查詢預算
+# ─────────────────────────────────────────────
+# (method, path, 上限[, body(ctx, i)])；path 以 str.format 代入 benchmark._context 的欄位。
+# 上限為目前實作的查詢數：列表固定為一次 SELECT（關聯以 joinedload 帶出）；
+# /api/slots 指定老師時由記憶體索引回答，至多一次版本檢查；寫入類含配發器的短交易。
+
+def _roll_call(ctx, i):
+    return {
+        'date': ctx['today'], 'start_time': '10:00', 'course': '預算檢查',
+        'entries': [{'student_id': student_id} for student_id in ctx['exam_students'][:30]],
+    }
+
+
+BUDGETS = [
+    ('GET', '/api/teachers', 1),
+    ('GET', '/api/courses', 1),
+    ('GET', '/api/slots?teacher_id={teacher_id}', 1),
+    ('GET', '/api/slots?days=14', 1),
+    ('POST', '/api/book', 4, _booking_body),
+    ('GET', '/admin/api/bookings?limit=50', 1),
+    ('GET', '/admin/api/bookings?status=confirmed&date_from={today}&date_to={week_ahead}', 1),
+    ('GET', '/admin/api/bookings/stats', 2),
+    ('GET', '/admin/api/students?limit=50', 1),
+    ('GET', '/admin/api/payments?limit=50', 1),
+    ('GET', '/admin/api/expenses?limit=50', 1),
+    ('GET', '/admin/api/attendance?limit=50', 1),
+    ('GET', '/admin/api/attendance?date={today}&q=a&limit=50', 1),
+    ('GET', '/admin/api/attendance/stats', 1),
+    ('POST', '/admin/api/attendance/roll-call', 3, _roll_call),
+    ('GET', '/admin/api/exams', 1),
+    ('GET', '/admin/api/grades?exam_id={exam_id}&limit=50', 1),
+    ('GET', '/admin/api/grades?q=a&limit=50', 1),
+    ('GET', '/admin/api/grades/summary?exam_id={exam_id}', 1),
+    ('GET', '/admin/api/grades/stats', 1),
+    ('POST', '/admin/api/exams/{exam_id}/grades:bulk', 9, _grade_sheet),
+    ('POST', '/admin/api/grades', 8, _single_grade),
+    ('GET', '/admin/api/finance/summary', 4),
+    ('GET', '/admin/api/finance/monthly', 2),
+    ('GET', '/admin/api/reports/ceo', 12),
+    ('GET', '/admin/api/shifts', 1),
+    ('GET', '/admin/api/shifts?date_from={today}&date_to={week_ahead}&limit=500', 1),
+    ('GET', '/admin/api/shifts/hours?month={month}', 4),
+    ('GET', '/admin/api/substitutes', 1),
+    ('GET', '/admin/api/leaves', 1),
+]
+
+
+@click.command()
+@click.option('--profile', type=click.Choice(['small', 'medium', 'large']), default='small', show_default=True,
+              help='資料集的負載設定檔（見 generate_data.py）')
+@click.option('--seed', 'seed_value', type=int, default=42, show_default=True, help='資料集亂數種子')
+@click.option('--verbose', '-v', is_flag=True, help='列出每個路由的全部 SQL')
+def main(profile, seed_value, verbose):
+    """檢查各路由每個請求的 SQL 數是否在預算內"""
+    dataset = _prepare_database(profile, seed_value)
+    os.environ.pop('DATABASE_URL', None)
+    os.environ['SQLITE_PATH'] = RUN_DB
+    os.environ['LINE_SENDER_THREAD'] = '0'
+    os.environ['REPORT_CACHE_SECONDS'] = '0'
+
+    # app 在匯入時依環境變數連線，須在設定好 SQLITE_PATH 之後才匯入
+    from app import app, db, ADMIN_PASSWORD
+    from generate_data import PROFILES, Generator
+
+    over = []
+    with app.app_context():
+        if dataset:
+            print(f'產生資料集：{profile}（seed={seed_value}）')
+            Generator(PROFILES[profile], random.Random(seed_value)).run()
+            db.session.execute(db.text('PRAGMA wal_checkpoint(TRUNCATE)'))
+            db.session.commit()
+            db.engine.dispose()
+            shutil.copyfile(RUN_DB, dataset)
+
+        ctx = _context(10)
+        client = app.test_client()
+        headers = {'X-Admin-Password': ADMIN_PASSWORD}
+        print(f'\n{"路由":<72}{"SQL":>5}{"預算":>6}')
+        for method, path, budget, *body in BUDGETS:
+            url = path.format(**ctx)
+            # 先呼叫一次讓各 worker 的快取（時段索引、自動回覆規則等）就緒，再量第二次
+            client.open(url, method=method, json=body[0](ctx, 0) if body else None, headers=headers)
+            with QueryCounter(db.engine) as counter:
+                response = client.open(url, method=method, json=body[0](ctx, 1) if body else None, headers=headers)
+            if response.status_code >= 400:
+                raise click.ClickException(f'{method} {url} 回傳 {response.status_code}：'
+                                           f'{response.get_data(as_text=True)[:200]}')
+            mark = '✗' if counter.count > budget else ' '
+            print(f'{mark} {method + " " + path:<70}{counter.count:>5}{budget:>6}')
+            if counter.count > budget:
+                over.append((method, path, budget, counter))
+            elif verbose:
+                print(counter.report())
+        db.engine.dispose()
+
+    if over:
+        print('\n✗ 超出查詢預算：')
+        for method, path, budget, counter in over:
+            print(f'\n  {method} {path}：{counter.count} 句（預算 {budget}）')
+            print(counter.report())
+        sys.exit(1)
+    print('\n✓ 所有路由都在查詢預算內')
+
+
+if __name__ == '__main__':
+    main()
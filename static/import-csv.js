@@ -0,0 +1,25 @@
+// 財務與學生管理頁共用：批次匯入 CSV（欄位可用英文欄名或中文標題），完成後列出失敗的列
+async function importCsv(name, input, onDone) {
+  const file = input.files[0];
+  input.value = '';
+  if (!file) return;
+  const form = new FormData();
+  form.append('file', file);
+  const res = await fetch(`/admin/api/import/${name}`, {
+    method: 'POST',
+    headers: { 'X-Admin-Password': sessionStorage.getItem('adminPassword') || '' },
+    body: form
+  });
+  const result = await res.json();
+  if (!res.ok) {
+    alert(result.error || '匯入失敗');
+    return;
+  }
+  let message = `已匯入 ${result.imported} 筆`;
+  if (result.failed) {
+    message += `，${result.failed} 筆失敗：\n` + result.errors.slice(0, 20)
+      .map(e => `第 ${e.row} 列：${e.errors.join('、')}`).join('\n');
+  }
+  alert(message);
+  onDone();
+}